@@ -0,0 +1,59 @@
+"""
+Size and CPU cost of the payload codecs (utils/codec.py) per chat message.
+
+Each available codec encodes and decodes, --rounds times, a MESSAGE
+payload of a single message, of --batch messages (the host's broadcast
+batch) and of --history messages (the history a host sends on CONNECT). Reported per message: encoded bytes, and microseconds to encode and
+to decode. msgpack is only measured when it is installed.
+
+Usage:
+    python -m benchmark.codec_bench --batch 50 --history 5000 --rounds 200
+"""
+import argparse
+import json
+import time
+
+from utils.codec import CODECS
+
+def messages(count):
+    return [{
+        "username": f"user-{i % 7}",
+        "message_content": f"Message number {i}, see you at the usual place around eight?",
+        "time": "12:34:56",
+    } for i in range(count)]
+
+def measure(codec, payload, rounds):
+    encoded = codec.dumps(payload)
+    assert codec.loads(encoded) == payload, codec.name
+
+    start = time.process_time()
+    for _ in range(rounds):
+        codec.dumps(payload)
+    encode = time.process_time() - start
+
+    start = time.process_time()
+    for _ in range(rounds):
+        codec.loads(encoded)
+    decode = time.process_time() - start
+
+    per = rounds * len(payload)
+    return {
+        "codec": codec.name,
+        "messages": len(payload),
+        "bytes_per_message": round(len(encoded) / len(payload), 1),
+        "encode_us_per_message": round(encode / per * 1e6, 3),
+        "decode_us_per_message": round(decode / per * 1e6, 3),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Payload codec size and CPU per message")
+    parser.add_argument("--batch", type=int, default=50, help="Messages per MESSAGE frame")
+    parser.add_argument("--history", type=int, default=5000, help="Messages in a CONNECT history")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    results = []
+    for count in (1, args.batch, args.history):
+        for codec in CODECS:
+            results.append(measure(codec, messages(count), args.rounds))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,107 @@
+"""
+Receive cost of one large frame, e.g. the history a host sends on CONNECT.
+
+A MESSAGE frame of about --size MB is delivered in --chunk byte pieces to:
+    split_loop      the former receive loops: buffer += data.decode(), then
+                    '\\' in buffer / buffer.split('\\', 1) after every chunk
+    decoder_legacy  StreamDecoder.feed() with the legacy framing
+    decoder_length  StreamDecoder.feed() with the length-prefixed framing
+    recv_into       StreamDecoder.read_frame() on a socket pair (length-prefixed),
+                    the sender writing --chunk bytes at a time
+
+Usage:
+    python -m benchmark.decoder_bench --size 10 --chunk 1024
+"""
+import argparse
+import json
+import socket
+import time
+from threading import Thread
+
+from utils.protocol import Command, Framing, StreamDecoder, create_request, parse_request
+
+def history(size_mb):
+    message = {"username": "user-0000", "message_content": "x" * 80, "time": "12:00:00"}
+    count = size_mb * 1024 * 1024 // len(json.dumps(message))
+    return [dict(message, username=f"user-{i:04d}") for i in range(count)]
+
+def chunks(data, chunk):
+    return [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+def split_loop(pieces):
+    frames = []
+    buffer = ""
+    for data in pieces:
+        buffer += data.decode("utf-8")
+        while '\\' in buffer:
+            request, buffer = buffer.split('\\', 1)
+            if request:
+                frames.append(parse_request(request, isSeparated=True))
+    return frames
+
+def decoder_feed(pieces):
+    frames = []
+    decoder = StreamDecoder()
+    for data in pieces:
+        decoder.feed(data)
+        frames.extend(decoder.frames())
+    return frames
+
+def recv_into(data, chunk):
+    sender, receiver = socket.socketpair()
+
+    def send():
+        for piece in chunks(data, chunk):
+            sender.sendall(piece)
+        sender.close()
+
+    thread = Thread(target=send)
+    start = time.perf_counter()
+    thread.start()
+    frames = []
+    decoder = StreamDecoder()
+    while True:
+        frame = decoder.read_frame(receiver, chunk)
+        if frame is None:
+            break
+        frames.append(frame)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    return frames, elapsed
+
+def measure(name, function, *args):
+    start = time.perf_counter()
+    frames = function(*args)
+    elapsed = time.perf_counter() - start
+    return name, frames, elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decoding one large frame received in small chunks")
+    parser.add_argument("--size", type=int, default=10, help="Frame size in MB")
+    parser.add_argument("--chunk", type=int, default=1024, help="Bytes per recv")
+    args = parser.parse_args()
+
+    messages = history(args.size)
+    legacy = create_request(Command.MESSAGE, messages)
+    length = create_request(Command.MESSAGE, messages, framing=Framing.LENGTH)
+
+    runs = [
+        measure("split_loop", split_loop, chunks(legacy, args.chunk)),
+        measure("decoder_legacy", decoder_feed, chunks(legacy, args.chunk)),
+        measure("decoder_length", decoder_feed, chunks(length, args.chunk)),
+    ]
+    frames, elapsed = recv_into(length, args.chunk)
+    runs.append(("recv_into", frames, elapsed))
+
+    results = []
+    for name, frames, elapsed in runs:
+        assert len(frames) == 1 and len(frames[0][1]) == len(messages), name
+        results.append({
+            "mode": name,
+            "frame_bytes": len(length),
+            "chunk": args.chunk,
+            "seconds": round(elapsed, 4),
+            "mb_per_second": round(len(length) / elapsed / 1e6, 1),
+        })
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,179 @@
+"""
+Compare the threaded PeerHost with the event-loop PeerHost.
+
+A tracker and, per mode, a host are started as their own processes. --peers
+raw clients connect to the host (CONNECT, then the history); the host's
+resident memory before and after gives the memory per connection. The
+channel owner then sends --messages messages one at a time, and the time
+until each one reached every connected peer is the broadcast latency. The
+host's own fan-out time per batch (encoding plus handing the frame to every
+peer, from DEBUG) is reported next to it.
+
+Usage:
+    python -m benchmark.host_bench --peers 5000 --messages 20
+"""
+import argparse
+import json
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from utils.protocol import Command, Status, Wire, StreamDecoder, handshake_offer, agreed_wire
+from benchmark.tracker_bench import start_tracker, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OWNER = "owner"
+
+HOST_SCRIPT = """
+import sys
+from peer.peer_host import PeerHost
+mode, port, tracker_port, peers = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+# Channels stay registered on the tracker until their lease ends, so each mode hosts its own
+PeerHost(f"bench-{mode}", "owner", "127.0.0.1", port, "127.0.0.1", tracker_port, max_connections=peers, mode=mode).listen()
+"""
+
+def raise_file_limit(needed):
+    """Allow the benchmark and the host it starts to open a socket per peer."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+def start_host(mode, port, tracker_port, peers):
+    process = subprocess.Popen(
+        [sys.executable, "-c", HOST_SCRIPT, mode, str(port), str(tracker_port), str(peers)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                # The probe took a connection slot for a moment, let the host drop it
+                time.sleep(0.2)
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Host ({mode}) did not start on port {port}")
+
+def rss(pid):
+    """Resident memory of a process in bytes."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def connect(port, username):
+    """Open a peer connection and read the CONNECT response and the history."""
+    sock = socket.create_connection(("127.0.0.1", port))
+    sock.sendall(Wire().request(Command.CONNECT, {"username": username, **handshake_offer()}))
+    decoder = StreamDecoder(size=1024)
+    _, answer = decoder.read_frame(sock)
+    decoder.read_frame(sock)
+    return sock, decoder, agreed_wire(answer)
+
+def broadcast(sender, wire, receivers, index):
+    """Send one message and return the seconds until every receiver got it."""
+    marker = f"bench-{index}"
+    selector = selectors.DefaultSelector()
+    for sock, decoder in receivers:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ, decoder)
+    waiting = len(receivers)
+    start = time.perf_counter()
+    sender.sendall(wire.request(Command.MESSAGE, [{"username": OWNER, "message_content": marker}]))
+    deadline = start + 30
+    while waiting and time.perf_counter() < deadline:
+        for key, _ in selector.select(timeout=1):
+            data = key.fileobj.recv(65536)
+            if not data:
+                selector.unregister(key.fileobj)
+                waiting -= 1
+                continue
+            key.data.feed(data)
+            for command, payload in key.data.frames():
+                if command == Command.MESSAGE.value and any(m["message_content"] == marker for m in payload):
+                    selector.unregister(key.fileobj)
+                    waiting -= 1
+    elapsed = time.perf_counter() - start
+    selector.close()
+    for sock, _ in receivers:
+        sock.setblocking(True)
+    return elapsed, waiting
+
+def host_stats(sock, decoder, wire):
+    """The broadcast stats of the host's DEBUG reply."""
+    sock.sendall(wire.request(Command.DEBUG, {}))
+    while True:
+        command, payload = decoder.read_frame(sock)
+        if command == Status.OK.value and isinstance(payload, dict) and "broadcast" in payload:
+            return payload["broadcast"]
+
+def bench_mode(mode, port, tracker_port, args):
+    process = start_host(mode, port, tracker_port, args.peers + 1)
+    receivers = []
+    try:
+        before = rss(process.pid)
+        start = time.perf_counter()
+        for i in range(args.peers):
+            sock, decoder, _ = connect(port, f"peer-{i}")
+            receivers.append((sock, decoder))
+        connect_time = time.perf_counter() - start
+        # Let the host finish setting up the last connections
+        time.sleep(0.5)
+        after = rss(process.pid)
+
+        sender, sender_decoder, wire = connect(port, OWNER)
+        latencies = []
+        missed = 0
+        for i in range(args.messages):
+            elapsed, waiting = broadcast(sender, wire, receivers, i)
+            latencies.append(elapsed)
+            missed += waiting
+        fanout = host_stats(sender, sender_decoder, wire)
+        sender.close()
+    finally:
+        for sock, _ in receivers:
+            sock.close()
+        process.terminate()
+        process.wait()
+    return {
+        "mode": mode,
+        "peers": args.peers,
+        "connects_per_second": round(args.peers / connect_time, 1),
+        "rss_before_bytes": before,
+        "rss_after_bytes": after,
+        "bytes_per_connection": round((after - before) / args.peers) if args.peers else 0,
+        "broadcast_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "broadcast_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "broadcast_max_ms": round(max(latencies, default=0) * 1000, 3),
+        "missed_deliveries": missed,
+        "fanout_avg_ms": fanout["fanout_avg_ms"],
+        "fanout_max_ms": fanout["fanout_max_ms"],
+        "encodes_per_batch": round(fanout["encodes"] / fanout["batches"], 2) if fanout["batches"] else None,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Threaded vs event-loop PeerHost benchmark")
+    parser.add_argument("--peers", type=int, default=1000, help="Peers connected to the host")
+    parser.add_argument("--messages", type=int, default=20, help="Messages broadcast to the peers")
+    parser.add_argument("--modes", default="threaded,async")
+    parser.add_argument("--port", type=int, default=23336)
+    args = parser.parse_args()
+
+    # Benchmark and host each hold a socket per peer
+    raise_file_limit(args.peers * 2 + 256)
+    tracker = start_tracker("async", args.port)
+    try:
+        results = [
+            bench_mode(mode, args.port + 1 + i, args.port, args)
+            for i, mode in enumerate(args.modes.split(","))
+        ]
+    finally:
+        tracker.terminate()
+        tracker.wait()
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,139 @@
+"""
+Login throughput of the tracker at 10k accounts.
+
+1. In process: the old linear scan over a plaintext account list against the
+   indexed AccountStore, for the lookup alone and for a full hashed login.
+2. Over the wire: an event-loop tracker recovered with --accounts accounts
+   answers a SIGNIN storm from concurrent clients while LIST latency is
+   sampled, showing that hashing runs off the loop.
+
+Usage:
+    python -m benchmark.login_bench --accounts 10000 --iterations 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils.accounts import AccountStore, hash_password
+from utils.protocol import Command, create_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def bench_in_process(accounts, iterations, logins):
+    plaintext = [{"username": f"user-{i}", "password": f"password-{i}"} for i in range(accounts)]
+    store = AccountStore(iterations=iterations)
+    store.accounts = {f"user-{i}": hash_password(f"password-{i}", iterations=iterations) for i in range(accounts)}
+
+    # Lookup only: the last user is the worst case of the scan
+    start = time.perf_counter()
+    for _ in range(logins):
+        any(a["username"] == f"user-{accounts - 1}" and a["password"] == f"password-{accounts - 1}" for a in plaintext)
+    linear = logins / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(logins):
+        with store.lock:
+            store.accounts.get(f"user-{accounts - 1}")
+    indexed = logins / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(logins):
+        assert store.authenticate(f"user-{i}", f"password-{i}")
+    hashed = logins / (time.perf_counter() - start)
+    store.pool.shutdown()
+
+    return {
+        "accounts": accounts,
+        "linear_scan_lookups_per_second": round(linear, 1),
+        "indexed_lookups_per_second": round(indexed, 1),
+        "hashed_logins_per_second": round(hashed, 1),
+    }
+
+def write_snapshot(data_dir, accounts, iterations):
+    with open(os.path.join(data_dir, "snapshot.json"), "w") as f:
+        json.dump({"accounts": {"accounts": {
+            f"user-{i}": hash_password(f"password-{i}", iterations=iterations) for i in range(accounts)
+        }}}, f)
+
+async def request(port, command, payload):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    start = time.perf_counter()
+    writer.write(create_request(command, payload))
+    response = await reader.readuntil(b"\\")
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return response, elapsed
+
+async def storm(port, logins, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    list_latencies = []
+    done = False
+
+    async def login(i):
+        async with semaphore:
+            response, _ = await request(port, Command.SIGNIN, {"username": f"user-{i}", "password": f"password-{i}"})
+            assert response.startswith(b"OK"), response
+
+    async def sample_list():
+        while not done:
+            _, elapsed = await request(port, Command.LIST, {})
+            list_latencies.append(elapsed)
+            await asyncio.sleep(0.01)
+
+    sampler = asyncio.create_task(sample_list())
+    start = time.perf_counter()
+    await asyncio.gather(*(login(i) for i in range(logins)))
+    elapsed = time.perf_counter() - start
+    done = True
+    await sampler
+    list_latencies.sort()
+    return {
+        "logins_per_second": round(logins / elapsed, 1),
+        "list_samples": len(list_latencies),
+        "list_p99_ms_during_logins": round(list_latencies[int(len(list_latencies) * 0.99) - 1] * 1000, 3),
+    }
+
+def bench_tracker(accounts, iterations, logins, concurrency, workers, port):
+    data_dir = tempfile.mkdtemp(prefix="login-bench-")
+    write_snapshot(data_dir, accounts, iterations)
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "tracker.py"), "--mode", "async", "--port", str(port),
+         "--data-dir", data_dir, "--workers", str(workers)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        for _ in range(200):
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                    break
+            except OSError:
+                time.sleep(0.05)
+        result = asyncio.run(storm(port, logins, concurrency))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(data_dir)
+    result.update({"accounts": accounts, "workers": workers, "concurrency": concurrency})
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tracker login throughput")
+    parser.add_argument("--accounts", type=int, default=10000)
+    parser.add_argument("--iterations", type=int, default=1000, help="PBKDF2 iterations of the test accounts")
+    parser.add_argument("--logins", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=25236)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "in_process": bench_in_process(args.accounts, args.iterations, args.logins),
+        "tracker": bench_tracker(args.accounts, args.iterations, args.logins, args.concurrency, args.workers, args.port),
+    }, indent=2))
@@ -0,0 +1,115 @@
+"""
+Measure a PeerHost whose channel history is kept on disk (--data-dir).
+
+A host appends --messages messages to its log, then, each in a fresh
+process:
+    restart   time to construct the host on the existing log (open the
+              segments, recover the last one, load the memory tail), and its
+              resident memory next to that of a host without a log
+    history   time to build random pages of history (catch_up), from disk
+              before the memory tail and from memory within it
+
+Usage:
+    python -m benchmark.message_log_bench --messages 10000000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHANNEL = "bench"
+
+def rss():
+    """Resident memory of this process in bytes."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def make_host(data_dir):
+    from peer.peer_host import PeerHost
+    # Port 0: the host is never listened on, only its history is used
+    return PeerHost(CHANNEL, "owner", "127.0.0.1", 0, "127.0.0.1", 1, data_dir=data_dir or None)
+
+def write_log(data_dir, messages):
+    # Runs in a child process, like the restart that follows
+    host = make_host(data_dir)
+    count = messages - (host.next_seq - 1)  # The host wrote its welcome messages
+    start = time.perf_counter()
+    for i in range(count):
+        host._append_message({"username": f"user-{i % 13}", "message_content": f"Message number {i}, see you at eight?"},
+                             broadcast=False)
+    elapsed = time.perf_counter() - start
+    host.log.close()
+    return {"seconds": round(elapsed, 3), "appends_per_second": round(count / elapsed, 1)}
+
+def restart(data_dir):
+    base = rss()
+    start = time.perf_counter()
+    host = make_host(data_dir)
+    elapsed = time.perf_counter() - start
+    return {"seconds": round(elapsed, 3), "rss_bytes": rss(), "rss_growth_bytes": rss() - base,
+            "messages": host.next_seq - host._first_seq(), "memory_tail": len(host.messages)}
+
+def history(data_dir, pages):
+    from utils.protocol import Wire
+    from utils.outbox import PAGE_SIZE
+    from benchmark.tracker_bench import percentile
+
+    host = make_host(data_dir)
+    wire = Wire()
+    results = {}
+    tail_start = host.messages[0]["seq"]
+    for source, low, high in (("disk", host._first_seq(), tail_start - PAGE_SIZE),
+                              ("memory", tail_start, host.next_seq - PAGE_SIZE)):
+        if high <= low:
+            continue
+        latencies = []
+        for _ in range(pages):
+            page = random.randrange(low, high)
+            start = time.perf_counter()
+            host.catch_up(wire, page, page + PAGE_SIZE)
+            latencies.append(time.perf_counter() - start)
+        results[source] = {
+            "page_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "page_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        }
+    return results
+
+def run_child(function, *args):
+    code = (
+        "import json, sys; sys.path.insert(0, %r); "
+        "from benchmark.message_log_bench import %s; "
+        "print(json.dumps(%s(*%r)))" % (ROOT, function, function, list(args))
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def directory_size(path):
+    """Bytes allocated on disk, the index files being sparse until filled."""
+    return sum(os.stat(os.path.join(root, name)).st_blocks * 512 for root, _, names in os.walk(path) for name in names)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PeerHost message log write, restart and history read")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--pages", type=int, default=200, help="History pages read from disk and from memory")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="message-log-bench-")
+    try:
+        result = {"messages": args.messages, "write": run_child("write_log", data_dir, args.messages)}
+        result["bytes_on_disk"] = directory_size(data_dir)
+        result["restart"] = run_child("restart", data_dir)
+        result["restart"]["rss_without_log_bytes"] = run_child("restart", "")["rss_bytes"]
+        result["history"] = run_child("history", data_dir, args.pages)
+    finally:
+        shutil.rmtree(data_dir)
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,178 @@
+"""
+Encode and decode cost of utils/protocol.py, to compare revisions.
+
+create_request, create_response, parse_request and parse_response are
+measured on MESSAGE payloads of a single message, a 50-message batch and a
+10k-message history, in every wire mode:
+    legacy/json          separator-ended frames, parsed by parse_request/parse_response
+    length/json          length-prefixed frames, parsed by StreamDecoder
+    length/binary        ...with the binary codec
+    length/msgpack       ...with msgpack, if installed
+    length/binary+zlib   ...compressed, encoded through Wire (create_* have no compression)
+Reported per case: frame bytes, microseconds and operations per second, and
+the peak bytes allocated by one operation (tracemalloc, measured apart from
+the timing). The dispatch section times create_request of a small payload
+for every Command, i.e. the per-command branches of request_body.
+
+Results are printed as JSON; --output also writes them to a file, and
+--compare prints each case's time relative to an earlier result file:
+    python -m benchmark.protocol_bench --output before.json
+    (change something)
+    python -m benchmark.protocol_bench --compare before.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+
+from utils.codec import CODECS, JSON, BINARY
+from utils.protocol import (Command, Status, Framing, Wire, StreamDecoder, create_request, create_response,
+                            parse_request, parse_response)
+
+SIZES = {"single": 1, "batch": 50, "history": 10000}
+
+def messages(count):
+    return [{
+        "username": f"user-{i % 13}",
+        "message_content": f"Message number {i}, see you at the usual place around eight?",
+        "time": "12:34:56",
+    } for i in range(count)]
+
+def modes():
+    yield "legacy/json", Wire()
+    for codec in CODECS:
+        yield f"length/{codec.name}", Wire(Framing.LENGTH, codec=codec)
+    yield "length/binary+zlib", Wire(Framing.LENGTH, codec=BINARY, compression="zlib")
+
+def encoders(wire):
+    """create_request and create_response in the wire's mode."""
+    if wire.compression:
+        return (lambda payload: wire.request(Command.MESSAGE, payload),
+                lambda payload: wire.response(Status.OK, payload))
+    return (lambda payload: create_request(Command.MESSAGE, payload, framing=wire.framing, codec=wire.codec),
+            lambda payload: create_response(Status.OK, payload, framing=wire.framing, codec=wire.codec))
+
+def decoder(wire, parse):
+    """parse_request or parse_response of a frame in the wire's mode."""
+    if wire.framing == Framing.LEGACY:
+        return parse
+    stream = StreamDecoder()
+
+    def decode(frame):
+        stream.feed(frame)
+        return next(stream.frames())
+    return decode
+
+def measure(function, argument, min_time):
+    """Microseconds per call, repeating until min_time seconds were spent, and peak bytes allocated by one call."""
+    rounds = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            function(argument)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        rounds *= 2 if elapsed <= 0 else max(2, min(10, int(min_time / elapsed) + 1))
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        function(argument)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return elapsed / rounds * 1e6, peak
+
+def result(section, operation, mode, size, frame, us, peak):
+    return {
+        "section": section,
+        "operation": operation,
+        "mode": mode,
+        "size": size,
+        "frame_bytes": len(frame),
+        "us_per_op": round(us, 3),
+        "ops_per_second": round(1e6 / us, 1),
+        "peak_alloc_bytes": peak,
+    }
+
+def run_codecs(min_time):
+    results = []
+    for size, count in SIZES.items():
+        payload = messages(count)
+        for mode, wire in modes():
+            encode_request, encode_response = encoders(wire)
+            request = encode_request(payload)
+            response = encode_response(payload)
+            decode_request = decoder(wire, parse_request)
+            decode_response = decoder(wire, parse_response)
+            assert decode_request(request) == (Command.MESSAGE.value, payload), mode
+            assert decode_response(response) == (Status.OK.value, payload), mode
+
+            for operation, function, argument, frame in [
+                ("create_request", encode_request, payload, request),
+                ("create_response", encode_response, payload, response),
+                ("parse_request", decode_request, request, request),
+                ("parse_response", decode_response, response, response),
+            ]:
+                us, peak = measure(function, argument, min_time)
+                results.append(result("codec", operation, mode, size, frame, us, peak))
+    return results
+
+def run_dispatch(min_time):
+    results = []
+    payload = {"channel_name": "general", "username": "user-1"}
+    for command in Command:
+        frame = create_request(command, payload, framing=Framing.LENGTH, codec=JSON)
+        us, peak = measure(lambda payload: create_request(command, payload, framing=Framing.LENGTH, codec=JSON),
+                           payload, min_time)
+        results.append(result("dispatch", "create_request", command.value, "small", frame, us, peak))
+    return results
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """Time of each case relative to the same case in baseline (above 1: slower now)."""
+    before = {(r["section"], r["operation"], r["mode"], r["size"]): r for r in baseline["results"]}
+    changes = []
+    for r in results:
+        old = before.get((r["section"], r["operation"], r["mode"], r["size"]))
+        if old is not None:
+            changes.append({
+                "section": r["section"],
+                "operation": r["operation"],
+                "mode": r["mode"],
+                "size": r["size"],
+                "time_ratio": round(r["us_per_op"] / old["us_per_op"], 3),
+                "alloc_ratio": round(r["peak_alloc_bytes"] / old["peak_alloc_bytes"], 3) if old["peak_alloc_bytes"] else None,
+            })
+    return {"baseline_revision": baseline.get("revision"), "changes": changes}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="utils/protocol.py encode and decode microbenchmarks")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Seconds spent timing each case")
+    parser.add_argument("--output", default="", help="Also write the results to this file")
+    parser.add_argument("--compare", default="", help="Results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "codecs": [codec.name for codec in CODECS],
+        "results": run_codecs(args.min_time) + run_dispatch(args.min_time),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            report["comparison"] = compare(report["results"], json.load(f))
+    print(json.dumps(report, indent=2))
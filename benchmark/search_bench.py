@@ -0,0 +1,127 @@
+"""
+Measure the SEARCH index of a channel (utils/search.py).
+
+--messages chat messages are generated, with words drawn from a Zipf-like
+distribution over a vocabulary of --vocabulary words and 200 users, and
+added to a SearchIndex one at a time as PeerHost does on append. Reported:
+the build time, the index's resident memory per message (process RSS before
+and after, the messages themselves excluded), and the p50/p99 latency of
+--queries queries of each kind:
+    rare         one word out of the least frequent half of the vocabulary
+    common       one of the 10 most frequent words
+    two_terms    two of the 11th to 200th most frequent words
+    user         a user's messages holding one of those words
+    time_range   one of those words in a random tenth of the history
+    relevance    two of those words, ranked by BM25
+    deep_page    a common word, 20 results from offset 1000
+
+Usage:
+    python -m benchmark.search_bench --messages 1000000
+"""
+import argparse
+import gc
+import itertools
+import json
+import random
+import time
+
+from utils.search import SearchIndex
+from benchmark.tracker_bench import percentile
+
+START_TS = 1_700_000_000_000
+
+def rss():
+    """Resident memory of this process in bytes."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def vocabulary(size):
+    return [f"w{i}" for i in range(size)]
+
+def message_stream(count, words, rng):
+    """Chat-like messages of 3 to 20 words, 200 users, about one message every 100 ms."""
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    for seq in range(1, count + 1):
+        yield {
+            "seq": seq,
+            "ts": START_TS + seq * 100,
+            "username": f"user-{rng.randrange(200)}",
+            "message_content": " ".join(rng.choices(words, cum_weights=cum_weights, k=rng.randint(3, 20))),
+        }
+
+def build(count, words, rng):
+    index = SearchIndex()
+    gc.collect()
+    before = rss()
+    elapsed = 0
+    stream = message_stream(count, words, rng)
+    while True:
+        # Messages are generated in batches outside the timing, and dropped once indexed
+        batch = [message for _, message in zip(range(10000), stream)]
+        if not batch:
+            break
+        start = time.perf_counter()
+        for message in batch:
+            index.add(message)
+        elapsed += time.perf_counter() - start
+    del batch
+    gc.collect()
+    return index, elapsed, rss() - before
+
+def queries(kind, words, count, rng):
+    middle = words[10:200]
+    if kind == "rare":
+        return {"query": rng.choice(words[len(words) // 2:])}
+    if kind == "common":
+        return {"query": rng.choice(words[:10])}
+    if kind == "two_terms":
+        return {"query": " ".join(rng.sample(middle, 2))}
+    if kind == "user":
+        return {"query": rng.choice(middle), "username": f"user-{rng.randrange(200)}"}
+    if kind == "time_range":
+        since = START_TS + rng.randrange(count) * 100
+        return {"query": rng.choice(middle), "since": since, "until": since + count * 10}
+    if kind == "relevance":
+        return {"query": " ".join(rng.sample(middle, 2)), "sort": "relevance"}
+    if kind == "deep_page":
+        return {"query": rng.choice(words[:10]), "offset": 1000}
+    raise ValueError(kind)
+
+KINDS = ("rare", "common", "two_terms", "user", "time_range", "relevance", "deep_page")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Channel search index build, memory and query latency")
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--vocabulary", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200, help="Queries timed per kind")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    words = vocabulary(args.vocabulary)
+    index, build_seconds, memory = build(args.messages, words, rng)
+    result = {
+        "messages": args.messages,
+        "build_seconds": round(build_seconds, 3),
+        "messages_per_second": round(args.messages / build_seconds, 1),
+        "rss_bytes_per_message": round(memory / args.messages, 1),
+        "index": index.stats(),
+        "queries": {},
+    }
+    for kind in KINDS:
+        latencies = []
+        totals = []
+        for _ in range(args.queries):
+            query = queries(kind, words, args.messages, rng)
+            start = time.perf_counter()
+            total, _ = index.search(limit=20, **query)
+            latencies.append(time.perf_counter() - start)
+            totals.append(total)
+        result["queries"][kind] = {
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "median_matches": sorted(totals)[len(totals) // 2],
+        }
+    print(json.dumps(result, indent=2))
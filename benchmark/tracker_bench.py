@@ -0,0 +1,109 @@
+"""
+Compare the threaded tracker with the event-loop tracker.
+
+Each mode is started as its own tracker process, pre-filled with channels,
+then hammered by many concurrent short-lived clients that each connect,
+send LIST and disconnect (the pattern of PeerClient.get_peer_hosts).
+
+Usage:
+    python -m benchmark.tracker_bench --connections 5000 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from utils.protocol import Command, create_request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start_tracker(mode, port):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "tracker.py"), "--mode", mode, "--port", str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # Wait until the tracker accepts connections
+    for _ in range(100):
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Tracker ({mode}) did not start on port {port}")
+
+def fill_channels(port, count):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.sendall(create_request(Command.HOST, [
+            {"channel_name": f"channel-{i}", "peer_server_ip": "127.0.0.1", "peer_server_port": 20000 + i}
+            for i in range(count)
+        ]))
+        sock.recv(4096)
+
+async def list_once(port, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    start = time.perf_counter()
+    writer.write(create_request(Command.LIST, {}))
+    await reader.readuntil(b"\\")
+    latencies.append(time.perf_counter() - start)
+    writer.close()
+
+async def run_load(port, connections, concurrency):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker():
+        nonlocal errors
+        async with semaphore:
+            try:
+                await list_once(port, latencies)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(connections)))
+    elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def bench_mode(mode, port, args):
+    process = start_tracker(mode, port)
+    try:
+        fill_channels(port, args.channels)
+        latencies, errors, elapsed = asyncio.run(run_load(port, args.connections, args.concurrency))
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        "mode": mode,
+        "connections": args.connections,
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "connections_per_second": round(len(latencies) / elapsed, 1),
+        "list_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "list_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Threaded vs event-loop tracker benchmark")
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=50, help="Channels registered before the run")
+    parser.add_argument("--port", type=int, default=23236)
+    args = parser.parse_args()
+
+    results = [
+        bench_mode("threaded", args.port, args),
+        bench_mode("async", args.port + 1, args),
+    ]
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,100 @@
+"""
+Measure how long the tracker takes to recover its state on startup.
+
+A data directory with --channels channels and --accounts accounts is built
+through the tracker's own journal, then recovery is timed in a fresh process
+for two layouts:
+    snapshot: everything compacted into the snapshot, plus a --tail record log
+    log-only: the same mutations replayed from the log alone (no compaction)
+
+Usage:
+    python -m benchmark.tracker_recovery_bench --channels 100000 --accounts 100000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def build_data_dir(data_dir, channels, accounts, tail, compact):
+    # Runs in a child process so the tracker module state starts empty
+    import tracker
+
+    # Cheap password hashes, this measures recovery and not account creation
+    tracker.accounts.iterations = 1000
+    tracker.load_state(data_dir, snapshot_every=10**12)
+    for i in range(channels):
+        tracker.handle_request("HOST", [{
+            "channel_name": f"channel-{i}",
+            "peer_server_ip": "10.0.0.1",
+            "peer_server_port": 20000 + i % 40000,
+            "ttl": 30,
+        }])
+    for i in range(accounts):
+        tracker.handle_request("SIGNUP", {"username": f"user-{i}", "password": f"password-{i}"})
+    if compact:
+        tracker.journal.compact(tracker.dump_state)
+    # Log tail after the snapshot: half new channels, half removals
+    for i in range(tail):
+        if i % 2:
+            tracker.handle_request("UNHOST", [{
+                "channel_name": f"channel-{i}",
+                "peer_server_ip": "10.0.0.1",
+                "peer_server_port": 20000 + i % 40000,
+            }])
+        else:
+            tracker.handle_request("HOST", [{
+                "channel_name": f"tail-{i}",
+                "peer_server_ip": "10.0.0.2",
+                "peer_server_port": 20000 + i % 40000,
+            }])
+    tracker.journal.close()
+
+def time_recovery(data_dir):
+    # Runs in a child process so the tracker module state starts empty
+    import tracker
+
+    start = time.perf_counter()
+    tracker.load_state(data_dir)
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": round(elapsed, 3),
+        "channels": len(tracker.registry.channels),
+        "accounts": len(tracker.accounts.accounts),
+    }
+
+def run_child(function, *args):
+    code = (
+        "import json, sys; sys.path.insert(0, %r); "
+        "from benchmark.tracker_recovery_bench import %s; "
+        "print(json.dumps(%s(*%r)))" % (ROOT, function, function, list(args))
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tracker startup time from snapshot and log")
+    parser.add_argument("--channels", type=int, default=100000)
+    parser.add_argument("--accounts", type=int, default=100000)
+    parser.add_argument("--tail", type=int, default=10000, help="Log records written after the snapshot")
+    args = parser.parse_args()
+
+    results = []
+    for layout, compact in (("snapshot", True), ("log-only", False)):
+        data_dir = tempfile.mkdtemp(prefix="tracker-bench-")
+        try:
+            run_child("build_data_dir", data_dir, args.channels, args.accounts, args.tail, compact)
+            result = run_child("time_recovery", data_dir)
+            result.update({"layout": layout, "bytes_on_disk": directory_size(data_dir)})
+            results.append(result)
+        finally:
+            shutil.rmtree(data_dir)
+    print(json.dumps(results, indent=2))
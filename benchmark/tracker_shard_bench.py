@@ -0,0 +1,103 @@
+"""
+Run several tracker shards on localhost and check routing and fan-out.
+
+Starts `tracker.py --shards N`, registers channels on the shard chosen by the
+hash ring (as PeerHost does), verifies that every shard only holds the
+channels it owns and that a fan-out LIST returns all of them, then measures
+LOOKUP throughput from concurrent clients against 1 shard and N shards.
+
+Usage:
+    python -m benchmark.tracker_shard_bench --shards 4 --channels 2000
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from peer.peer_client import PeerClient
+from utils.hash_ring import HashRing
+from utils.protocol import Command, Status
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def start_shards(port, shards):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "tracker.py"), "--mode", "async",
+         "--port", str(port), "--shards", str(shards)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    trackers = [("127.0.0.1", port + index) for index in range(shards)]
+    for tracker in trackers:
+        for _ in range(100):
+            try:
+                with socket.create_connection(tracker, timeout=0.1):
+                    break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            process.terminate()
+            raise RuntimeError(f"Tracker shard {tracker} did not start")
+    return process, trackers
+
+def run(port, shards, channels, clients):
+    process, trackers = start_shards(port, shards)
+    try:
+        client = PeerClient("bench", trackers[0][0], trackers[0][1], trackers)
+        ring = HashRing(trackers)
+
+        # Register every channel on the shard that owns it
+        for i in range(channels):
+            name = f"channel-{i}"
+            status, _ = client._request_tracker(ring.node_for(name), Command.HOST, {
+                "channel_name": name, "peer_server_ip": "127.0.0.1", "peer_server_port": 20000 + i
+            })
+            assert status == Status.OK.value
+
+        # Each shard holds exactly its slice, the fan-out LIST holds everything
+        per_shard = {}
+        for tracker in trackers:
+            _, stats = client._request_tracker(tracker, Command.STATS, {})
+            per_shard[f"{tracker[0]}:{tracker[1]}"] = stats["channels"]
+        listed = client.get_peer_hosts()
+        assert len(listed) == channels, f"fan-out LIST returned {len(listed)} of {channels} channels"
+        assert sum(per_shard.values()) == channels
+
+        def lookup(i):
+            assert client.lookup_channel(f"channel-{i % channels}") is not None
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            list(executor.map(lookup, range(channels)))
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        client.get_peer_hosts()
+        list_seconds = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "shards": shards,
+        "channels_per_shard": per_shard,
+        "lookups_per_second": round(channels / elapsed, 1),
+        "fan_out_list_ms": round(list_seconds * 1000, 3),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sharded tracker routing check and benchmark")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent LOOKUP clients")
+    parser.add_argument("--port", type=int, default=24236)
+    args = parser.parse_args()
+
+    results = [
+        run(args.port, 1, args.channels, args.clients),
+        run(args.port + 100, args.shards, args.channels, args.clients),
+    ]
+    print(json.dumps(results, indent=2))
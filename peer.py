@@ -2,6 +2,8 @@ import argparse
 import random
 from peer.peer_host import PeerHost
 from peer.peer_client import PeerClient
+from utils.hash_ring import parse_nodes
+from utils.history import Retention, JsonLinesArchive
 from threading import Thread
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
@@ -196,6 +198,16 @@ class ChannelListPage(Page):
         logout_button = tk.Button(self.main_container, text="Logout", font=("Arial", 10), 
                                  command=self.logout, bg="#e74c3c", fg="white")
         logout_button.pack(pady=(0, 10))
+        
+        # Directory revision currently displayed, None until the page is first loaded
+        self.shown_directory_revision = None
+        self.watch_directory()
+    
+    def watch_directory(self):
+        # Redraw when the pushed directory changed; this only reads local state
+        if self.shown_directory_revision is not None and self.shown_directory_revision != self.controller.client.directory_revision:
+            self.load_channels()
+        self.after(1000, self.watch_directory)
     
     def load_channels(self):
         # Update username display
@@ -209,6 +221,7 @@ class ChannelListPage(Page):
         
         # Get all available channels
         channels = getAllChannel()
+        self.shown_directory_revision = self.controller.client.directory_revision
         print(channels)
         
         # Get connected channels
@@ -547,7 +560,10 @@ def exitFunc():
         client.disconnect(channel['channel_name'])
 
 def getAllChannel():
-    return client.get_peer_hosts()
+    # The subscription keeps the directory live, only ask the tracker when it is not running
+    if client.directory_subscribed:
+        return client.get_directory()
+    return client.refresh_directory()
 
 def getAllConnectedChannel():
     channel_list = []
@@ -558,12 +574,7 @@ def getAllConnectedChannel():
     return channel_list
 
 def joinChannel(channel_name):
-    hosts = client.get_peer_hosts()
-    target_host = None
-    for host in hosts:
-        if host['channel_name'] == channel_name:
-            target_host = host
-            break
+    target_host = client.lookup_channel(channel_name)
         
     if target_host:
         if channel_name in client.channels:
@@ -580,7 +591,7 @@ def joinChannel(channel_name):
 def getMessage(channel_name):
         # Display current messages for this channel
     with client.messages_lock:
-        all_message = client.messages.get(channel_name, [])
+        all_message = list(client.messages.get(channel_name, []))
         client._send_cached_messages(channel_name)
         return all_message
 
@@ -611,6 +622,18 @@ if __name__ == "__main__":
     parser.add_argument('--peer-host-port', type=int, default=0, help='Port for hosting a peer server, 0 for random')
     parser.add_argument('--channel-name', default='', help='Name of the channel to host, if empty, only client mode')
     parser.add_argument('--username', default='User', help='Username for the client')
+    parser.add_argument('--tracker-shards', default='', help='Sharded trackers as ip:port,ip:port (overrides --tracker-ip/--tracker-port)')
+    parser.add_argument('--host-mode', choices=['threaded', 'async'], default='threaded',
+                        help='Serve the hosted channel with a thread per peer or with one event loop for all peers')
+    parser.add_argument('--overflow-policy', choices=['drop_oldest', 'disconnect', 'resync'], default='resync',
+                        help='What the hosted channel does with a peer whose outbound queue is full')
+    parser.add_argument('--outbound-queue-size', type=int, default=256, help='Frames queued per peer before the overflow policy applies')
+    parser.add_argument('--data-dir', default='', help='Directory for the hosted channel\'s message log, if empty the history is kept in memory only')
+    parser.add_argument('--retention-messages', type=int, default=None, help='Keep only the last N messages of each channel')
+    parser.add_argument('--retention-age', type=float, default=None, help='Keep only the messages newer than this many seconds')
+    parser.add_argument('--retention-bytes', type=int, default=None, help='Keep up to this many bytes of messages per channel')
+    parser.add_argument('--search', action='store_true', help='Index the hosted channel\'s history to answer SEARCH (rebuilt from the log on startup with --data-dir)')
+    parser.add_argument('--retention-archive', default='', help='File the hosted channel appends the messages past its retention to, if empty they are dropped')
     
     args = parser.parse_args()
     tracker_ip = args.tracker_ip
@@ -619,16 +642,27 @@ if __name__ == "__main__":
     peer_host_port = args.peer_host_port if args.peer_host_port != 0 else random.randint(6000, 7000)
     channel_name = args.channel_name
     username = args.username
+    tracker_shards = parse_nodes(args.tracker_shards)
+    
+    retention = Retention(args.retention_messages, args.retention_age, args.retention_bytes)
+    archive = JsonLinesArchive(args.retention_archive) if args.retention_archive else None
     
     # Create PeerClient for client operations
-    client = PeerClient(username, tracker_ip, tracker_port)
+    client = PeerClient(username, tracker_ip, tracker_port, tracker_shards,
+                        retention=retention if retention else None)
     
     # If channel name is provided, run as host as well
     if channel_name:
-        peer_host = PeerHost(channel_name, username, peer_host_ip, peer_host_port, tracker_ip, tracker_port)
+        peer_host = PeerHost(channel_name, username, peer_host_ip, peer_host_port, tracker_ip, tracker_port,
+                             tracker_shards=tracker_shards, mode=args.host_mode,
+                             outbound_queue_size=args.outbound_queue_size, overflow_policy=args.overflow_policy,
+                             data_dir=args.data_dir, retention=retention, archive=archive, search=args.search)
         Thread(target=peer_server, args=(peer_host,), daemon=True).start()
         print(f"Hosting channel '{channel_name}' on {peer_host_ip}:{peer_host_port}")
     
+    # Keep the channel directory updated by the tracker
+    client.subscribe_directory()
+    
     # Start the GUI
     app = App(client)
     
@@ -1,53 +1,402 @@
 import socket
 import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor, Future
 from threading import Thread, Lock
-from utils.protocol import Command, Status, create_request, parse_response
+from utils.protocol import Command, Status, Framing, Wire, StreamDecoder, handshake_offer, agreed_wire, batch_items
+from utils.pending import PendingResponses, REQUEST_TIMEOUT
+from utils.hash_ring import HashRing
+from utils.history import MessageRing, Retention
 import time
 
+# Messages kept per channel unless given another retention, older ones are dropped
+CLIENT_HISTORY = 10000
+
+def new_message_id():
+    """A unique id for a message sent by this client, for the host to recognize replays."""
+    return uuid.uuid4().hex
+
 class PeerClient:
-    def __init__(self, username, tracker_ip, tracker_port):
+    def __init__(self, username, tracker_ip, tracker_port, tracker_shards=None, retention=None, archive=None):
         # Tracker information
         self.tracker_ip = tracker_ip
         self.tracker_port = tracker_port
         
+        # Tracker shards [(ip, port), ...], each owning the channels the hash ring maps to it
+        self.trackers = [tuple(tracker) for tracker in tracker_shards] if tracker_shards else [(tracker_ip, tracker_port)]
+        self.tracker_ring = HashRing(self.trackers)
+        self.tracker_wires = {}  # {tracker: Wire}, framing agreed with a HELLO on first contact
+        # Open connections to trackers that take request ids, shared by all requests to a tracker
+        self.tracker_sessions = {}  # {tracker: {socket, wire, decoder, pending, send_lock}}
+        self.tracker_sessions_lock = Lock()
+        
         # Peer client information
         self.username = username
         
         # Peer host information using channel_name as key
         self.channels = {}  # Store channel information {channel_name: {ip, port, socket}}
-        self.messages = {}  # Messages per channel {channel_name: [message1, message2, ...]}
+        self.messages = {}  # Messages per channel {channel_name: MessageRing}
         self.messages_lock = Lock()
+        # How much history to keep per channel (utils/history.py), evicted messages go to archive or are dropped
+        self.retention = retention or Retention(max_messages=CLIENT_HISTORY)
+        self.archive = archive
+        self.channel_retention = {}  # {channel_name: (Retention, archive)}, overriding the above
+        
+        # Local copy of the trackers' channel directory, kept up to date with LIST deltas
+        self.directory = {}  # {channel_name: {channel_name, peer_server_ip, peer_server_port}}
+        self.shard_channels = {tracker: set() for tracker in self.trackers}  # {tracker: {channel_name, ...}}
+        self.directory_versions = {tracker: 0 for tracker in self.trackers}  # Last version seen per tracker
+        self.directory_revision = 0  # Bumped on every local change, lets the GUI detect updates
+        self.directory_lock = Lock()
+        self.directory_subscribed = False
+        self.on_directory_change = None
         
         # Cached messages
-        self.cached_messages = {}  # { channel_name: [message1, message2, ...] }
+        # Each message keeps the id it got when cached, so the host drops it if it is replayed after all
+        self.cached_messages = {}  # { channel_name: [{"id", "message_content"}, ...] }
+        self.cached_messages_lock = Lock()
         self.cached_messages_file = f"{username}_cached_messages.json"
         self._load_cached_messages()
         print(f"Cached messages loaded: {self.cached_messages}")
 
+    def _exchange(self, tracker, wire, command, payload):
+        with socket.socket() as tracker_socket:
+            tracker_socket.connect(tracker)
+            tracker_socket.sendall(wire.request(command, payload))
+            
+            # The response may be larger than one recv, read a whole frame
+            response = StreamDecoder().read_frame(tracker_socket)
+            if response is None:
+                raise ConnectionError("Tracker closed the connection")
+            return response
+
+    def _tracker_wire(self, tracker):
+        """Return the Wire for a tracker, asking it once which framings and codecs it understands."""
+        wire = self.tracker_wires.get(tracker)
+        if wire is None:
+            try:
+                status, payload = self._exchange(tracker, Wire(Framing.LENGTH), Command.HELLO, handshake_offer())
+                wire = agreed_wire(payload) if status == Status.OK.value else Wire()
+            except ConnectionRefusedError:
+                raise
+            except ConnectionError:
+                # Trackers from before the length-prefixed framing drop the connection on it
+                wire = Wire()
+            self.tracker_wires[tracker] = wire
+        return wire
+
+    def _send_tracked(self, session, command, payload, timeout=REQUEST_TIMEOUT):
+        """
+        Send a request with a new request id on a connection whose peer takes them.
+
+        Args:
+            session (dict): The connection: socket, wire, pending and send_lock.
+        Returns:
+            Future: Completed with the (status, payload) reply, or failed after timeout seconds.
+        """
+        pending = session['pending']
+        request_id, future = pending.register(timeout)
+        try:
+            with session['send_lock']:
+                session['socket'].sendall(session['wire'].request(command, payload, request_id))
+        except Exception as e:
+            pending.discard(request_id, e)
+            raise
+        return future
+
+    def _send_batch(self, session, requests, timeout=REQUEST_TIMEOUT):
+        """
+        Send [(command, payload), ...] as one BATCH frame on a connection whose peer takes request ids.
+
+        Returns:
+            list: The Future of each request's (status, payload) reply, None as
+                  result for requests without a reply (e.g. CACHE).
+        """
+        pending = session['pending']
+        registered = [pending.register(timeout) for _ in requests]
+        request_ids = [request_id for request_id, _ in registered]
+        try:
+            envelope = self._send_tracked(session, Command.BATCH, batch_items(requests, request_ids), timeout)
+        except Exception as e:
+            for request_id in request_ids:
+                pending.discard(request_id, e)
+            raise
+        envelope.add_done_callback(lambda envelope: self._resolve_batch(pending, request_ids, envelope))
+        return [future for _, future in registered]
+
+    def _resolve_batch(self, pending, request_ids, envelope):
+        """Hand each result of a BATCH response to the Future of its request."""
+        error = ValueError("No result for the request in its batch")
+        try:
+            status, results = envelope.result()
+            if status != Status.OK.value:
+                # The whole batch was refused (e.g. overload), every request gets that reply
+                for request_id in request_ids:
+                    pending.resolve(request_id, (status, results))
+            else:
+                for result in results:
+                    if result.get("request_id") is not None:
+                        reply = None if result["status"] is None else (result["status"], result.get("payload"))
+                        pending.resolve(result["request_id"], reply)
+        except Exception as e:
+            error = e
+        for request_id in request_ids:
+            pending.discard(request_id, error)
+
+    def _tracker_session(self, tracker, wire):
+        with self.tracker_sessions_lock:
+            session = self.tracker_sessions.get(tracker)
+            if session is None:
+                session = {
+                    'socket': socket.create_connection(tracker),
+                    'wire': wire,
+                    'decoder': StreamDecoder(),
+                    'pending': PendingResponses(),
+                    'send_lock': Lock(),
+                }
+                self.tracker_sessions[tracker] = session
+                Thread(target=self._listen_tracker, args=(tracker, session), daemon=True).start()
+            return session
+
+    def _listen_tracker(self, tracker, session):
+        """Hand the replies of a tracker session to the requests waiting for them."""
+        tracker_socket = session['socket']
+        decoder = session['decoder']
+        pending = session['pending']
+        tracker_socket.settimeout(1.0)
+        try:
+            while True:
+                try:
+                    frame = decoder.read_frame(tracker_socket)
+                except socket.timeout:
+                    pending.expire()
+                    continue
+                except ValueError as e:
+                    print(f"Error parsing tracker response: {e}")
+                    continue
+                if frame is None:
+                    break
+                if decoder.request_id is not None:
+                    pending.resolve(decoder.request_id, frame)
+                pending.expire()
+        except OSError as e:
+            print(f"Connection to tracker {tracker[0]}:{tracker[1]} lost: {e}")
+        finally:
+            with self.tracker_sessions_lock:
+                if self.tracker_sessions.get(tracker) is session:
+                    del self.tracker_sessions[tracker]
+            tracker_socket.close()
+            pending.fail_all(ConnectionError("Tracker closed the connection"))
+
+    def submit_tracker(self, tracker, command, payload, timeout=REQUEST_TIMEOUT):
+        """
+        Send a request to a tracker (ip, port) without waiting for the reply.
+        Any number of requests may be in flight on the tracker's connection.
+
+        Returns:
+            Future: Completed with the (status, payload) reply, None for trackers without request ids.
+        """
+        wire = self._tracker_wire(tracker)
+        if not wire.request_ids:
+            return None
+        try:
+            return self._send_tracked(self._tracker_session(tracker, wire), command, payload, timeout)
+        except OSError:
+            # The session broke since it was opened (e.g. tracker restart), try once on a new one
+            with self.tracker_sessions_lock:
+                session = self.tracker_sessions.pop(tracker, None)
+            if session is not None:
+                session['socket'].close()
+            return self._send_tracked(self._tracker_session(tracker, wire), command, payload, timeout)
+
+    def submit_tracker_batch(self, tracker, requests, timeout=REQUEST_TIMEOUT):
+        """
+        Send [(command, payload), ...] to a tracker in one BATCH frame, handled in order.
+
+        Returns:
+            list: The Future of each request's (status, payload) reply. Trackers
+                  without request ids get the requests one by one instead.
+        """
+        wire = self._tracker_wire(tracker)
+        if not wire.request_ids:
+            futures = []
+            for command, payload in requests:
+                future = Future()
+                future.set_result(self._exchange(tracker, wire, command, payload))
+                futures.append(future)
+            return futures
+        return self._send_batch(self._tracker_session(tracker, wire), requests, timeout)
+
+    def _request_tracker(self, tracker, command, payload, timeout=REQUEST_TIMEOUT):
+        """Send one request to a tracker (ip, port) and return the parsed (status, payload) response."""
+        future = self.submit_tracker(tracker, command, payload, timeout)
+        if future is None:
+            return self._exchange(tracker, self._tracker_wire(tracker), command, payload)
+        return future.result(timeout)
+
+    def _fan_out(self, command, make_payload):
+        """
+        Send a request to every tracker shard in parallel.
+        
+        Args:
+            command (Command): The command sent to every tracker.
+            make_payload (callable): Builds the payload for a given tracker.
+        Returns:
+            list: [(tracker, status, payload), ...] of the shards that answered.
+        """
+        def ask(tracker):
+            try:
+                return (tracker,) + self._request_tracker(tracker, command, make_payload(tracker))
+            except Exception as e:
+                print(f"Error contacting tracker {tracker[0]}:{tracker[1]}: {e}")
+                return None
+        
+        if len(self.trackers) == 1:
+            results = [ask(self.trackers[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.trackers)) as executor:
+                results = list(executor.map(ask, self.trackers))
+        return [result for result in results if result is not None]
+
     # DONE
     def get_peer_hosts(self):
         """
-        Send a request to the tracker to get the list of available peer hosts.
+        Send a request to the trackers to get the list of available peer hosts.
         Returns a list of dictionaries containing host information.
         """
+        hosts = []
+        for tracker, status, payload in self._fan_out(Command.LIST, lambda tracker: {}):
+            if status == Status.OK.value:
+                hosts.extend(payload)
+            else:
+                print(f"Error from tracker {tracker[0]}:{tracker[1]}: {status}")
+        return hosts
+
+    def refresh_directory(self):
+        """
+        Bring the local channel directory up to date by asking each tracker only
+        for the channels added, updated or removed since the last known version.
+        Returns a list of dictionaries containing host information.
+        """
+        responses = self._fan_out(Command.LIST, lambda tracker: {
+            "since_version": self.directory_versions[tracker]
+        })
+        for tracker, status, payload in responses:
+            if status != Status.OK.value:
+                print(f"Error from tracker {tracker[0]}:{tracker[1]}: {status}")
+            else:
+                self._apply_directory_delta(tracker, payload)
+        
+        return self.get_directory()
+
+    def get_directory(self):
+        """Return the locally known channels without asking the tracker."""
+        with self.directory_lock:
+            return list(self.directory.values())
+
+    def _apply_directory_delta(self, tracker, delta):
+        with self.directory_lock:
+            known = self.shard_channels[tracker]
+            if delta["full"]:
+                for channel_name in known:
+                    self.directory.pop(channel_name, None)
+                known.clear()
+                changed = delta["channels"]
+            else:
+                changed = delta["added"] + delta["updated"]
+                for channel_name in delta["removed"]:
+                    self.directory.pop(channel_name, None)
+                    known.discard(channel_name)
+            for ch in changed:
+                self.directory[ch["channel_name"]] = ch
+                known.add(ch["channel_name"])
+            self.directory_versions[tracker] = delta["version"]
+            self.directory_revision += 1
+        if self.on_directory_change:
+            self.on_directory_change()
+
+    def _apply_directory_event(self, tracker, event):
+        with self.directory_lock:
+            # Already part of the delta received when subscribing
+            if event["version"] <= self.directory_versions[tracker]:
+                return
+            if event["event"] == "removed":
+                self.directory.pop(event["channel_name"], None)
+                self.shard_channels[tracker].discard(event["channel_name"])
+            else:
+                self.directory[event["channel_name"]] = event["channel"]
+                self.shard_channels[tracker].add(event["channel_name"])
+            self.directory_versions[tracker] = event["version"]
+            self.directory_revision += 1
+        if self.on_directory_change:
+            self.on_directory_change()
+
+    def subscribe_directory(self, on_change=None):
+        """
+        Keep the local channel directory live: every tracker pushes each added,
+        updated or removed channel on one open connection, so no polling is needed.
+        
+        Args:
+            on_change: Optional callable invoked (from a subscription thread) after each change.
+        """
+        self.on_directory_change = on_change
+        if self.directory_subscribed:
+            return
+        self.directory_subscribed = True
+        for tracker in self.trackers:
+            Thread(target=self._listen_directory, args=(tracker,), daemon=True).start()
+
+    def unsubscribe_directory(self):
+        self.directory_subscribed = False
+
+    def _listen_directory(self, tracker):
+        """Receive directory events from a tracker, reconnecting and resuming from the last known version."""
+        while self.directory_subscribed:
+            try:
+                wire = self._tracker_wire(tracker)
+                with socket.socket() as tracker_socket:
+                    tracker_socket.connect(tracker)
+                    tracker_socket.sendall(wire.request(Command.SUBSCRIBE, {
+                        "since_version": self.directory_versions[tracker]
+                    }))
+                    tracker_socket.settimeout(1.0)
+                    
+                    decoder = StreamDecoder()
+                    while self.directory_subscribed:
+                        try:
+                            frame = decoder.read_frame(tracker_socket)
+                        except socket.timeout:
+                            continue  # Check if still subscribed
+                        if frame is None:
+                            break
+                        
+                        command, payload = frame
+                        if command == Status.OK.value:
+                            self._apply_directory_delta(tracker, payload)
+                        elif command == Command.EVENT.value:
+                            self._apply_directory_event(tracker, payload)
+            except Exception as e:
+                print(f"Directory subscription to tracker {tracker[0]}:{tracker[1]} lost: {e}")
+            
+            if self.directory_subscribed:
+                time.sleep(2)
+
+    def lookup_channel(self, channel_name):
+        """
+        Ask the tracker owning the channel for it by name.
+        Returns the host information dictionary, or None if the channel is not registered.
+        """
         try:
-            with socket.socket() as tracker_socket:
-                tracker_socket.connect((self.tracker_ip, self.tracker_port))
-                
-                request = create_request(Command.LIST, {})
-                tracker_socket.send(request)
-                
-                response = tracker_socket.recv(4096)
-                status, payload = parse_response(response)
-                
-                if status == Status.OK.value:
-                    return payload
-                else:
-                    print(f"Error from tracker: {status}")
-                    return []
+            tracker = self.tracker_ring.node_for(channel_name)
+            status, payload = self._request_tracker(tracker, Command.LOOKUP, {
+                "channel_name": channel_name
+            })
+            if status == Status.OK.value:
+                return payload
+            print(f"Channel '{channel_name}' not found on tracker")
         except Exception as e:
-            print(f"Error getting peer hosts from tracker: {e}")
-            return []
+            print(f"Error looking up channel '{channel_name}' on tracker: {e}")
+        return None
 
     # DONE
     def connect_to_host(self, target_host):
@@ -64,14 +413,21 @@ class PeerClient:
             new_socket = socket.socket()
             new_socket.connect((host_ip, host_port))
             
-            new_socket.send(create_request(Command.CONNECT, {
-                "username": self.username
+            # After a disconnection, only ask for the messages missed since
+            last_seen_seq = self._last_seen_seq(channel_name)
+            new_socket.send(Wire().request(Command.CONNECT, {
+                "username": self.username,
+                **handshake_offer(),
+                **({"last_seen_seq": last_seen_seq} if last_seen_seq is not None else {}),
             }))
-            response = new_socket.recv(1024)
-            print(response)
-            command, payload = parse_response(response)
-            if command == Status.UNAUTHORIZED.value:
-                print(f"Error connecting to host: {command}")
+            # Frames that arrive together with the response stay buffered for listen_for_messages
+            decoder = StreamDecoder()
+            command, payload = decoder.read_frame(new_socket, 1024)
+            print(command, payload)
+            if command != Status.OK.value:
+                # UNAUTHORIZED, or SERVER_ERROR from a host whose channel is full
+                print(f"Error connecting to host: {command} {payload}")
+                new_socket.close()
                 return False
             else:
                 print(f"Connected to host: {command}")
@@ -80,20 +436,28 @@ class PeerClient:
             self.channels[channel_name] = {
                 'ip': host_ip,
                 'port': host_port,
-                'socket': new_socket
+                'socket': new_socket,
+                # Hosts that do not echo a framing and codec only speak the legacy ones
+                'wire': agreed_wire(payload),
+                'decoder': decoder,
+                # Requests waiting for their reply, for hosts that take request ids
+                'pending': PendingResponses(),
+                'send_lock': Lock(),
             }
-            self.messages[channel_name] = []
+            if last_seen_seq is None or payload.get('history_from') != last_seen_seq + 1:
+                # The host sends its whole log (new channel, older host, or messages it no longer has)
+                with self.messages_lock:
+                    self.messages[channel_name] = self._new_history(channel_name)
             
             # receive initial messages
-            response = new_socket.recv(4096)
-            command, initial_messages = parse_response(response)
+            command, initial_messages = decoder.read_frame(new_socket)
             if command != Command.MESSAGE.value:
                 print(f"Unexpected command received: {command}")
                 return False
+            # The rest of the history follows in more MESSAGE frames, read by listen_for_messages
             for msg in initial_messages:
                 if isinstance(msg, dict) and 'username' in msg and 'message_content' in msg and 'time' in msg:
-                    with self.messages_lock:
-                        self.messages[channel_name].append(msg)
+                    self._add_message(channel_name, msg)
                 else:
                     print(f"Warning: Invalid message format received: {msg}")
             
@@ -110,6 +474,47 @@ class PeerClient:
                 del self.messages[channel_name]
             return False
 
+    def _new_history(self, channel_name, messages=()):
+        retention, archive = self.channel_retention.get(channel_name, (self.retention, self.archive))
+        return MessageRing(retention, archive, messages)
+
+    def set_retention(self, channel_name, retention, archive=None):
+        """Keep the history of one channel by its own retention, applied to what it holds already."""
+        with self.messages_lock:
+            self.channel_retention[channel_name] = (retention, archive)
+            if channel_name in self.messages:
+                self.messages[channel_name] = self._new_history(channel_name, self.messages[channel_name])
+
+    def history_stats(self):
+        """Size of the history kept per channel, and what retention evicted from it."""
+        with self.messages_lock:
+            for messages in self.messages.values():
+                messages.expire()
+            return {channel_name: messages.stats() for channel_name, messages in self.messages.items()}
+
+    def _last_seen_seq(self, channel_name):
+        """Sequence number of the last message received from the channel's host, None if there is none."""
+        with self.messages_lock:
+            for msg in reversed(self.messages.get(channel_name, [])):
+                if 'seq' in msg:
+                    return msg['seq']
+        return None
+
+    def _add_message(self, channel_name, msg):
+        """Keep a message received from the host, False if it was received already."""
+        with self.messages_lock:
+            messages = self.messages.get(channel_name)
+            if messages is None:
+                messages = self.messages[channel_name] = self._new_history(channel_name)
+            if 'seq' in msg:
+                for seen in reversed(messages):
+                    if 'seq' in seen:
+                        if msg['seq'] <= seen['seq']:
+                            return False
+                        break
+            messages.append(msg)
+        return True
+
     def listen_for_messages(self, channel_name):
         """Listen for incoming messages from a specific channel."""
         if channel_name not in self.channels:
@@ -118,60 +523,51 @@ class PeerClient:
         
         channel_info = self.channels[channel_name]
         socket_obj = channel_info['socket']
+        decoder = channel_info['decoder']
+        pending = channel_info['pending']
         host_ip = channel_info['ip']
         host_port = channel_info['port']
         
         if socket_obj:
             socket_obj.settimeout(1.0)
         
-        buffer = ""
         while channel_name in self.channels and socket_obj:
             try:
-                data = socket_obj.recv(1024)
-                if not data:
+                # Parse the next frame, whichever framing the host uses
+                try:
+                    frame = decoder.read_frame(socket_obj, 1024)
+                except ValueError as e:
+                    print(f"Error parsing message data: {e}")
+                    continue
+                if frame is None:
                     break
+                pending.expire()
+                # Replies to tracked requests go to whoever waits for them, broadcasts carry no id
+                if decoder.request_id is not None and pending.resolve(decoder.request_id, frame):
+                    continue
                 
-                buffer += data.decode("utf-8")
-                while '\\' in buffer:
-                    # Split the buffer into individual requests
-                    request, buffer = buffer.split('\\', 1)
-                    
-                    if not request:
-                        continue
-                    
-                    # Parse the request
-                    try:
-                        command, payload = parse_response(request, isSeparated=True)
-                        if command == Command.MESSAGE.value:
-                            messages = payload
-                            for msg in messages:
-                                with self.messages_lock:
-                                    self.messages[channel_name].append(msg)
-                                
-                                RESET = "\033[0m"
-                                TIME_COLOR = "\033[92m"  # Green for time
-                                USER_COLOR = "\033[94m"  # Blue for username
-                                SELF_COLOR = "\033[97m"  # White for self messages
-                                if msg['username'] == self.username:
-                                    print(f"{TIME_COLOR}{msg['time']}{RESET} {SELF_COLOR}[{msg['username']}]{RESET}: {msg['message_content']}")
-                                else:
-                                    print(f"{TIME_COLOR}{msg['time']}{RESET} {USER_COLOR}[{msg['username']}]{RESET}: {msg['message_content']}")
-                            
-                        elif command == Status.UNAUTHORIZED.value:
-                            print(f"Unauthorized access to channel '{channel_name}'")
-                            continue  # Ignore non-message commands
-                    except ValueError:
-                        # Fallback: Try to parse as raw JSON if protocol format fails
-                        try:
-                            message = json.loads(request)
-                            if not isinstance(message, dict) or 'username' not in message or 'message_content' not in message:
-                                print(f"Warning: Invalid message format received: {request}")
-                                continue
-                        except json.JSONDecodeError:
-                            print(f"Error parsing message data: {request}")
+                command, payload = frame
+                if command == Command.MESSAGE.value:
+                    messages = payload
+                    for msg in messages:
+                        if not self._add_message(channel_name, msg):
                             continue
+                        
+                        RESET = "\033[0m"
+                        TIME_COLOR = "\033[92m"  # Green for time
+                        USER_COLOR = "\033[94m"  # Blue for username
+                        SELF_COLOR = "\033[97m"  # White for self messages
+                        if msg['username'] == self.username:
+                            print(f"{TIME_COLOR}{msg['time']}{RESET} {SELF_COLOR}[{msg['username']}]{RESET}: {msg['message_content']}")
+                        else:
+                            print(f"{TIME_COLOR}{msg['time']}{RESET} {USER_COLOR}[{msg['username']}]{RESET}: {msg['message_content']}")
+                    
+                elif command == Status.UNAUTHORIZED.value:
+                    print(f"Unauthorized access to channel '{channel_name}'")
+                    continue  # Ignore non-message commands
                 
             except socket.timeout:
+                pending.expire()
                 continue  # Timeout occurred, check if channel still exists
             except socket.error as e:
                 if channel_name in self.channels:
@@ -182,6 +578,7 @@ class PeerClient:
                 break
         
         # Cleanup on disconnection
+        pending.fail_all(ConnectionError(f"Disconnected from channel '{channel_name}'"))
         if channel_name in self.channels:
             if self.channels[channel_name]['socket']:
                 self.channels[channel_name]['socket'].close()
@@ -207,19 +604,31 @@ class PeerClient:
                     self._cache_message(content, None)
             return True
         
-        # Prepare message request
+        # Prepare message request, its id lets the host drop copies of it (e.g. resent from the cache)
+        message_id = new_message_id()
         payload = {
             "username": self.username,
             "message_content": content,
+            "id": message_id,
         }
-        request = create_request(Command.MESSAGE, payload)
         success = False
         
         target_channels = [channel_name] if channel_name else list(self.channels.keys())
         for ch_name in target_channels:
             if ch_name in self.channels:
                 try:
-                    self.channels[ch_name]['socket'].send(request)
+                    cached = self._cached_payload(ch_name) if self.channels[ch_name]['wire'].request_ids else []
+                    if cached:
+                        # Flush the messages cached for the channel together with this one, in one frame.
+                        # They stay cached until the host answered, resending them is harmless
+                        _, reply = self.send_batch(ch_name, [(Command.CACHE, cached), (Command.MESSAGE, payload)])
+                        reply.add_done_callback(
+                            lambda reply, ch_name=ch_name, ids={msg["id"] for msg in cached}:
+                            self._cached_delivered(ch_name, ids, reply))
+                    else:
+                        reply = self.request_host(ch_name, Command.MESSAGE, payload)
+                    if reply is not None:
+                        reply.add_done_callback(lambda reply, ch_name=ch_name: self._report_reply(ch_name, "Message", reply))
                     with self.messages_lock:
                         self.messages[ch_name].append(payload)
                     success = True
@@ -229,49 +638,119 @@ class PeerClient:
                     if ch_name in self.channels:
                         self.channels[ch_name]['socket'].close()
                         self.channels.pop(ch_name, None)
-                    # Cache the message for this specific channel
-                    self._cache_message(content, ch_name)
+                    # Cache the message for this specific channel, with its id in case the host got it anyway
+                    self._cache_message(content, ch_name, message_id)
         
         if not success and not channel_name:
             print("Failed to send message to any channel. Caching message for all known channels.")
             if self.channels:
                 for ch_name in self.channels.keys():
-                    self._cache_message(content, ch_name)
+                    self._cache_message(content, ch_name, message_id)
             else:
                 # No specific channel, cache as general message
                 self._cache_message(content, None)
         return True
     
+    def request_host(self, channel_name, command, payload, timeout=REQUEST_TIMEOUT):
+        """
+        Send a request to the host of a connected channel. Any number of
+        requests may be in flight; each reply is matched by its request id.
+
+        Returns:
+            Future: Completed with the (status, payload) reply, or None for hosts
+                    without request ids, whose replies can not be told apart.
+        """
+        channel = self.channels[channel_name]
+        if channel['wire'].request_ids:
+            return self._send_tracked(channel, command, payload, timeout)
+        with channel['send_lock']:
+            channel['socket'].sendall(channel['wire'].request(command, payload))
+        return None
+
+    def send_batch(self, channel_name, requests, timeout=REQUEST_TIMEOUT):
+        """
+        Send [(command, payload), ...] to the host of a connected channel in one
+        BATCH frame; the host handles them in order and answers them together.
+
+        Returns:
+            list: The Future of each request's reply, as for request_host. Hosts
+                  without request ids get the requests one by one instead.
+        """
+        channel = self.channels[channel_name]
+        if channel['wire'].request_ids:
+            return self._send_batch(channel, requests, timeout)
+        return [self.request_host(channel_name, command, payload, timeout) for command, payload in requests]
+
+    def _report_reply(self, channel_name, action, reply, show=False):
+        try:
+            status, payload = reply.result()
+            if show and status == Status.OK.value:
+                print(f"{action} reply from channel '{channel_name}': {payload}")
+            elif status != Status.OK.value:
+                print(f"{action} rejected by channel '{channel_name}': {status} {payload}")
+        except Exception as e:
+            print(f"{action} to channel '{channel_name}' got no reply: {e}")
+
     def change_view(self, channel_name, view):
-        """Change the view of messages for a specific channel."""
+        """
+        Change the view of messages for a specific channel.
+        Returns the Future of the host's reply, None if there is none to wait for.
+        """
         if channel_name not in self.channels:
             print(f"Not connected to channel '{channel_name}'")
-            return
+            return None
         
-        request = create_request(Command.VIEW, {
-            "username": self.username,
-            "permission": view,
-        })
         try:
-            self.channels[channel_name]['socket'].send(request)
+            reply = self.request_host(channel_name, Command.VIEW, {
+                "username": self.username,
+                "permission": view,
+            })
+            if reply is not None:
+                reply.add_done_callback(lambda reply: self._report_reply(channel_name, "View change", reply))
             print(f"View changed to {view} for channel '{channel_name}'")
+            return reply
         except Exception as e:
             print(f"Error changing view for channel '{channel_name}': {e}")
+            return None
     
     def debug(self, channel_name):
-        """Send a debug command to a specific channel."""
+        """
+        Send a debug command to a specific channel.
+        Returns the Future of the host's debug information, None if there is none to wait for.
+        """
         if channel_name not in self.channels:
             print(f"Not connected to channel '{channel_name}'")
-            return
+            return None
         
-        request = create_request(Command.DEBUG, {})
         try:
-            self.channels[channel_name]['socket'].send(request)            
+            reply = self.request_host(channel_name, Command.DEBUG, {})
+            if reply is not None:
+                reply.add_done_callback(lambda reply: self._report_reply(channel_name, "Debug command", reply, show=True))
             print(f"Debug command sent to channel '{channel_name}'")
+            return reply
         except Exception as e:
             print(f"Error sending debug command to channel '{channel_name}': {e}")
+            return None
         
 
+    def search(self, channel_name, query="", username=None, since=None, until=None, sort="newest", offset=0, limit=20):
+        """
+        Search the history of a connected channel on its host.
+        Returns the Future of the (status, payload) reply, None if there is none to wait for.
+        """
+        if channel_name not in self.channels:
+            print(f"Not connected to channel '{channel_name}'")
+            return None
+        payload = {"query": query, "sort": sort, "offset": offset, "limit": limit}
+        for key, value in (("username", username), ("since", since), ("until", until)):
+            if value is not None:
+                payload[key] = value
+        try:
+            return self.request_host(channel_name, Command.SEARCH, payload)
+        except Exception as e:
+            print(f"Error searching channel '{channel_name}': {e}")
+            return None
+
     def disconnect(self, channel_name=None):
         """Disconnect from a specific channel or all channels if channel_name is None."""
         target_channels = [channel_name] if channel_name else list(self.channels.keys())
@@ -296,33 +775,41 @@ class PeerClient:
                 for channel_name, messages in channel_name_with_cached_messages.items():
                     if channel_name not in self.cached_messages:
                         self.cached_messages[channel_name] = []
-                    self.cached_messages[channel_name].extend(messages)
+                    # Files written before message ids hold the bare contents
+                    self.cached_messages[channel_name].extend(
+                        {"id": new_message_id(), "message_content": msg} if isinstance(msg, str) else msg
+                        for msg in messages)
         except FileNotFoundError:
             self.cached_messages = {}
         except Exception as e:
             print(f"Error loading cached messages: {e}")
             self.cached_messages = {}
             
-    def _cache_message(self, message_content, channel_name):
+    def _cache_message(self, message_content, channel_name, message_id=None):
         """
         Cache a message to be sent later when connection is available.
         
         Args:
             message_content: The message content to cache
             channel_name: The name of the channel
+            message_id: The id the message was already sent with, if any
         """
-        # Initialize list for this channel if it doesn't exist
-        if channel_name not in self.cached_messages:
-            self.cached_messages[channel_name] = []
-        
-        # Add the message to the channel's list
-        self.cached_messages[channel_name].append(message_content)
-        
-        try:
-            with open(self.cached_messages_file, 'w') as f:
-                json.dump(self.cached_messages, f, indent=4)
-        except Exception as e:
-            print(f"Error caching message: {e}")
+        with self.cached_messages_lock:
+            # Initialize list for this channel if it doesn't exist
+            if channel_name not in self.cached_messages:
+                self.cached_messages[channel_name] = []
+            
+            # Add the message to the channel's list
+            self.cached_messages[channel_name].append({
+                "id": message_id or new_message_id(),
+                "message_content": message_content,
+            })
+            
+            try:
+                with open(self.cached_messages_file, 'w') as f:
+                    json.dump(self.cached_messages, f, indent=4)
+            except Exception as e:
+                print(f"Error caching message: {e}")
     
     # DONE
     def _send_cached_messages(self, channel_name):
@@ -332,28 +819,56 @@ class PeerClient:
         Args:
             channel_name: The name of the channel to send cached messages to
         """
-        if not self.cached_messages:
-            return
-        
-        # Check if we have any messages for this channel
-        messages_to_send = self.cached_messages.get(channel_name, [])
+        payload = self._cached_payload(channel_name)
         
-        if messages_to_send:
-            print(f"Sending {len(messages_to_send)} cached messages to channel '{channel_name}'...")
-
-            # Prepare the payload for sending multiple messages at once
-            payload = [{
-                "username": self.username,
-                "message_content": msg,
-            } for msg in messages_to_send]
+        if payload:
+            print(f"Sending {len(payload)} cached messages to channel '{channel_name}'...")
                 
-            request = create_request(Command.CACHE, payload)
-            self.channels[channel_name]['socket'].send(request)
+            if self.channels[channel_name]['wire'].request_ids:
+                # CACHE has no response of its own, the BATCH around it tells when the host handled it.
+                # Until then the messages stay cached, the host drops the ids it has if they are resent
+                [reply] = self.send_batch(channel_name, [(Command.CACHE, payload)])
+                reply.add_done_callback(lambda reply: self._cached_delivered(
+                    channel_name, {msg["id"] for msg in payload}, reply))
+                return
+            
+            channel = self.channels[channel_name]
+            with channel['send_lock']:
+                channel['socket'].sendall(channel['wire'].request(Command.CACHE, payload))
             # No response needed for cache command
             
-            # Save updated cache to file
+            self._clear_cached_messages(channel_name)
+
+    def _cached_payload(self, channel_name):
+        """The CACHE payload of the messages cached for a channel, empty if there are none."""
+        with self.cached_messages_lock:
+            return [{
+                "username": self.username,
+                "message_content": msg["message_content"],
+                "id": msg["id"],
+            } for msg in self.cached_messages.get(channel_name, [])]
+
+    def _cached_delivered(self, channel_name, ids, reply):
+        """Forget the cached messages sent with a request once the host accepted it."""
+        try:
+            result = reply.result()
+        except Exception as e:
+            print(f"Cached messages for channel '{channel_name}' kept, no reply from the host: {e}")
+            return
+        if result is None or result[0] == Status.OK.value:
+            self._clear_cached_messages(channel_name, ids)
+
+    def _clear_cached_messages(self, channel_name, ids=None):
+        """Forget the cached messages of a channel once they are sent, only those with the given ids if any."""
+        # Save updated cache to file
+        with self.cached_messages_lock:
             try:
-                del self.cached_messages[channel_name]  # Remove sent messages from cache
+                # Remove sent messages from cache, keeping those cached since
+                kept = [msg for msg in self.cached_messages.get(channel_name, []) if ids is not None and msg["id"] not in ids]
+                if kept:
+                    self.cached_messages[channel_name] = kept
+                else:
+                    self.cached_messages.pop(channel_name, None)
                 # Save the updated cached messages to file
                 with open(self.cached_messages_file, 'w') as f:
                     json.dump(self.cached_messages, f, indent=2)
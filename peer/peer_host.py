@@ -1,27 +1,219 @@
+import asyncio
+import os
 import socket
-from threading import Thread, Lock
-import json
+from threading import Thread, Lock, Event
 import queue
 import time
 from datetime import datetime
-from utils.protocol import create_request, parse_request, Command, parse_response, Status, create_response
+from utils.protocol import Command, Status, Framing, Wire, StreamDecoder, SharedFrame, handshake_offer, accept_offer, \
+    agreed_wire, compression_stats, BATCH_WIRE, batch_reply
+from utils.hash_ring import HashRing
+from utils.outbox import Outbox, OUTBOUND_QUEUE_SIZE
+from utils.message_log import MessageLog
+from utils.history import MessageRing, Retention
+from utils.search import SearchIndex, MAX_SEARCH_RESULTS
+from utils.dedup import DedupWindow
+
+# Peers a host serves at once unless given max_connections: a thread per peer
+# in threaded mode, one event loop for all of them in async mode
+MAX_CONNECTIONS = {"threaded": 10, "async": 10000}
+
+# Messages sent to the peers in one MESSAGE frame
+MAX_BROADCAST_BATCH = 50
+
+# Seconds to wait for the tracker's answer before the session is treated as broken, so a tracker
+# that never answers (e.g. one ignoring HEARTBEAT) can not hold tracker_lock forever
+TRACKER_TIMEOUT = 10
+
+# Seconds a peer turned away from a full channel in threaded mode has to send its CONNECT to be answered
+TURN_AWAY_TIMEOUT = 5
+# Peers turned away at once in threaded mode, a thread each; past that they are closed without an answer
+MAX_TURNING_AWAY = 16
+
+# Initial receive buffer of a peer session, most peers only send small frames
+SESSION_BUFFER_SIZE = 512
+
+# Latest messages kept in memory when the history is on disk (data_dir), older pages are read from the log
+MEMORY_TAIL = 10000
+
+# Seconds between two passes evicting the messages retention no longer keeps, for idle channels
+RETENTION_SWEEP_INTERVAL = 10
+
+class BroadcastStats:
+    """Cost of fanning each broadcast batch out to the connected peers."""
+    def __init__(self):
+        self.lock = Lock()
+        self.batches = 0
+        self.messages = 0
+        self.deliveries = 0  # Frames handed to peers, one per peer per batch
+        self.encodes = 0  # Frames encoded, one per framing and codec in use per batch
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, messages, peers, encodes, seconds):
+        with self.lock:
+            self.batches += 1
+            self.messages += messages
+            self.deliveries += peers
+            self.encodes += encodes
+            self.seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self.last_seconds = seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "messages": self.messages,
+                "deliveries": self.deliveries,
+                "encodes": self.encodes,
+                "fanout_avg_ms": round(self.seconds / self.batches * 1000, 3) if self.batches else None,
+                "fanout_max_ms": round(self.max_seconds * 1000, 3),
+                "fanout_last_ms": round(self.last_seconds * 1000, 3),
+            }
+
+class PeerConnection:
+    """
+    One connected peer in threaded mode. Everything sent to the peer
+    (responses, history, broadcasts) goes through its bounded Outbox and is
+    written by the peer's own writer thread with sendall, so frames sent from
+    different threads never interleave and a peer slow to read only holds up
+    its own queue.
+    """
+    def __init__(self, conn, addr, limit, policy, catch_up):
+        self.conn = conn
+        self.addr = addr
+        self.wire = None  # Agreed in the peer's CONNECT
+        self.ready = Event()
+        self.outbox = Outbox(limit, policy, lambda start, end: catch_up(self.wire, start, end), self.ready.set)
+        Thread(target=self._write, daemon=True).start()
+
+    def send(self, data, span=None):
+        if not self.outbox.put(data, span):
+            print(f"Peer {self.addr} is too slow, disconnecting it")
+            self.abort()
+
+    def close(self):
+        """Close the connection once the frames queued before are sent."""
+        self.outbox.close()
+
+    def abort(self):
+        """Close the connection now, dropping what is queued."""
+        self.outbox.close()
+        try:
+            # Wakes up the threads reading from and writing to the peer
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write(self):
+        while True:
+            self.ready.clear()
+            data = self.outbox.pop()
+            if data is None:
+                if self.outbox.done():
+                    break
+                self.ready.wait()
+                continue
+            try:
+                self.conn.sendall(data)
+            except OSError as e:
+                print(f"Connection with peer {self.addr} lost: {e}")
+                break
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+class PeerSession:
+    """
+    One connected peer in async mode: what a peer's threads keep on their
+    stack in threaded mode. Frames go through the peer's bounded Outbox and
+    are written by a writer task that waits for the transport to drain, so a
+    peer slow to read never blocks the loop or the other peers.
+    """
+    def __init__(self, loop, writer, addr, limit, policy, catch_up):
+        self.loop = loop
+        self.writer = writer
+        self.addr = addr
+        self.wire = None  # Agreed in the peer's CONNECT
+        self.decoder = StreamDecoder(size=SESSION_BUFFER_SIZE)
+        self.task = asyncio.current_task(loop)  # Serving the session
+        self.ready = asyncio.Event()
+        self.outbox = Outbox(limit, policy, lambda start, end: catch_up(self.wire, start, end), self.ready.set)
+        self.writer_task = loop.create_task(self._write())
+
+    def send(self, data, span=None):
+        """Queue data for the peer; only called on the loop."""
+        if not self.outbox.put(data, span):
+            print(f"Peer {self.addr} is too slow, disconnecting it")
+            self.abort()
+
+    def close(self):
+        """Close the connection once the frames queued before are sent, from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self.outbox.close)
+        except RuntimeError:
+            pass  # The loop is closed, and the connection with it
+
+    def abort(self):
+        self.outbox.close()
+        self.writer.transport.abort()
+
+    async def _write(self):
+        try:
+            while True:
+                self.ready.clear()
+                data = self.outbox.pop()
+                if data is None:
+                    if self.outbox.done():
+                        break
+                    await self.ready.wait()
+                    continue
+                self.writer.write(data)
+                await self.writer.drain()
+        except (OSError, RuntimeError) as e:
+            print(f"Connection with peer {self.addr} lost: {e}")
+        finally:
+            self.writer.close()
 
 class PeerHost:
-    def __init__(self, channel_name, owner_peer, ip, port, tracker_ip, tracker_port, max_connections=10):
+    def __init__(self, channel_name, owner_peer, ip, port, tracker_ip, tracker_port, max_connections=None, lease_ttl=30,
+                 tracker_shards=None, mode="threaded", outbound_queue_size=OUTBOUND_QUEUE_SIZE,
+                 overflow_policy="resync", data_dir=None, memory_tail=MEMORY_TAIL,
+                 retention=None, archive=None, search=False):
         # Tracker information
         self.tracker_ip = tracker_ip
         self.tracker_port = tracker_port
+        if tracker_shards:
+            # Register on the shard that owns the channel name, as clients look it up there
+            self.tracker_ip, self.tracker_port = HashRing(tracker_shards).node_for(channel_name)
+        
+        # Tracker session, kept open to renew the channel lease with heartbeats
+        self.tracker_socket = None
+        self.tracker_decoder = None
+        self.tracker_wire = Wire()  # Framing and codec agreed with the tracker in a HELLO
+        self.tracker_lock = Lock()
+        self.lease_ttl = lease_ttl
         
         # Channel information
         self.owner_peer = owner_peer
         self.channel_name = channel_name
         self.ip = ip
         self.port = port
-        self.max_connections = max_connections
+        # threaded: a thread per peer, async: all peers served by one event loop
+        self.mode = mode
+        self.max_connections = max_connections or MAX_CONNECTIONS[mode]
         
         # Connected peers information
-        self.connected_peers = []
+        self.connected_peers = {}  # {addr: PeerConnection in threaded mode, PeerSession in async mode}
+        # Frames each peer may have queued, and what happens past that (utils/outbox.py)
+        self.outbound_queue_size = outbound_queue_size
+        self.overflow_policy = overflow_policy
         self.peer_lock = Lock()
+        self.turning_away = 0  # Threads answering peers over max_connections
         
         # Authentication information
         self.authen_peers = {}
@@ -38,14 +230,45 @@ class PeerHost:
         # Viewers permission
         self.view_permission = True
         
-        # Messages information
-        self.messages = [
-            {"username": "System", "message_content": "Welcome to the channel!", "time": datetime.now().strftime("%H:%M:%S")},
-            {"username": "Dien", "message_content": "Hello everyone!", "time": datetime.now().strftime("%H:%M:%S")},
-            {"username": "Hieu", "message_content": "Hi Dien!", "time": datetime.now().strftime("%H:%M:%S")}
-        ]
+        # Messages information, each stamped with its sequence number ("seq") and epoch milliseconds ("ts")
+        self.next_seq = 1
         self.messages_lock = Lock()
         self.message_queue = queue.Queue()
+        self.broadcast_stats = BroadcastStats()
+        # Inverted index of the history for SEARCH (utils/search.py), updated as messages are appended.
+        # Opt-in: it takes about 115 bytes of memory per message, and with a data_dir the whole log is
+        # read back to rebuild it on startup (about 26 s per million messages)
+        self.search_index = SearchIndex() if search else None
+        # How much history the channel keeps (utils/history.py), messages past it are handed to archive or dropped
+        self.retention = retention or Retention()
+        self.archive = archive
+        # With a data_dir the history is kept in a log on disk (utils/message_log.py) and survives restarts
+        self.log = None
+        if data_dir:
+            self.log = MessageLog(os.path.join(data_dir, channel_name))
+            self.next_seq = self.log.open()
+            # Only the latest messages stay in memory, the retention applies to the log
+            self.messages = MessageRing(Retention(max_messages=memory_tail),
+                                        messages=self.log.read(self.next_seq - memory_tail, self.next_seq))
+            if self.search_index is not None:
+                for start in range(self.log.first_seq, self.next_seq, 10000):
+                    for message in self.log.read(start, start + 10000):
+                        self.search_index.add(message)
+            print(f"Recovered {self.next_seq - self.log.first_seq} messages of {channel_name} from {data_dir}")
+        else:
+            self.messages = MessageRing(self.retention, archive)
+        self.last_ts = self.messages[-1]['ts'] if self.messages else 0
+        # Ids of the messages received recently (utils/dedup.py), a replayed message is appended once
+        self.dedup = DedupWindow()
+        recent = self.messages
+        if self.log is not None:
+            recent = self.log.read(self.next_seq - self.dedup.size, self.next_seq)
+        for message in recent:
+            if isinstance(message.get('id'), str):
+                self.dedup.add(message['id'], message['ts'] / 1000)
+        if self.next_seq == 1:
+            for username, content in [("System", "Welcome to the channel!"), ("Dien", "Hello everyone!"), ("Hieu", "Hi Dien!")]:
+                self._append_message({"username": username, "message_content": content}, broadcast=False)
         
         # Running manager
         self.socket_server = socket.socket()
@@ -53,8 +276,17 @@ class PeerHost:
         
         # Flag to control threads
         self.running = True
+        
+        # Async mode: the loop serving the peers, set once it runs
+        self.loop = None
+        self.sessions = set()
+        self.stopped = None
+        self.broadcast_wakeup = None
 
     def listen(self):
+        if self.mode == "async":
+            self.listen_async()
+            return
         try: 
             status = self.host_submission()
             if status != "OK":
@@ -66,13 +298,21 @@ class PeerHost:
             
             # Start the broadcast thread
             Thread(target=self.broadcast_messages, daemon=True).start()
+            # Keep the channel registered on the tracker
+            Thread(target=self.renew_lease, daemon=True).start()
+            # Apply the retention to idle channels too
+            Thread(target=self.retention_sweep, daemon=True).start()
             
             while self.running:
                 conn, addr = self.socket_server.accept()
                 with self.peer_lock:
                     if len(self.connected_peers) < self.max_connections:
-                        self.connected_peers.append((conn, addr))
-                        Thread(target=self.handle_peer_connection, args=(conn, addr), daemon=True).start()
+                        peer = self.connected_peers[addr] = PeerConnection(
+                            conn, addr, self.outbound_queue_size, self.overflow_policy, self.catch_up)
+                        Thread(target=self.handle_peer_connection, args=(peer,), daemon=True).start()
+                    elif self.turning_away < MAX_TURNING_AWAY:
+                        self.turning_away += 1
+                        Thread(target=self.turn_away, args=(conn, addr), daemon=True).start()
                     else:
                         conn.close()
         except Exception as e:
@@ -81,132 +321,499 @@ class PeerHost:
         finally:
             self.socket_server.close()
 
+    def _tracker_exchange(self, wire, command, payload):
+        self.tracker_socket.sendall(wire.request(command, payload))
+        response = self.tracker_decoder.read_frame(self.tracker_socket)
+        if response is None:
+            raise ConnectionError("Tracker closed the session")
+        return response
+
+    def _open_tracker_session(self):
+        self.tracker_socket = socket.create_connection((self.tracker_ip, self.tracker_port), TRACKER_TIMEOUT)
+        self.tracker_decoder = StreamDecoder()
+
+    def _tracker_request(self, command, payload):
+        """Send a request on the persistent tracker session and return the parsed (status, payload) response."""
+        with self.tracker_lock:
+            try:
+                if self.tracker_socket is None:
+                    self._open_tracker_session()
+                    try:
+                        status, hello = self._tracker_exchange(Wire(Framing.LENGTH), Command.HELLO, handshake_offer())
+                        self.tracker_wire = agreed_wire(hello) if status == Status.OK.value else Wire()
+                    except (ConnectionError, socket.timeout):
+                        # Trackers from before the length-prefixed framing drop the connection on it, or ignore it
+                        self.tracker_socket.close()
+                        self._open_tracker_session()
+                        self.tracker_wire = Wire()
+                return self._tracker_exchange(self.tracker_wire, command, payload)
+            except OSError:
+                # Reopen the session on the next request
+                if self.tracker_socket is not None:
+                    self.tracker_socket.close()
+                self.tracker_socket = None
+                raise
+
+    def _channel_info(self):
+        return {
+            "channel_name": self.channel_name,
+            "peer_server_ip": self.ip,
+            "peer_server_port": self.port
+        }
+
     # DONE
-    def host_submission(self):                
-        with socket.socket() as tracker_socket:
-            tracker_socket.connect((self.tracker_ip, self.tracker_port))
-            
-            request = create_request(Command.HOST, {
-                "channel_name": self.channel_name,
-                "peer_server_ip": self.ip,
-                "peer_server_port": self.port
-            })
-            tracker_socket.send(request)
-            response = tracker_socket.recv(1024)
-            status, payload = parse_response(response)
-            
-            if status != Status.OK.value:
-                print(f"Failed to submit info to tracker: {payload['status']}")
-                return payload['status']
-            
-            tracker_socket.close()
+    def host_submission(self):
+        status, payload = self._tracker_request(Command.HOST, {**self._channel_info(), "ttl": self.lease_ttl})
+        
+        if status != Status.OK.value:
+            # Error replies (e.g. REQUEST_ERROR) carry a message rather than a status
+            print(f"Failed to submit info to tracker: {payload.get('status', payload.get('message'))}")
+            return status
         
         return status
-    
-    def handle_peer_connection(self, conn, addr):
-        identity = conn.recv(1024)
-        command, payload = parse_request(identity)
+
+    def renew_lease(self):
+        """Send a heartbeat a few times per lease so the tracker keeps the channel listed."""
+        while self.running:
+            time.sleep(self.lease_ttl / 3)
+            if not self.running:
+                break
+            try:
+                status, payload = self._tracker_request(Command.HEARTBEAT, {
+                    "channel_name": [self.channel_name]
+                })
+                if status == Status.OK.value and payload["unknown"] and self.running:
+                    # The lease ran out (e.g. tracker restart), register the channel again
+                    print("Channel lease lost on tracker, hosting again.")
+                    self.host_submission()
+            except Exception as e:
+                print(f"Error renewing channel lease: {e}")
+
+    def retention_sweep(self):
+        """Evict the messages that aged out of the retention, and the log segments it no longer keeps."""
+        while self.running:
+            time.sleep(RETENTION_SWEEP_INTERVAL)
+            if not self.running:
+                break
+            try:
+                self.enforce_retention()
+            except Exception as e:
+                print(f"Error applying retention: {e}")
+
+    def enforce_retention(self):
+        with self.messages_lock:
+            self.messages.expire()
+        if self.log is not None and self.retention:
+            deleted = self.log.retain(self.retention, self.archive)
+            if deleted:
+                print(f"Retention removed {deleted} messages of {self.channel_name} from the log")
+        if self.search_index is not None:
+            self.search_index.forget_before(self._first_seq())
+
+    def accept_peer(self, addr, payload):
+        """
+        Answer a peer's CONNECT.
+
+        Returns:
+            Wire: The framing and codec agreed with the peer.
+            bytes: The response to send.
+            int: First sequence number of the history to send the peer, None if it is turned away
+                (the connection is closed after the response).
+        """
+        # Peers offering the length-prefixed framing and a compact codec in CONNECT get them,
+        # older peers the legacy framing with JSON
+        if not isinstance(payload, dict) or not isinstance(payload.get('username'), str):
+            wire = accept_offer(payload) if isinstance(payload, dict) else Wire()
+            return wire, wire.response(Status.REQUEST_ERROR, {"message": "CONNECT needs a username"}), None
+        wire = accept_offer(payload)
         if not self.view_permission:
             # Check if the peer is authenticated
             if not self._is_authenticated(payload['username']):
                 print(f"Peer {payload['username']} is not authenticated.")
-                conn.send(create_response(Status.UNAUTHORIZED, {}))
                 print(f"Sending UNAUTHORIZED response to {addr}")
-                conn.close()
-                return
+                return wire, wire.response(Status.UNAUTHORIZED, {}), None
             
+        print(f"Peer {payload['username']} authenticated successfully.")
+        # Peers reconnecting with the last sequence number they saw only get what they missed
+        history_from = self._history_start(payload.get('last_seen_seq'))
         # Send authentication response
-        conn.send(create_response(Status.OK, {
+        return wire, wire.response(Status.OK, {
             "status": "success",
-            "message": "Authenticated successfully"
-        }))
-        print(f"Peer {payload['username']} authenticated successfully.")
-        # Send initial messages to the new peer
+            "message": "Authenticated successfully",
+            "history_from": history_from,
+            **wire.agreement(),
+        }), history_from
+
+    def _append_message(self, message, broadcast=True):
+        """
+        Stamp a message with the next sequence number and add it to the log (and the broadcast queue).
+
+        Returns:
+            bool: False if the message has an "id" the channel received already, it is not appended again.
+        """
+        now = time.time()
         with self.messages_lock:
-            request = create_request(Command.MESSAGE, self.messages)
-            conn.send(request)
+            # Checked under messages_lock, so two copies arriving at once are not both appended
+            message_id = message.get('id')
+            if isinstance(message_id, str) and not self.dedup.add(message_id, now):
+                return False
+            message['seq'] = self.next_seq
+            # Never earlier than the previous message even if the clock steps back, SEARCH bisects timestamps
+            message['ts'] = self.last_ts = max(int(now * 1000), self.last_ts)
+            message['time'] = datetime.fromtimestamp(now).strftime("%H:%M:%S")
+            self.next_seq += 1
+            self.messages.append(message)
+            if self.log is not None:
+                self.log.append(message)
+            if self.search_index is not None:
+                self.search_index.add(message)
+            if broadcast:
+                # Queued in log order, so each broadcast batch is a span of sequence numbers
+                self.message_queue.put(message)
+        return True
+
+    def _first_seq(self):
+        if self.log is not None:
+            return self.log.first_seq
+        return self.messages[0]['seq'] if self.messages else self.next_seq
+
+    def _history_start(self, last_seen_seq):
+        """First sequence number to send a peer that saw up to last_seen_seq: all it missed, else the whole log."""
+        with self.messages_lock:
+            first = self._first_seq()
+            if isinstance(last_seen_seq, int) and first - 1 <= last_seen_seq < self.next_seq:
+                return last_seen_seq + 1
+            return first
+
+    def join(self, peer, wire, history_from):
+        """
+        Add a peer that passed its CONNECT to the broadcasts and send it the
+        messages from history_from on, in pages. Done under messages_lock so
+        no message is appended between its history and its first broadcast.
+        """
+        with self.messages_lock, self.peer_lock:
+            peer.wire = wire
+            self.connected_peers[peer.addr] = peer
+            end = self.next_seq
+            history_from = max(history_from, self._first_seq())
+            if history_from >= end:
+                # Nothing missed, the peer still gets the MESSAGE frame it waits for
+                peer.send(wire.request(Command.MESSAGE, []))
+            peer.outbox.resend(history_from, end)
+
+    def catch_up(self, wire, start, end):
+        """The MESSAGE frame of the messages with sequence numbers [start, end), for a peer's history or resync."""
+        with self.messages_lock:
+            first = self.messages[0]['seq'] if self.messages else self.next_seq
+            messages = self.messages[max(start - first, 0):max(end - first, 0)]
+        if self.log is not None and start < first:
+            # Older than the memory tail: read the page from disk, outside messages_lock
+            messages = self.log.read(start, min(end, first)) + messages
+        return wire.request(Command.MESSAGE, messages)
+
+    def _messages_by_seq(self, seqs):
+        """The messages with the given sequence numbers, in that order, from memory or else from the log."""
+        found = {}
+        with self.messages_lock:
+            first = self.messages[0]['seq'] if self.messages else self.next_seq
+            for seq in seqs:
+                if first <= seq < self.next_seq:
+                    found[seq] = self.messages[seq - first]
+        if self.log is not None:
+            for seq in seqs:
+                if seq not in found:
+                    found.update((message['seq'], message) for message in self.log.read(seq, seq + 1))
+        return [found[seq] for seq in seqs if seq in found]
+
+    def search(self, payload):
+        """
+        Answer a SEARCH from the index: the messages holding every term of
+        "query", optionally only those of "username" and sent from "since"
+        until "until" (epoch milliseconds), sorted by "newest" or
+        "relevance", "limit" at a time from "offset".
+
+        Returns:
+            tuple: (Status, response payload)
+        """
+        if self.search_index is None:
+            return Status.REQUEST_ERROR, {"message": "Search is disabled on this channel"}
+        try:
+            offset = int(payload.get('offset', 0))
+            limit = min(int(payload.get('limit', 20)), MAX_SEARCH_RESULTS)
+            total, seqs = self.search_index.search(
+                payload.get('query', ""), payload.get('username'), payload.get('since'), payload.get('until'),
+                payload.get('sort', "newest"), offset, limit)
+        except (AttributeError, TypeError, ValueError) as e:
+            return Status.REQUEST_ERROR, {"message": f"Invalid search: {e}"}
+        return Status.OK, {
+            "total": total,
+            "offset": offset,
+            "results": self._messages_by_seq(seqs),
+            "next_offset": offset + limit if offset + limit < total else None,
+        }
+
+    def respond(self, addr, wire, request_id, command, payload):
+        """The response to one frame of a connected peer, None if it has none."""
+        # Replies carry the id of their request, if it has one
+        reply = wire.answering(request_id)
+        if command == Command.BATCH.value:
+            # Sub-requests are handled in order and answered in one response
+            return reply.response(Status.OK, [
+                batch_reply(item, lambda command, payload: self.handle_peer_request(addr, command, payload, BATCH_WIRE))
+                for item in payload
+            ])
+        return self.handle_peer_request(addr, command, payload, reply)
+
+    def turn_away(self, conn, addr):
+        """Answer the CONNECT of a peer over max_connections with SERVER_ERROR, as async mode does, and close."""
+        try:
+            conn.settimeout(TURN_AWAY_TIMEOUT)
+            frame = StreamDecoder().read_frame(conn, 1024)
+            if frame is not None:
+                conn.sendall(accept_offer(frame[1]).response(Status.SERVER_ERROR, {"message": "Channel is full"}))
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Could not turn away peer {addr}: {e}")
+        finally:
+            conn.close()
+            with self.peer_lock:
+                self.turning_away -= 1
+
+    def handle_peer_connection(self, peer):
+        conn, addr = peer.conn, peer.addr
+        decoder = StreamDecoder()
+        history_from = None
+        try:
+            frame = decoder.read_frame(conn, 1024)
+            if frame is not None:
+                command, payload = frame
+                wire, response, history_from = self.accept_peer(addr, payload)
+                peer.send(response)
+        except Exception as e:
+            print(f"CONNECT of peer {addr} failed: {e}")
+        finally:
+            if history_from is None:
+                # Free the connection slot of a peer turned away, gone before its CONNECT or whose CONNECT failed
+                with self.peer_lock:
+                    self.connected_peers.pop(addr, None)
+                peer.close()
+        if history_from is None:
+            return
+        # Send initial messages to the new peer
+        self.join(peer, wire, history_from)
         
-        buffer = ""
         while self.running:
-            data = conn.recv(1024)
-            buffer += data.decode("utf-8")
-            if not data:
+            try:
+                frame = decoder.read_frame(conn, 1024)
+            except (OSError, ValueError) as e:
+                print(f"Connection with peer {addr} lost: {e}")
+                break
+            if frame is None:
                 break
             
-            while '\\' in buffer:
-                # Split the buffer into individual requests
-                request, buffer = buffer.split('\\', 1)
-                
-                if not request:
-                    continue
-                
-                # Parse the request
-                try: 
-                    command, payload = parse_request(request, isSeparated=True)
-                    if command == Command.MESSAGE.value:
-                        # Check authentication
-                        if not self._is_authenticated(payload[0]['username']):
-                            print(f"Peer message {payload[0]['username']} is not authenticated.")
-                            conn.send(create_response(Status.UNAUTHORIZED, {}))
-                            print(f"Sending UNAUTHORIZED response to {addr}")
-                            continue
-
-                        for message in payload:
-                            message['time'] = datetime.now().strftime("%H:%M:%S")
-                            with self.messages_lock:
-                                self.messages.append(message)
-                            self.message_queue.put(message)
-                        response = create_response(Status.OK, {
-                            "status": "success",
-                            "message": "Message received"
-                        })
-
-                        conn.send(response)
-                        
-                    elif command == Command.CACHE.value:
-                        # Check authentication
-
-                        if not self._is_authenticated(payload[0]['username']):
-                            print(f"Peer cache {payload[0]['username']} is not authenticated.")
-                            continue
-
-                        for message in payload:
-                            message['time'] = datetime.now().strftime("%H:%M:%S")
-                            with self.messages_lock:
-                                self.messages.append(message)
-                            self.message_queue.put(message)
-                        # No response needed for cache command
-                    elif command == Command.DEBUG.value:
-                        with self.messages_lock and self.authen_peers_lock and self.peer_lock:
-                            print("DEBUG INFO")
-                            print(f"Connected Peers: {[a for _, a in self.connected_peers]}")
-                            print(f"Authenticated Peers: {self.authen_peers}")
-                            print(f"Messages: {self.messages}")
-                            print(f"View Permission: {self.view_permission}")
-                            
-                    elif command == Command.VIEW.value:
-                        if payload['username'] == self.owner_peer:
-                            self.view_permission = bool(payload['permission'])
-                            response = create_response(Status.OK, {
-                                "status": "success",
-                                "message": "Permission updated"
-                            })
-                            conn.send(response)
-                        else:
-                            response = create_response(Status.UNAUTHORIZED, {
-                                "status": "failure",
-                                "message": "Permission denied"
-                            })
-                            conn.send(response)
-                        
-                except Exception as e:
-                    print(f"Error handling peer {addr}: {e}")
-                    break
-        
+            # Parse the request
+            try: 
+                command, payload = frame
+                response = self.respond(addr, wire, decoder.request_id, command, payload)
+                if response is not None:
+                    peer.send(response)
+                    
+            except Exception as e:
+                print(f"Error handling peer {addr}: {e}")
+                continue
+
         # Remove peer on disconnection
         with self.peer_lock:
-            self.connected_peers = [(c, a) for c, a in self.connected_peers if a != addr]
-        conn.close()
+            self.connected_peers.pop(addr, None)
+        peer.close()
+
+    ########################################
+    # Event-loop mode
+    ########################################
+
+    def listen_async(self):
+        try:
+            status = self.host_submission()
+            if status != "OK":
+                print("Failed to submit info to tracker.")
+                return
+            # The tracker session stays on its blocking socket, only the peers are on the loop
+            Thread(target=self.renew_lease, daemon=True).start()
+            # Apply the retention to idle channels too
+            Thread(target=self.retention_sweep, daemon=True).start()
+            asyncio.run(self.serve_async())
+        except Exception as e:
+            print(f"Error: {e}")
+            self.running = False
+        finally:
+            self.socket_server.close()
+            if self.log is not None:
+                self.log.close()
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.sessions = set()  # Sessions being served, connected or still in their CONNECT
+        self.stopped = asyncio.Event()
+        self.broadcast_wakeup = asyncio.Event()
+        server = await asyncio.start_server(self.handle_peer_session, sock=self.socket_server, backlog=1024)
+        print(f"Successfully listening on {self.ip}:{self.port} (event loop)...")
+        broadcaster = asyncio.create_task(self.broadcast_async())
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            broadcaster.cancel()
+            # Let the sessions end on their closed connection rather than be cancelled
+            for session in self.sessions:
+                session.writer.close()
+            if self.sessions:
+                await asyncio.wait([session.task for session in self.sessions], timeout=1)
+
+    async def handle_peer_session(self, reader, writer):
+        """Serve one peer on the event loop, with the semantics of handle_peer_connection."""
+        addr = writer.get_extra_info("peername")
+        session = PeerSession(self.loop, writer, addr, self.outbound_queue_size, self.overflow_policy, self.catch_up)
+        decoder = session.decoder
+        self.sessions.add(session)
+        try:
+            # The CONNECT handshake
+            frame = None
+            while frame is None:
+                data = await reader.read(4096)
+                if not data:
+                    return
+                decoder.feed(data)
+                frame = next(decoder.frames(), None)
+            command, payload = frame
+
+            with self.peer_lock:
+                full = len(self.connected_peers) >= self.max_connections
+            if full:
+                session.send(accept_offer(payload).response(Status.SERVER_ERROR, {"message": "Channel is full"}))
+                return
+            wire, response, history_from = self.accept_peer(addr, payload)
+            session.send(response)
+            if history_from is None:
+                return
+            self.join(session, wire, history_from)
+
+            while self.running:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                decoder.feed(data)
+                for command, payload in decoder.frames():
+                    try:
+                        response = self.respond(addr, session.wire, decoder.request_id, command, payload)
+                    except Exception as e:
+                        print(f"Error handling peer {addr}: {e}")
+                        continue
+                    if response is not None:
+                        session.send(response)
+                if not self.message_queue.empty():
+                    self.broadcast_wakeup.set()
+        except (OSError, ValueError) as e:
+            print(f"Connection with peer {addr} lost: {e}")
+        finally:
+            self.sessions.discard(session)
+            with self.peer_lock:
+                if self.connected_peers.get(addr) is session:
+                    del self.connected_peers[addr]
+            # The writer task closes the connection once the queued frames are written
+            session.outbox.close()
+
+    async def broadcast_async(self):
+        """Send the queued messages to every peer, each batch encoded once per framing and codec in use."""
+        while self.running:
+            await self.broadcast_wakeup.wait()
+            self.broadcast_wakeup.clear()
+            while True:
+                messages_to_send = []
+                try:
+                    while len(messages_to_send) < MAX_BROADCAST_BATCH:
+                        messages_to_send.append(self.message_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if not messages_to_send:
+                    break
+                self.fan_out(messages_to_send)
+                # Let the peers' reads and writes run between two batches
+                await asyncio.sleep(0)
+
+    def handle_peer_request(self, addr, command, payload, reply):
+        """
+        Handle one request of a connected peer.
+
+        Args:
+            reply (Wire): Encodes the response, BATCH_WIRE for an item of a BATCH.
+        Returns:
+            The response to send, None if the command has none.
+        """
+        if command == Command.MESSAGE.value:
+            # Check authentication
+            if not self._is_authenticated(payload[0]['username']):
+                print(f"Peer message {payload[0]['username']} is not authenticated.")
+                print(f"Sending UNAUTHORIZED response to {addr}")
+                return reply.response(Status.UNAUTHORIZED, {})
+
+            duplicates = sum(not self._append_message(message) for message in payload)
+            return reply.response(Status.OK, {
+                "status": "success",
+                "message": "Message received",
+                # Messages with an id received before, acknowledged but not appended again
+                "duplicates": duplicates,
+            })
+            
+        elif command == Command.CACHE.value:
+            # Check authentication
+
+            if not self._is_authenticated(payload[0]['username']):
+                print(f"Peer cache {payload[0]['username']} is not authenticated.")
+                return None
+
+            for message in payload:
+                self._append_message(message)
+            # No response needed for cache command
+            return None
+        elif command == Command.DEBUG.value:
+            with self.messages_lock and self.authen_peers_lock and self.peer_lock:
+                print("DEBUG INFO")
+                print(f"Connected Peers: {list(self.connected_peers)}")
+                print(f"Authenticated Peers: {self.authen_peers}")
+                print(f"Messages: {self.messages}")
+                print(f"View Permission: {self.view_permission}")
+                print(f"Compression: {compression_stats.stats()}")
+                print(f"Broadcast: {self.broadcast_stats.stats()}")
+                outbound = self._outbound_stats()
+                print(f"Outbound: {outbound}")
+                return reply.response(Status.OK, {
+                    "connected_peers": len(self.connected_peers),
+                    "authenticated_peers": list(self.authen_peers),
+                    "messages": self.next_seq - self._first_seq(),
+                    # Memory held by the in-memory history, and the log on disk
+                    "history": self.messages.stats(),
+                    "log": self.log.stats() if self.log is not None else None,
+                    "search": self.search_index.stats() if self.search_index is not None else None,
+                    "dedup": self.dedup.stats(),
+                    "view_permission": self.view_permission,
+                    "compression": compression_stats.stats(),
+                    "broadcast": self.broadcast_stats.stats(),
+                    "outbound": outbound,
+                })
+                
+        elif command == Command.VIEW.value:
+            if payload['username'] == self.owner_peer:
+                self.view_permission = bool(payload['permission'])
+                return reply.response(Status.OK, {
+                    "status": "success",
+                    "message": "Permission updated"
+                })
+            return reply.response(Status.UNAUTHORIZED, {
+                "status": "failure",
+                "message": "Permission denied"
+            })
+        elif command == Command.SEARCH.value:
+            return reply.response(*self.search(payload))
+        return None
 
     # NOT DONE: 
     # Messages should be delivered in list rather than one by one -> Change the protocol, remove BROADCAST command
@@ -223,8 +830,7 @@ class PeerHost:
                     messages_to_send.append(message)
                     
                     # Try to get more messages without blocking (up to 50)
-                    max_batch_size = 50
-                    for _ in range(max_batch_size - 1):
+                    for _ in range(MAX_BROADCAST_BATCH - 1):
                         try:
                             message = self.message_queue.get_nowait()
                             messages_to_send.append(message)
@@ -234,32 +840,38 @@ class PeerHost:
                     continue  # No messages available, go back to the start of the loop
                 
                 # Now broadcast all collected messages
-                with self.peer_lock:
-                    peers = self.connected_peers.copy()
-                
-                # Process each peer outside the lock to minimize lock holding time
-                for conn, addr in peers:
-                    try:
-                        request = create_request(Command.MESSAGE, messages_to_send)
-                        conn.send(request)
-                    except (BrokenPipeError, ConnectionResetError):
-                        print(f"Peer {addr} disconnected. Removing from list.")
-                        with self.peer_lock:
-                            self.connected_peers = [(c, a) for c, a in self.connected_peers if a != addr]
-                            conn.close()
-                    except socket.error as e:
-                        print(f"Socket error with {addr}: {e}")
-                        with self.peer_lock:
-                            self.connected_peers = [(c, a) for c, a in self.connected_peers if a != addr]
-                    except Exception as e:
-                        print(f"Error broadcasting to {addr}: {e}")
-                        with self.peer_lock:
-                            self.connected_peers = [(c, a) for c, a in self.connected_peers if a != addr]
+                self.fan_out(messages_to_send)
                     
             except Exception as e:
                 print(f"Error in broadcast thread: {e}")
                 time.sleep(1)
 
+    def fan_out(self, messages):
+        """
+        Hand one batch of messages to every connected peer. The batch is
+        encoded once per framing and codec in use and the same immutable
+        frame is queued to each peer, so the cost does not grow with the
+        encoding per peer nor wait on peers slow to read.
+        """
+        start = time.perf_counter()
+        frame = SharedFrame(Command.MESSAGE, messages)
+        # Batches are taken from the queue in log order, so they are runs of sequence numbers
+        span = (messages[0]['seq'], messages[-1]['seq'] + 1)
+        with self.peer_lock:
+            # Peers still in their CONNECT have no wire yet, they get the messages with the history
+            peers = [peer for peer in self.connected_peers.values() if peer.wire is not None]
+        for peer in peers:
+            peer.send(frame.for_wire(peer.wire), span)
+        self.broadcast_stats.record(len(messages), len(peers), len(frame.frames), time.perf_counter() - start)
+
+    def _outbound_stats(self):
+        """Queue depth and drops of each connected peer's outbox, called with peer_lock held."""
+        return {
+            "policy": self.overflow_policy,
+            "queue_size": self.outbound_queue_size,
+            "peers": {f"{addr[0]}:{addr[1]}": peer.outbox.stats() for addr, peer in self.connected_peers.items()},
+        }
+
     def _is_authenticated(self, username):
         with self.authen_peers_lock:
             return username in self.authen_peers
@@ -269,8 +881,25 @@ class PeerHost:
 
     def stop(self):
         self.running = False
+        
+        # Withdraw the channel right away instead of waiting for the lease to expire
+        try:
+            self._tracker_request(Command.UNHOST, self._channel_info())
+        except Exception as e:
+            print(f"Error withdrawing channel from tracker: {e}")
+        with self.tracker_lock:
+            if self.tracker_socket is not None:
+                self.tracker_socket.close()
+                self.tracker_socket = None
+        
+        if self.loop is not None:
+            # The loop closes the server socket and the peer sessions when serve_async returns
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            return
         self.socket_server.close()
         with self.peer_lock:
-            for conn, _ in self.connected_peers:
+            for conn in self.connected_peers.values():
                 conn.close()
-            self.connected_peers = []
\ No newline at end of file
+            self.connected_peers = {}
+        if self.log is not None:
+            self.log.close()
\ No newline at end of file
@@ -1,12 +1,21 @@
 import socket
-import copy
-from threading import Thread, Lock
+from threading import Thread
 import json
-from utils.protocol import create_response, parse_request, Status
+from utils.protocol import Status, StreamDecoder, accept_offer, BATCH_WIRE, batch_reply
+from utils.registry import ChannelRegistry
+from utils.accounts import AccountStore
+from utils.dispatcher import OrderedDispatcher, ResponseQueue
 
 separater = '\r\r'
-lock = Lock()
-account_list = [
+
+# Requests of all connections share a fixed pool of workers; past QUEUE_LIMIT
+# waiting requests the tracker answers "overloaded" instead of queueing more
+WORKERS = 8
+QUEUE_LIMIT = 1000
+RETRY_AFTER = 1.0
+
+# Test accounts, hashed into the account store on startup
+seed_accounts = [
     {
         "username":"phuongthao",
         "password":"15052004",
@@ -33,208 +42,198 @@ account_list = [
     }
 ]
 
-visitor_list = []
+account_list = AccountStore()
+
+channel_list = ChannelRegistry()
+
+dispatcher = None
+
+def overload_response(wire, payload):
+    return wire.response(Status.SERVER_ERROR, {
+        "message": "Tracker is overloaded, retry later",
+        "retry_after": RETRY_AFTER,
+    })
+
+def error_response(e, wire, payload):
+    return wire.response(Status.SERVER_ERROR, {"message": str(e)})
 
-channel_list = []
+def hello(wire, payload):
+    return wire.response(Status.OK, accept_offer(payload, separater).agreement())
 
 
-def get_list(conn, lock):    
+def get_list(wire, payload):    
     #TODO: REQUEST: GETLIST: send the channel list 
     global channel_list 
     try:
-        safe_copy = []
-        with lock:
-            safe_copy = copy.deepcopy(channel_list)
-        response = create_response(Status.OK, safe_copy, separater)
+        # The registry keeps its own lock and hands out a shallow copy, no deepcopy needed
+        if "since_version" in payload:
+            response = wire.response(Status.OK, channel_list.changes_since(payload["since_version"]))
+        else:
+            response = wire.tag(channel_list.encoded_listing(
+                lambda channels: wire.untagged.response(Status.OK, channels), wire.key))
         print("response", response)
-        conn.sendall(response)
+        return response
 
     except Exception as e:
-        error_msg = create_response(Status.SERVER_ERROR, {"message": str(e)})
+        error_msg = wire.response(Status.SERVER_ERROR, {"message": str(e)})
         print('response', error_msg)
-        try:
-            conn.sendall(error_msg)
-        except:
-            pass 
+        print(f"[Error] Failed to list: {e}")
+        return error_msg
 
-        print(f"[Error] Failed to send: {e}")
+def lookup_channel(wire, payload):
+    global channel_list
+    try:
+        channel = channel_list.get(payload['channel_name'])
+        if channel is None:
+            response = wire.response(Status.REQUEST_ERROR, {"message": f"Channel {payload['channel_name']} not found"})
+        else:
+            response = wire.response(Status.OK, channel)
+        return response
+
+    except Exception as e:
+        print(f"[Error] Failed to handle request: {e}")
+        return wire.response(Status.SERVER_ERROR, {"message": str(e)})
 
-def visitor(conn, lock, payload):
+def visitor(wire, payload):
     global account_list
     try:
-        with lock:
-            if any(account['username'] == payload['username'] for account in account_list):
-                message = {"Message": "Username is existed"}
-                status = Status.REQUEST_ERROR
-            else:    
-                visitor_list.append(
-                    {
-                        "username": payload['username']
-                    }
-                )
-                message = {"message": f"Create visitor account {payload['username']} successful"}
-                status = Status.OK
+        if not account_list.add_visitor(payload['username']):
+            message = {"Message": "Username is existed"}
+            status = Status.REQUEST_ERROR
+        else:    
+            message = {"message": f"Create visitor account {payload['username']} successful"}
+            status = Status.OK
         
-        response = create_response(status, message, separater) 
-        conn.sendall(response)
+        response = wire.response(status, message) 
+        return response
 
     except Exception as e:
-        error_msg = create_response(Status.SERVER_ERROR, {"message": str(e)})
-        try:
-            conn.sendall(error_msg)
-        except:
-            pass 
-
-        print(f"[Error] Failed to send: {e}")
+        print(f"[Error] Failed to handle request: {e}")
+        return wire.response(Status.SERVER_ERROR, {"message": str(e)})
     
 
-def authenticate_user(conn, lock, payload):
+def authenticate_user(wire, payload):
     global account_list
     message = {"message": "Invalid username or password"}
     status = Status.REQUEST_ERROR
 
     try:
-        with lock:
-            for account in account_list:
-                if account['username'] == payload['username'] and account['password'] == payload['password']:
-                    message = {"message": "Login successful"}
-                    status = Status.OK
-                    break
+        # Indexed lookup, the password hash is verified in the store's process pool
+        if account_list.authenticate(payload['username'], payload['password']):
+            message = {"message": "Login successful"}
+            status = Status.OK
         
-        response = create_response(status, message, separater) 
-        conn.sendall(response)
+        response = wire.response(status, message) 
+        return response
 
     except Exception as e:
-        error_msg = create_response(Status.SERVER_ERROR, {"message": str(e)})
-        try:
-            conn.sendall(error_msg)
-        except:
-            pass 
-
-        print(f"[Error] Failed to send: {e}")    
+        print(f"[Error] Failed to handle request: {e}")
+        return wire.response(Status.SERVER_ERROR, {"message": str(e)})    
     
     
 
-def create_account(conn, lock, payload):
+def create_account(wire, payload):
     #TODO: REQUEST: CREATEACC: check duplicate username, then add to the account_list
     global account_list
     username = payload.get("username")
     password = payload.get("password")
 
     try:
-        with lock:
-            if any(acc["username"] == username for acc in account_list):
-                message = {"message": "Username already been used"}
-                status = Status.REQUEST_ERROR 
-            else:    
-                account_list.append(
-                    {
-                        "username": username,
-                        "password": password
-                    }
-                )
-                message = {"message": f"Create user account {username} successful"}
-                status = Status.OK
-
-        response = create_response(status, message, separater) 
-        conn.sendall(response)
+        if not account_list.create(username, password):
+            message = {"message": "Username already been used"}
+            status = Status.REQUEST_ERROR 
+        else:    
+            message = {"message": f"Create user account {username} successful"}
+            status = Status.OK
 
-    except Exception as e:
-        error_msg = create_response(Status.SERVER_ERROR, {"message": str(e)})
-        try:
-            conn.sendall(error_msg)
-        except:
-            pass 
+        response = wire.response(status, message) 
+        return response
 
-        print(f"[Error] Failed to send: {e}")  
+    except Exception as e:
+        print(f"[Error] Failed to handle request: {e}")
+        return wire.response(Status.SERVER_ERROR, {"message": str(e)})  
 
-def create_channel(conn, lock, payload):
+def create_channel(wire, payload):
     global channel_list
     print(payload)
     
     try:
-        with lock:
-            if any(channel['channel_name'] == payload['channel_name'] for channel in channel_list):
-                message = {"message": "Channel name already been used"}
-                status = Status.REQUEST_ERROR
-            else:    
-                channel_list.append(
-                    {
-                        "channel_name": payload['channel_name'],
-                        "peer_server_ip": payload['peer_server_ip'],
-                        "peer_server_port": payload['peer_server_port']
-                    }
-                )
-                message = {"message": f"Create channel {payload['channel_name']} successful"}
-                status = Status.OK
-
-        response = create_response(status, message, separater) 
-        conn.sendall(response)
+        if channel_list.register(payload) == "conflict":
+            message = {"message": "Channel name already been used"}
+            status = Status.REQUEST_ERROR
+        else:    
+            message = {"message": f"Create channel {payload['channel_name']} successful"}
+            status = Status.OK
+
+        response = wire.response(status, message) 
+        return response
     except Exception as e:
-        error_msg = create_response(Status.SERVER_ERROR, {"message": str(e)})
-        try:
-            conn.sendall(error_msg)
-        except:
-            pass 
+        print(f"[Error] Failed to handle request: {e}")
+        return wire.response(Status.SERVER_ERROR, {"message": str(e)})
+
+# Handlers by command, each called as handler(wire, payload)
+HANDLERS = {
+    "LIST": get_list,
+    "LOOKUP": lookup_channel,
+    "HOST": lambda wire, payload: create_channel(wire, payload[0]),
+    "SIGNIN": authenticate_user,
+    "SIGNUP": create_account,
+    "GUEST": visitor,
+    "HELLO": hello,
+}
+
+def unknown_command(command):
+    """Handler answering a command this tracker does not serve, e.g. the HEARTBEAT of a leased host."""
+    return lambda wire, payload: wire.response(Status.REQUEST_ERROR, {"message": f"Unknown command {command}"})
+
+def handle_batch_item(command, payload):
+    handler = HANDLERS.get(command)
+    if handler is None:
+        return Status.REQUEST_ERROR.value, {"message": f"Unknown command {command}"}
+    return handler(BATCH_WIRE, payload)
 
-        print(f"[Error] Failed to send: {e}")
+def batch(wire, payload):
+    # The items run in order on one worker and are answered together
+    return wire.response(Status.OK, [batch_reply(item, handle_batch_item) for item in payload])
 
 def handle_user_submission(addr, conn):
-    global lock   
+    # Responses of this connection, sent in request order by the dispatcher
+    responses = ResponseQueue(conn)
+
+    # Legacy frames end with separater, length-prefixed ones are told apart by their header
+    decoder = StreamDecoder(separater)
 
-    
     ## Handle user request (while loop for listening)##
-    buffer = ""
     try:
         while True:        
-            data = conn.recv(4096)
-            if not data:
+            frame = decoder.read_frame(conn)
+            if frame is None:
                 print("No data received from", addr)
                 return
-            buffer += data.decode("utf-8")
-
-            while separater in buffer:
-
-                line, buffer = buffer.split(separater,1)
-                
-                if not line:
-                    continue
-                
-                command, payload = parse_request(line, isSeparated=True)
-                
-                if command == "LIST":
-                    Thread(target=get_list, args=(conn, lock), daemon=True).start()
-                    
-                elif command == "HOST":
-                    # peers.append({
-                    #     "channel_name": payload['channel_name'],
-                    #     "peer_server_ip": payload['peer_server_ip'],
-                    #     "peer_server_port": payload['peer_server_port'],
-                    # })
-                    # response = create_response(Status.OK, {
-                    #     "status": "success",
-                    #     "channel_name": payload['channel_name'],
-                    # })
-                    # conn.sendall(response)
-                    Thread(target=create_channel, args=(conn, lock, payload[0]), daemon=True).start()
-                
-                
-                elif command == "SIGNIN":
-                    Thread(target=authenticate_user, args=(conn, lock, payload), daemon=True).start()
-                elif command == "SIGNUP":
-                    Thread(target=create_account, args=(conn, lock, payload), daemon=True).start()
-                elif command == "GUEST":
-                    Thread(target=visitor, args=(conn, lock, payload), daemon=True).start()
-                else:
-                    pass
+
+            command, payload = frame
+            # Answer in the framing and codec of the request
+            wire = decoder.reply_wire()
+
+            if command == "BATCH":
+                dispatcher.submit(responses, batch, wire, payload)
+            else:
+                # Unknown commands are answered too, a client waiting for its reply must not hang
+                dispatcher.submit(responses, HANDLERS.get(command) or unknown_command(command), wire, payload)
             
     except ValueError as e:
         print("Error parsing data:", e)
         return
+    except OSError as e:
+        print(f"Connection error with {addr}: {e}")
+        return
     finally:
-        conn.close()
+        # The writer closes the connection once the responses already answered are sent
+        responses.close()
 
-def listen(ip, port):
+def listen(ip, port, workers=WORKERS, queue_limit=QUEUE_LIMIT):
+    global dispatcher
+    dispatcher = OrderedDispatcher(workers, queue_limit, overload_response, error_response)
     try:
         tracker_socket = socket.socket()
         tracker_socket.bind((ip, port))
@@ -254,6 +253,8 @@ def listen(ip, port):
 if __name__ == "__main__":
     
     # Dummy values for testing
+    for account in seed_accounts:
+        account_list.create(account["username"], account["password"])
     ip = '127.0.0.1'
     port = 22236
     listen(ip, port)
\ No newline at end of file
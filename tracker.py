@@ -1,74 +1,509 @@
+import argparse
+import asyncio
+import os
+import queue
+import select
+import signal
 import socket
+import sys
+import time
+from multiprocessing import Process
 from threading import Thread
 import json
-from utils.protocol import create_response, parse_request, Status
+from utils.protocol import Command, Status, Wire, SharedFrame, StreamDecoder, accept_offer, compression_stats, \
+    BATCH_WIRE, batch_reply, batch_result
+from utils.registry import ChannelRegistry
+from utils.journal import Journal
+from utils.accounts import AccountStore
+from utils.rate_limit import RateLimiter
 
-def handle_user_submission(addr, conn):
-    # Buffer to handle multiple requests at once
-    buffer = ""
+# Shared tracker state, used by both the threaded and the event-loop mode
+# Directory events are encoded once and the same bytes are pushed to every subscriber
+registry = ChannelRegistry(encode_event=lambda event: SharedFrame(Command.EVENT, event))
+accounts = AccountStore()
+
+# Token buckets per source address and per username, disabled (rate 0) unless configured
+address_limits = RateLimiter()
+user_limits = RateLimiter()
+# Commands whose payload names the user they act for
+USER_COMMANDS = {"SIGNIN", "SIGNUP", "GUEST"}
+
+# Responses go out in the framing and codec their request came in; HELLO tells
+# a client which ones the tracker understands
+LEGACY_WIRE = Wire()
+
+# Append-only log and snapshot of the state above, None when running in memory only
+journal = None
+
+# Commands that hash passwords; in event-loop mode they are awaited on the
+# account store's process pool so they never stall the loop
+BLOCKING_COMMANDS = {"SIGNIN", "SIGNUP"}
+
+# Longest sleep of the lease reaper, so leases added meanwhile are picked up
+LEASE_CHECK_INTERVAL = 1.0
+
+# Events a subscriber may fall behind before it is dropped (it resubscribes with since_version)
+SUBSCRIBER_QUEUE_LIMIT = 1000
+SUBSCRIBER_BUFFER_LIMIT = 1024 * 1024
+# Seconds an idle threaded subscription waits for an event before checking the client is still there
+SUBSCRIBER_POLL_INTERVAL = 1.0
+
+def signin_response(success, wire):
+    if success:
+        return wire.response(Status.OK, {"message": "Login successful"})
+    return wire.response(Status.REQUEST_ERROR, {"message": "Invalid username or password"})
+
+def signup_response(success, username, wire):
+    if success:
+        return wire.response(Status.OK, {"message": f"Create user account {username} successful"})
+    return wire.response(Status.REQUEST_ERROR, {"message": "Username already been used"})
+
+def admit(host, command, payload, wire):
+    """
+    Charge a request to its client's token buckets before doing any work.
+
+    Returns:
+        bytes: A REQUEST_ERROR response with a retry_after hint if the client is
+               over its limit, None if the request may run.
+    """
+    if command == "BATCH":
+        # Its items are charged one by one
+        return None
+    retry_after = address_limits.acquire(host)
+    if not retry_after and command in USER_COMMANDS:
+        retry_after = user_limits.acquire(payload.get("username"))
+    if not retry_after:
+        return None
+    return wire.response(Status.REQUEST_ERROR, {
+        "message": "Too many requests",
+        "retry_after": round(retry_after, 3),
+    })
+
+def handle_request(command, payload, wire=LEGACY_WIRE):
+    """
+    Process a single parsed request against the tracker state.
+
+    Args:
+        command (str): The command of the request.
+        payload: The decoded payload of the request.
+        wire (Wire): Encoding of the response.
+
+    Returns:
+        bytes: The encoded response, or None if the command has no response.
+    """
+    if command == "LIST":
+        if "since_version" in payload:
+            return wire.response(Status.OK, registry.changes_since(payload["since_version"]))
+        # The listing is cached without a request id, the id of this request is added to it
+        return wire.tag(registry.encoded_listing(lambda channels: wire.untagged.response(Status.OK, channels), wire.key))
+    elif command == "LOOKUP":
+        channel = registry.get(payload["channel_name"])
+        if channel is None:
+            return wire.response(Status.REQUEST_ERROR, {"message": f"Channel {payload['channel_name']} not found"})
+        return wire.response(Status.OK, channel)
+    elif command == "HOST":
+        # A host can have multiple channels
+        accepted, rejected = [], []
+        for peer in payload:
+            # Channels hosted with a "ttl" must be renewed with HEARTBEAT before it runs out
+            if registry.register(peer, peer.get("ttl")) == "conflict":
+                rejected.append(peer["channel_name"])
+            else:
+                accepted.append(peer["channel_name"])
+
+        if rejected:
+            return wire.response(Status.REQUEST_ERROR, {
+                "status": "Channel name already been used",
+                "channel_name": accepted,
+                "rejected": rejected,
+            })
+        return wire.response(Status.OK, {
+            "status": "success",
+            "channel_name": accepted,
+        })
+    elif command == "HEARTBEAT":
+        # Channels the tracker does not know (anymore) have to be hosted again
+        unknown = registry.renew(payload["channel_name"])
+        return wire.response(Status.OK, {
+            "status": "success",
+            "unknown": unknown,
+        })
+    elif command == "UNHOST":
+        removed = [peer["channel_name"] for peer in payload
+                   if registry.unregister(peer["channel_name"], (peer["peer_server_ip"], peer["peer_server_port"]))]
+        return wire.response(Status.OK, {
+            "status": "success",
+            "channel_name": removed,
+        })
+    elif command == "SIGNIN":
+        return signin_response(accounts.authenticate(payload['username'], payload['password']), wire)
+    elif command == "SIGNUP":
+        return signup_response(accounts.create(payload['username'], payload['password']), payload['username'], wire)
+    elif command == "GUEST":
+        if not accounts.add_visitor(payload['username']):
+            return wire.response(Status.REQUEST_ERROR, {"message": "Username is existed"})
+        return wire.response(Status.OK, {"message": f"Create visitor account {payload['username']} successful"})
+    elif command == "STATS":
+        return wire.response(Status.OK, {
+            **registry.stats(),
+            **accounts.stats(),
+            "rate_limited": {
+                "address": address_limits.stats()["rejected"],
+                "username": user_limits.stats()["rejected"],
+            },
+            "compression": compression_stats.stats(),
+        })
+    elif command == "HELLO":
+        return wire.response(Status.OK, accept_offer(payload).agreement())
+    elif command == "MESSAGE":
+        return None
+    return wire.response(Status.REQUEST_ERROR, {"message": f"Unknown command {command}"})
+
+def handle_batch(host, items, wire):
+    """
+    Handle the items of a BATCH in order, each charged to the client's
+    limits like a request of its own, and answer them in one response.
+    """
+    return wire.response(Status.OK, [
+        batch_reply(item, lambda command, payload: admit(host, command, payload, BATCH_WIRE)
+                    or handle_request(command, payload, BATCH_WIRE))
+        for item in items
+    ])
+
+def client_left(conn):
+    """True if the client closed its end of conn, checked without blocking or consuming data."""
+    readable, _, _ = select.select([conn], [], [], 0)
+    return bool(readable) and conn.recv(1, socket.MSG_PEEK) == b""
+
+def serve_subscription(addr, conn, payload, wire):
+    """
+    Turn a connection into a push-only directory subscription: the delta since
+    the client's version is sent first, then every change event in order.
+    While no event comes the connection is checked every
+    SUBSCRIBER_POLL_INTERVAL, so a client that left is unsubscribed right away
+    rather than on the next event of the directory.
+    """
+    events = queue.Queue(maxsize=SUBSCRIBER_QUEUE_LIMIT)
+    lagging = False
+    
+    def push(event):
+        nonlocal lagging
+        try:
+            events.put_nowait(event)
+        except queue.Full:
+            lagging = True
     
+    delta = registry.subscribe(push, payload.get("since_version", 0))
+    try:
+        conn.sendall(wire.response(Status.OK, delta))
+        while not lagging:
+            try:
+                event = events.get(timeout=SUBSCRIBER_POLL_INTERVAL)
+            except queue.Empty:
+                if client_left(conn):
+                    print(f"Subscriber {addr} left")
+                    return
+                continue
+            conn.sendall(event.for_wire(wire))
+        print(f"Subscriber {addr} is too slow, closing its subscription")
+    finally:
+        registry.unsubscribe(push)
+
+def handle_user_submission(addr, conn):
+    # Splits the stream into requests, whichever framing each one uses
+    decoder = StreamDecoder()
+
     try:
         while True:
-            data = conn.recv(4096)
-            if not data:
+            frame = decoder.read_frame(conn)
+            if frame is None:
                 print(f"Connection closed by {addr}")
                 return
+
+            command, payload = frame
+            wire = decoder.reply_wire()
+            response = admit(addr[0], command, payload, wire)
+            if response is not None:
+                conn.sendall(response)
+                continue
+
+            if command == "SUBSCRIBE":
+                # The connection only carries events from now on
+                serve_subscription(addr, conn, payload, wire)
+                return
             
-            buffer += data.decode("utf-8")
-            
-            while '\\' in buffer:
-                # Split the buffer into individual requests
-                request, buffer = buffer.split('\\', 1)
-                
-                if not request:
-                    continue
-                
-                # Parse the request
-                command, payload = parse_request(request, isSeparated=True)
-                
-                if command == "LIST":
-                    response = create_response(Status.OK, peers)
-                    conn.send(response)
-                elif command == "HOST":
-                    # A host can have multiple channels
-                    for peer in payload:
-                        peers.append(peer)
-                        
-                    response = create_response(Status.OK, {
-                        "status": "success",
-                        "channel_name": [peer["channel_name"] for peer in payload],
-                    })
-                    conn.send(response)
-                elif command == "MESSAGE":
-                    pass
-            
-    except ValueError as e:
+            if command == "BATCH":
+                response = handle_batch(addr[0], payload, wire)
+            else:
+                response = handle_request(command, payload, wire)
+            if response is not None:
+                conn.sendall(response)
+
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
         print("Error parsing data:", e)
         return
+    except OSError as e:
+        print(f"Connection error with {addr}: {e}")
+        return
     finally:
         conn.close()
 
+def dump_state():
+    return {
+        "registry": registry.dump(),
+        "accounts": accounts.dump(),
+    }
+
+def load_state(data_dir, snapshot_every=10000):
+    """
+    Recover the registry and the accounts from the snapshot and the log tail
+    in data_dir, then record every further mutation there.
+    """
+    global journal
+    journal = Journal(data_dir, snapshot_every)
+    state, records = journal.load()
+
+    registry.restore(state.get("registry", {}))
+    if isinstance(state.get("accounts"), list):
+        # Snapshot written before passwords were hashed
+        for account in state["accounts"]:
+            accounts.create(account["username"], account["password"])
+        for visitor in state.get("visitors", []):
+            accounts.add_visitor(visitor["username"])
+    else:
+        accounts.restore(state.get("accounts", {}))
+
+    # Records may repeat what the snapshot already holds, both replays are idempotent
+    for record in records:
+        if record["op"] in ("register", "unregister"):
+            registry.replay(record)
+        else:
+            accounts.replay(record)
+
+    registry.journal = journal
+    accounts.journal = journal
+    journal.open()
+    print(f"Recovered {len(registry.channels)} channels and {len(accounts.accounts)} accounts "
+          f"({len(records)} log records) from {data_dir}")
+
+def compact_journal():
+    if journal is not None and journal.snapshot_due:
+        journal.compact(dump_state)
+
+def seconds_to_next_expiry():
+    next_expiry = registry.next_expiry()
+    if next_expiry is None:
+        return LEASE_CHECK_INTERVAL
+    return min(max(next_expiry - time.monotonic(), 0), LEASE_CHECK_INTERVAL)
+
+def expire_leases():
+    # Sleep until the earliest lease deadline instead of scanning all channels
+    while True:
+        time.sleep(seconds_to_next_expiry())
+        for channel_name in registry.expire():
+            print(f"Lease of channel {channel_name} expired")
+        compact_journal()
+
 def listen(ip, port):
+    Thread(target=expire_leases, daemon=True).start()
     try:
         tracker_socket = socket.socket()
         tracker_socket.bind((ip, port))
         tracker_socket.listen(10)
         print(f"listening on {ip}:{port}...")
-        
+
         while True:
             conn, addr = tracker_socket.accept()
             Thread(target=handle_user_submission, args=(addr, conn), daemon=True).start()
 
     except KeyboardInterrupt:
         print("Exiting...")
-        
+
     finally:
         tracker_socket.close()
 
+########################################
+# Event-loop mode
+########################################
+
+def write_event(writer, wire, event):
+    if writer.is_closing():
+        return
+    if writer.transport.get_write_buffer_size() > SUBSCRIBER_BUFFER_LIMIT:
+        print(f"Subscriber {writer.get_extra_info('peername')} is too slow, closing its subscription")
+        writer.close()
+        return
+    writer.write(event.for_wire(wire))
+
+async def handle_account_request(command, payload, wire):
+    if command == "SIGNIN":
+        return signin_response(await accounts.authenticate_async(payload['username'], payload['password']), wire)
+    return signup_response(await accounts.create_async(payload['username'], payload['password']), payload['username'],
+                           wire)
+
+async def handle_batch_async(host, items, wire):
+    """handle_batch for the event loop, where account items are awaited on the process pool."""
+    results = []
+    for item in items:
+        if isinstance(item, dict) and item.get("command") in BLOCKING_COMMANDS:
+            command, payload = item["command"], item.get("payload", {})
+            try:
+                reply = admit(host, command, payload, BATCH_WIRE) \
+                    or await handle_account_request(command, payload, BATCH_WIRE)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                reply = (Status.REQUEST_ERROR.value, {"message": f"Invalid request: {e}"})
+            results.append(batch_result(item, reply))
+        else:
+            results.append(batch_reply(item, lambda command, payload: admit(host, command, payload, BATCH_WIRE)
+                                       or handle_request(command, payload, BATCH_WIRE)))
+    return wire.response(Status.OK, results)
+
+async def handle_user_session(reader, writer):
+    """
+    Serve one connection on the event loop. Requests on a connection are
+    answered in order; password hashing is awaited on the process pool.
+    """
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    decoder = StreamDecoder()
+    # Set once the connection subscribed to directory events
+    push = None
+
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+
+            decoder.feed(data)
+            for command, payload in decoder.frames():
+                wire = decoder.reply_wire()
+                rejection = admit(addr[0], command, payload, wire)
+                if rejection is not None:
+                    response = rejection
+                elif command == "SUBSCRIBE":
+                    if push is None:
+                        # Events may be produced on worker threads, always write them from the loop
+                        push = lambda event, wire=wire: loop.call_soon_threadsafe(write_event, writer, wire, event)
+                        delta = registry.subscribe(push, payload.get("since_version", 0))
+                    else:
+                        delta = registry.changes_since(payload.get("since_version", 0))
+                    response = wire.response(Status.OK, delta)
+                elif command in BLOCKING_COMMANDS:
+                    response = await handle_account_request(command, payload, wire)
+                elif command == "BATCH":
+                    response = await handle_batch_async(addr[0], payload, wire)
+                else:
+                    response = handle_request(command, payload, wire)
+
+                if response is not None:
+                    writer.write(response)
+            await writer.drain()
+
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        print("Error parsing data:", e)
+    except OSError as e:
+        print(f"Connection error with {addr}: {e}")
+    finally:
+        if push is not None:
+            registry.unsubscribe(push)
+        writer.close()
+
+async def expire_leases_async():
+    while True:
+        await asyncio.sleep(seconds_to_next_expiry())
+        for channel_name in registry.expire():
+            print(f"Lease of channel {channel_name} expired")
+        if journal is not None and journal.snapshot_due:
+            # Writing the snapshot must not stall the loop
+            await asyncio.get_running_loop().run_in_executor(None, compact_journal)
+
+async def serve(ip, port):
+    reaper = asyncio.create_task(expire_leases_async())
+    server = await asyncio.start_server(handle_user_session, ip, port, backlog=1024)
+    print(f"listening on {ip}:{port} (event loop, {accounts.workers} hashing workers)...")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        reaper.cancel()
+
+def listen_async(ip, port):
+    try:
+        asyncio.run(serve(ip, port))
+    except KeyboardInterrupt:
+        print("Exiting...")
+
+def run(ip, port, mode='threaded', workers=2, data_dir='', snapshot_every=10000, hash_iterations=None, limits=None):
+    global address_limits, user_limits
+    accounts.workers = workers
+    if limits:
+        # Built by the constructor, which keeps the bursts at 1 or more
+        address_limits = RateLimiter(limits["address_rate"], limits["address_burst"])
+        user_limits = RateLimiter(limits["user_rate"], limits["user_burst"])
+    if hash_iterations:
+        accounts.iterations = hash_iterations
+    if data_dir:
+        load_state(data_dir, snapshot_every)
+
+    if mode == 'async':
+        listen_async(ip, port)
+    else:
+        listen(ip, port)
+
+    if journal is not None:
+        journal.close()
+
+def run_shards(ip, port, shards, mode, workers, data_dir, snapshot_every, hash_iterations=None, limits=None):
+    """
+    Start one tracker process per shard on consecutive ports. Peers given the
+    same shard list route each channel name to its owner with a hash ring.
+    """
+    processes = []
+    for index in range(shards):
+        shard_dir = os.path.join(data_dir, f"shard-{index}") if data_dir else ''
+        # Not daemonic: each shard starts its own password hashing processes
+        process = Process(target=run, args=(ip, port + index, mode, workers, shard_dir, snapshot_every, hash_iterations, limits))
+        process.start()
+        processes.append(process)
+    print("Tracker shards: " + ",".join(f"{ip}:{port + index}" for index in range(shards)))
+    # Stop the shards too when this process is terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("Exiting...")
+    finally:
+        for process in processes:
+            process.terminate()
+
 if __name__ == "__main__":
-    
-    # Dummy values for testing
-    peers = []
-    ip = '127.0.0.1'
-    port = 22236
-    listen(ip, port)
\ No newline at end of file
+    parser = argparse.ArgumentParser(prog='Tracker', description='Run the channel tracker')
+    parser.add_argument('--ip', default='127.0.0.1', help='IP address to listen on')
+    parser.add_argument('--port', type=int, default=22236, help='Port to listen on (first port with --shards)')
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help='threaded: one thread per connection, async: single event loop')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes for password hashing')
+    parser.add_argument('--hash-iterations', type=int, default=0, help='PBKDF2 iterations for new passwords (0: default)')
+    parser.add_argument('--data-dir', default='', help='Directory for the journal and snapshot, if empty the state is kept in memory only')
+    parser.add_argument('--snapshot-every', type=int, default=10000, help='Log records between two snapshots')
+    parser.add_argument('--shards', type=int, default=1, help='Number of tracker processes, each owning a slice of the channel names')
+    parser.add_argument('--rate', type=float, default=0, help='Requests per second per source address (0: unlimited)')
+    parser.add_argument('--burst', type=int, default=20, help='Requests a source address may send at once')
+    parser.add_argument('--user-rate', type=float, default=0, help='SIGNIN/SIGNUP/GUEST per second per username (0: unlimited)')
+    parser.add_argument('--user-burst', type=int, default=5, help='Account requests a username may send at once')
+    args = parser.parse_args()
+
+    limits = {
+        "address_rate": args.rate,
+        "address_burst": args.burst,
+        "user_rate": args.user_rate,
+        "user_burst": args.user_burst,
+    }
+    if args.shards > 1:
+        run_shards(args.ip, args.port, args.shards, args.mode, args.workers, args.data_dir, args.snapshot_every,
+                   args.hash_iterations, limits)
+    else:
+        run(args.ip, args.port, args.mode, args.workers, args.data_dir, args.snapshot_every, args.hash_iterations,
+            limits)
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, BoundedSemaphore
+
+DEFAULT_ITERATIONS = 100000
+
+def hash_password(password, salt=None, iterations=DEFAULT_ITERATIONS):
+    """
+    Hash a password with salted PBKDF2-SHA256.
+
+    Returns:
+        dict: {"salt", "hash", "iterations"} as stored for an account.
+    """
+    salt = os.urandom(16) if salt is None else bytes.fromhex(salt)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return {"salt": salt.hex(), "hash": digest.hex(), "iterations": iterations}
+
+def verify_password(password, record):
+    """Check a password against a stored {"salt", "hash", "iterations"} record in constant time."""
+    expected = hash_password(password, record["salt"], record["iterations"])["hash"]
+    return hmac.compare_digest(expected, record["hash"])
+
+class AccountStore:
+    """
+    Accounts of the tracker indexed by username, with salted password hashes.
+
+    Lookups and inserts are O(1) under a short lock. Hashing is deliberately
+    slow, so it runs in a bounded process pool outside the lock: it neither
+    holds up other requests nor blocks the tracker's event loop.
+    """
+    def __init__(self, iterations=DEFAULT_ITERATIONS, workers=2, max_pending=64):
+        self.accounts = {}  # {username: {"salt", "hash", "iterations"}}
+        self.visitors = set()
+        self.lock = Lock()
+        self.iterations = iterations
+
+        # Created on first use, so importing the tracker does not fork
+        self.workers = workers
+        self.pool = None
+        self.pool_lock = Lock()
+        # At most max_pending hashes wait for the pool, further callers wait here
+        self.pending = BoundedSemaphore(max_pending)
+        # The same bound for event loop callers, created on the loop on first use
+        self.max_pending = max_pending
+        self.pending_async = None
+
+        # Optional utils.journal.Journal that records every new account
+        self.journal = None
+
+    def _get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def _run_hash(self, function, *args):
+        with self.pending:
+            return self._get_pool().submit(function, *args).result()
+
+    async def _run_hash_async(self, function, *args):
+        # Waiting on an asyncio semaphore never blocks the loop, and a caller
+        # cancelled while waiting or hashing (e.g. a client gone mid-login) gives its slot back
+        if self.pending_async is None:
+            self.pending_async = asyncio.Semaphore(self.max_pending)
+        async with self.pending_async:
+            return await asyncio.get_running_loop().run_in_executor(self._get_pool(), function, *args)
+
+    def _insert(self, username, record):
+        with self.lock:
+            if username in self.accounts:
+                return False
+            self.accounts[username] = record
+            if self.journal is not None:
+                self.journal.append({"op": "signup", "username": username, **record})
+            return True
+
+    def create(self, username, password):
+        """Create an account. Returns False if the username is already used."""
+        with self.lock:
+            if username in self.accounts:
+                return False
+        return self._insert(username, self._run_hash(hash_password, password, None, self.iterations))
+
+    async def create_async(self, username, password):
+        with self.lock:
+            if username in self.accounts:
+                return False
+        record = await self._run_hash_async(hash_password, password, None, self.iterations)
+        return self._insert(username, record)
+
+    def authenticate(self, username, password):
+        """Return True if the username exists and the password matches."""
+        with self.lock:
+            record = self.accounts.get(username)
+        if record is None:
+            return False
+        return self._run_hash(verify_password, password, record)
+
+    async def authenticate_async(self, username, password):
+        with self.lock:
+            record = self.accounts.get(username)
+        if record is None:
+            return False
+        return await self._run_hash_async(verify_password, password, record)
+
+    def add_visitor(self, username):
+        """Register a guest name. Returns False if it belongs to an account."""
+        with self.lock:
+            if username in self.accounts:
+                return False
+            if username not in self.visitors:
+                self.visitors.add(username)
+                if self.journal is not None:
+                    self.journal.append({"op": "guest", "username": username})
+            return True
+
+    def dump(self):
+        """State of the store for a journal snapshot."""
+        with self.lock:
+            return {
+                "accounts": dict(self.accounts),
+                "visitors": list(self.visitors),
+            }
+
+    def restore(self, state):
+        """Load a snapshot made by dump()."""
+        with self.lock:
+            self.accounts.update(state.get("accounts", {}))
+            self.visitors.update(state.get("visitors", []))
+
+    def replay(self, record):
+        """Apply one journal record written by this store."""
+        if record["op"] == "signup":
+            if "password" in record:
+                # Written before passwords were hashed, hash it now
+                self.create(record["username"], record["password"])
+            else:
+                self._insert(record["username"], {
+                    "salt": record["salt"],
+                    "hash": record["hash"],
+                    "iterations": record["iterations"],
+                })
+        elif record["op"] == "guest":
+            self.add_visitor(record["username"])
+
+    def stats(self):
+        with self.lock:
+            return {"accounts": len(self.accounts), "visitors": len(self.visitors)}
@@ -0,0 +1,181 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # Optional, the msgpack codec is only offered when it is installed
+    msgpack = None
+
+class JsonCodec:
+    """JSON text, the only codec of the legacy framing."""
+    name = "json"
+    id = 0
+
+    def dumps(self, payload):
+        return json.dumps(payload).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(str(data, "utf-8"))
+
+class BinaryCodec:
+    """
+    Compact tagged binary encoding of JSON values, stdlib only.
+
+    Every value starts with a one-byte tag; lengths and integers are varints
+    (integers zigzag-encoded), floats are 8-byte doubles. Dict keys are
+    interned per frame: the first use of a key carries its text, later uses
+    only its index, so a batch of messages pays for "username",
+    "message_content" and "time" once.
+    """
+    name = "binary"
+    id = 1
+
+    NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT, KEY, KEY_REF = range(10)
+    DOUBLE = struct.Struct("!d")
+
+    @staticmethod
+    def _write_uint(out, n):
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def _write(self, out, value, keys):
+        if isinstance(value, str):
+            data = value.encode("utf-8")
+            out.append(self.STR)
+            self._write_uint(out, len(data))
+            out += data
+        elif isinstance(value, dict):
+            out.append(self.DICT)
+            self._write_uint(out, len(value))
+            for key, item in value.items():
+                index = keys.get(key)
+                if index is None:
+                    keys[key] = len(keys)
+                    data = str(key).encode("utf-8")
+                    out.append(self.KEY)
+                    self._write_uint(out, len(data))
+                    out += data
+                else:
+                    out.append(self.KEY_REF)
+                    self._write_uint(out, index)
+                self._write(out, item, keys)
+        elif isinstance(value, (list, tuple)):
+            out.append(self.LIST)
+            self._write_uint(out, len(value))
+            for item in value:
+                self._write(out, item, keys)
+        elif value is None:
+            out.append(self.NONE)
+        elif value is True:
+            out.append(self.TRUE)
+        elif value is False:
+            out.append(self.FALSE)
+        elif isinstance(value, int):
+            out.append(self.INT)
+            self._write_uint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, float):
+            out.append(self.FLOAT)
+            out += self.DOUBLE.pack(value)
+        else:
+            raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+    def dumps(self, payload):
+        out = bytearray()
+        self._write(out, payload, {})
+        return bytes(out)
+
+    def loads(self, data):
+        data = bytes(data)
+        keys = []
+        position = 0
+
+        def read_uint():
+            nonlocal position
+            n = shift = 0
+            while True:
+                byte = data[position]
+                position += 1
+                n |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    return n
+                shift += 7
+
+        def read_text():
+            nonlocal position
+            length = read_uint()
+            text = data[position:position + length].decode("utf-8")
+            position += length
+            return text
+
+        def read():
+            nonlocal position
+            tag = data[position]
+            position += 1
+            if tag == self.STR:
+                return read_text()
+            if tag == self.DICT:
+                value = {}
+                for _ in range(read_uint()):
+                    tag = data[position]
+                    position += 1
+                    if tag == self.KEY:
+                        key = read_text()
+                        keys.append(key)
+                    elif tag == self.KEY_REF:
+                        key = keys[read_uint()]
+                    else:
+                        raise ValueError(f"Invalid key tag {tag}")
+                    value[key] = read()
+                return value
+            if tag == self.LIST:
+                return [read() for _ in range(read_uint())]
+            if tag == self.INT:
+                n = read_uint()
+                return n >> 1 if not n & 1 else -((n + 1) >> 1)
+            if tag == self.FLOAT:
+                value = self.DOUBLE.unpack_from(data, position)[0]
+                position += self.DOUBLE.size
+                return value
+            if tag == self.NONE:
+                return None
+            if tag == self.TRUE:
+                return True
+            if tag == self.FALSE:
+                return False
+            raise ValueError(f"Invalid value tag {tag}")
+
+        try:
+            return read()
+        except IndexError:
+            raise ValueError("Truncated binary payload")
+
+class MsgpackCodec:
+    """MessagePack through the optional msgpack package."""
+    name = "msgpack"
+    id = 2
+
+    def dumps(self, payload):
+        return msgpack.packb(payload)
+
+    def loads(self, data):
+        return msgpack.unpackb(data)
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+# Codecs available here, in order of preference when offered to or picked for a peer
+CODECS = ([MsgpackCodec()] if msgpack is not None else []) + [BINARY, JSON]
+CODECS_BY_ID = {codec.id: codec for codec in CODECS}
+
+def choose_codec(offered):
+    """
+    Pick the codec of a connection from the codec names offered in its
+    handshake, in the offer's order, falling back to JSON if none is known.
+    """
+    for name in offered or []:
+        for codec in CODECS:
+            if codec.name == name:
+                return codec
+    return JSON
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+# A replay is recognized as such if the original arrived at most this many messages...
+DEDUP_WINDOW_SIZE = 100000
+# ...and this many seconds before it
+DEDUP_WINDOW_SECONDS = 3600
+
+class DedupWindow:
+    """
+    The ids of the messages a channel received recently, to append each
+    message once however often a client replays it (e.g. a CACHE resent
+    after the connection dropped mid-send).
+
+    Ids are kept in arrival order in an OrderedDict, so a lookup is O(1)
+    and the oldest ones are forgotten from the front once there are more
+    than size of them or they are older than ttl seconds. PeerHost checks
+    an id and appends its message under one messages_lock, so two copies
+    arriving together can not both get in.
+    """
+    def __init__(self, size=DEDUP_WINDOW_SIZE, ttl=DEDUP_WINDOW_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self.ids = OrderedDict()  # {id: arrival time}
+        self.duplicates = 0
+
+    def add(self, message_id, now=None):
+        """
+        Record an id.
+
+        Returns:
+            bool: False if the id is in the window already, the message is a duplicate.
+        """
+        now = now if now is not None else time.time()
+        self._expire(now)
+        if message_id in self.ids:
+            self.duplicates += 1
+            return False
+        self.ids[message_id] = now
+        if len(self.ids) > self.size:
+            self.ids.popitem(last=False)
+        return True
+
+    def _expire(self, now):
+        cutoff = now - self.ttl
+        while self.ids:
+            oldest = next(iter(self.ids.values()))
+            if oldest >= cutoff:
+                break
+            self.ids.popitem(last=False)
+
+    def stats(self):
+        return {
+            "ids": len(self.ids),
+            "duplicates": self.duplicates,
+        }
@@ -0,0 +1,154 @@
+import queue
+import socket
+from collections import deque
+from threading import Thread, Lock
+
+# Responses a connection may have waiting to be written before it is dropped as too slow
+RESPONSE_QUEUE_SIZE = 1000
+
+class ResponseQueue:
+    """
+    Responses of one connection, sent in the order their requests arrived.
+
+    A slot is reserved when a request is read. Workers may fill the slots in
+    any order; a response is handed to the connection's writer thread once
+    every response before it is, and only that thread sends. A client that
+    stops reading holds up its own writer, never a worker of the shared
+    pool, and past limit unsent responses its connection is shut down.
+
+    Once the client stops sending (close()), the queue drains: the requests
+    already read are still answered, and the connection is closed after the
+    last of them is sent.
+    """
+    def __init__(self, conn, limit=RESPONSE_QUEUE_SIZE):
+        self.conn = conn
+        self.slots = deque()  # [[response, done], ...] in request order
+        self.lock = Lock()
+        self.limit = limit
+        self.outgoing = queue.Queue()  # Responses in order, then None to stop the writer
+        self.draining = False  # No more slots will be reserved
+        self.closed = False  # The writer was told to stop, nothing more is queued
+        Thread(target=self._write, daemon=True).start()
+
+    def reserve(self):
+        slot = [None, False]
+        with self.lock:
+            self.slots.append(slot)
+        return slot
+
+    def complete(self, slot, response):
+        """Fill a slot (None: no response) and queue every response that is now in order for the writer."""
+        with self.lock:
+            slot[0] = response
+            slot[1] = True
+            while self.slots and self.slots[0][1] and not self.closed:
+                response = self.slots.popleft()[0]
+                if response is None:
+                    continue
+                if self.outgoing.qsize() >= self.limit:
+                    print("Client is too slow reading its responses, disconnecting it")
+                    self._abort()
+                    return
+                self.outgoing.put(response)
+            if self.draining and not self.slots:
+                self._finish()
+
+    def close(self):
+        """Close the connection once every request already read is answered and its response sent."""
+        with self.lock:
+            self.draining = True
+            if not self.slots:
+                self._finish()
+
+    def _finish(self):
+        # Called with the lock held; the writer stops after the responses queued before
+        if not self.closed:
+            self.closed = True
+            self.outgoing.put(None)
+
+    def _abort(self):
+        # Called with the lock held; wakes up the threads reading from and writing to the client
+        self._finish()
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write(self):
+        while True:
+            response = self.outgoing.get()
+            if response is None:
+                break
+            try:
+                self.conn.sendall(response)
+            except OSError as e:
+                # The client is gone, its reader thread stops too
+                print(f"[Error] Failed to send: {e}")
+                break
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+class OrderedDispatcher:
+    """
+    Fixed pool of worker threads shared by all connections of a server.
+
+    Requests of different connections run in parallel, while the responses of
+    one connection leave in request order through its ResponseQueue. At most
+    queue_limit requests wait for a worker; past that a request is answered
+    right away with overload_response(*args) instead of being queued.
+    """
+    def __init__(self, workers=8, queue_limit=1000, overload_response=None, error_response=None):
+        self.tasks = queue.Queue(maxsize=queue_limit)
+        # Both are called with the handler's arguments and return the response to send
+        self.overload_response = overload_response
+        # error_response also gets the exception raised by the handler first
+        self.error_response = error_response
+
+        self.lock = Lock()
+        self.handled = 0
+        self.rejected = 0
+
+        self.workers = [Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, responses, handler, *args):
+        """
+        Queue handler(*args), its return value (bytes or None) is the response.
+
+        Returns:
+            bool: False if the queue was full and the overload response was sent instead.
+        """
+        slot = responses.reserve()
+        try:
+            self.tasks.put_nowait((responses, slot, handler, args))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            responses.complete(slot, self.overload_response(*args) if self.overload_response else None)
+            return False
+
+    def _work(self):
+        while True:
+            responses, slot, handler, args = self.tasks.get()
+            try:
+                response = handler(*args)
+            except Exception as e:
+                print(f"[Error] Request failed: {e}")
+                response = self.error_response(e, *args) if self.error_response else None
+            responses.complete(slot, response)
+            with self.lock:
+                self.handled += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": len(self.workers),
+                "queued": self.tasks.qsize(),
+                "handled": self.handled,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,42 @@
+import bisect
+import hashlib
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys (channel names) to tracker shards.
+
+    Each shard is placed on the ring many times (virtual nodes) so keys spread
+    evenly, and adding or removing a shard only moves the keys of that shard.
+    The ring only depends on the set of shards, not on their order, so every
+    peer configured with the same shards routes a channel to the same tracker.
+    """
+    def __init__(self, nodes, replicas=100):
+        self.nodes = sorted(set(tuple(node) for node in nodes))
+        self.replicas = replicas
+        self.ring = []  # [(hash, node), ...] sorted by hash
+        for node in self.nodes:
+            for i in range(replicas):
+                self.ring.append((self._hash(f"{node[0]}:{node[1]}#{i}"), node))
+        self.ring.sort()
+        self.hashes = [h for h, _ in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def node_for(self, key):
+        """Return the shard (ip, port) that owns key."""
+        if not self.ring:
+            raise ValueError("Hash ring has no nodes")
+        index = bisect.bisect(self.hashes, self._hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+def parse_nodes(text):
+    """Parse "ip:port,ip:port" into [(ip, port), ...]."""
+    nodes = []
+    for item in text.split(","):
+        item = item.strip()
+        if item:
+            ip, port = item.rsplit(":", 1)
+            nodes.append((ip, int(port)))
+    return nodes
@@ -0,0 +1,189 @@
+import json
+import time
+from array import array
+
+# Slots a MessageRing starts with, it grows by doubling up to its retention
+INITIAL_CAPACITY = 1024
+
+class Retention:
+    """
+    How much of a channel's history to keep: the last max_messages messages,
+    the ones newer than max_age seconds, and up to max_bytes bytes of them
+    (their size as compact JSON). Each limit applies when set, None keeps
+    everything.
+    """
+    def __init__(self, max_messages=None, max_age=None, max_bytes=None):
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    def __bool__(self):
+        return any(limit is not None for limit in (self.max_messages, self.max_age, self.max_bytes))
+
+    def __repr__(self):
+        return f"Retention(max_messages={self.max_messages}, max_age={self.max_age}, max_bytes={self.max_bytes})"
+
+    def cutoff(self, now=None):
+        """Epoch milliseconds before which messages are too old, None without max_age."""
+        if self.max_age is None:
+            return None
+        return int(((now or time.time()) - self.max_age) * 1000)
+
+def message_size(message):
+    return len(json.dumps(message, separators=(",", ":")))
+
+class JsonLinesArchive:
+    """Archival sink: appends the messages it is handed to a file, one JSON line each."""
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, messages):
+        with open(self.path, "a") as f:
+            for message in messages:
+                f.write(json.dumps(message, separators=(",", ":")) + "\n")
+
+class MessageRing:
+    """
+    The in-memory part of a channel's history, oldest message first.
+
+    Messages live in a circular list of slots next to two arrays of their
+    timestamp and size, so appending and evicting the oldest message are
+    O(1) and the only per-message overhead is a slot and 16 bytes. After
+    each append the oldest messages are evicted until retention holds; they
+    are handed to sink (a callable taking a list of messages), if any, or
+    dropped. Indexing and slicing work as on a list; a slice is a copy,
+    which PeerHost takes under its messages_lock and uses after releasing it.
+    """
+    def __init__(self, retention=None, sink=None, messages=()):
+        self.retention = retention or Retention()
+        self.sink = sink
+        capacity = INITIAL_CAPACITY
+        if self.retention.max_messages is not None:
+            capacity = max(1, min(capacity, self.retention.max_messages))
+        self._allocate(capacity)
+        self.head = 0  # Slot of the oldest message
+        self.count = 0
+        self.bytes = 0
+        self.evicted = 0
+        self.archived = 0
+        self.extend(messages)
+
+    def _allocate(self, capacity):
+        self.slots = [None] * capacity
+        self.stamps = array("q", bytes(8 * capacity))  # Epoch milliseconds, "ts" or when the message was added
+        self.sizes = array("q", bytes(8 * capacity))
+
+    def _resize(self, capacity):
+        order = [self._slot(i) for i in range(self.count)]
+        slots = self[:]
+        stamps = [self.stamps[slot] for slot in order]
+        sizes = [self.sizes[slot] for slot in order]
+        self._allocate(capacity)
+        self.slots[:self.count] = slots
+        self.stamps[:self.count] = array("q", stamps)
+        self.sizes[:self.count] = array("q", sizes)
+        self.head = 0
+
+    def _slot(self, i):
+        return (self.head + i) % len(self.slots)
+
+    def append(self, message):
+        self.extend([message])
+
+    def extend(self, messages):
+        evicted = []
+        now = time.time()
+        for message in messages:
+            if self.retention.max_messages is not None and self.count >= self.retention.max_messages:
+                evicted.append(self._evict())
+            if self.count == len(self.slots):
+                capacity = 2 * len(self.slots)
+                if self.retention.max_messages is not None:
+                    capacity = min(capacity, self.retention.max_messages)
+                self._resize(capacity)
+            slot = self._slot(self.count)
+            stamp = message.get("ts") if isinstance(message, dict) else None
+            size = message_size(message)
+            self.slots[slot] = message
+            self.stamps[slot] = stamp if isinstance(stamp, int) else int(now * 1000)
+            self.sizes[slot] = size
+            self.count += 1
+            self.bytes += size
+            if self.retention.max_bytes is not None:
+                # The newest message is kept even if it alone is over the limit
+                while self.bytes > self.retention.max_bytes and self.count > 1:
+                    evicted.append(self._evict())
+        evicted.extend(self._expire(now))
+        self._archive(evicted)
+
+    def expire(self, now=None):
+        """Evict the messages that got older than max_age, for channels idle for a while."""
+        self._archive(self._expire(now or time.time()))
+
+    def _expire(self, now):
+        cutoff = self.retention.cutoff(now)
+        evicted = []
+        while cutoff is not None and self.count and self.stamps[self.head] < cutoff:
+            evicted.append(self._evict())
+        if len(self.slots) > INITIAL_CAPACITY and self.count < len(self.slots) // 4:
+            # Give back the slots of a burst the retention evicted since
+            self._resize(max(INITIAL_CAPACITY, len(self.slots) // 2))
+        return evicted
+
+    def _evict(self):
+        message = self.slots[self.head]
+        self.slots[self.head] = None
+        self.bytes -= self.sizes[self.head]
+        self.head = (self.head + 1) % len(self.slots)
+        self.count -= 1
+        self.evicted += 1
+        return message
+
+    def _archive(self, evicted):
+        if evicted and self.sink is not None:
+            try:
+                self.sink(evicted)
+                self.archived += len(evicted)
+            except Exception as e:
+                print(f"Error archiving {len(evicted)} evicted messages: {e}")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if stop <= start:
+                return []
+            first, last = self._slot(start), self._slot(stop - 1)
+            if first <= last:
+                return self.slots[first:last + 1]
+            return self.slots[first:] + self.slots[:last + 1]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("MessageRing index out of range")
+        return self.slots[self._slot(index)]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.slots[self._slot(i)]
+
+    def __reversed__(self):
+        for i in range(self.count - 1, -1, -1):
+            yield self.slots[self._slot(i)]
+
+    def __repr__(self):
+        return repr(self[:])
+
+    def stats(self):
+        return {
+            "messages": self.count,
+            "bytes": self.bytes,
+            "capacity": len(self.slots),
+            "evicted": self.evicted,
+            "archived": self.archived,
+            "oldest_ts": self.stamps[self.head] if self.count else None,
+        }
@@ -0,0 +1,154 @@
+import json
+import os
+import time
+from threading import Lock
+
+class Journal:
+    """
+    Durable state of the tracker: an append-only log of mutations plus a
+    periodically compacted snapshot.
+
+    Records are JSON lines describing one mutation each. They only set or
+    delete keys (last writer wins), so replaying a record that is already part
+    of the snapshot is harmless; this lets the snapshot be taken while the
+    tracker keeps serving requests.
+
+    Files in directory:
+        snapshot.json   Compacted state, replaced atomically.
+        journal.log     Mutations since the snapshot.
+        journal.log.1   Log being compacted, only present after a crash mid-compaction.
+    """
+    def __init__(self, directory, snapshot_every=10000, fsync_interval=1.0):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self.log_path = os.path.join(directory, "journal.log")
+        self.rotated_path = self.log_path + ".1"
+
+        self.lock = Lock()
+        self.log_file = None
+        self.records_since_snapshot = 0
+        self.snapshot_due = False
+        self.compacting = False
+        self.last_fsync = time.monotonic()
+
+    def load(self):
+        """
+        Read the snapshot and the log tail written after it.
+
+        Returns:
+            (dict, list): The snapshot state ({} if none) and the records to replay in order.
+        """
+        state = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                state = json.load(f)
+
+        records = []
+        for path in (self.rotated_path, self.log_path):
+            if os.path.exists(path):
+                self._recover(path, records)
+        self.records_since_snapshot = len(records)
+        return state, records
+
+    def _recover(self, path, records):
+        """
+        Add the records of a log file to records and cut off a torn last line
+        left by a crash, so the records appended after the restart start on a
+        line of their own instead of being glued to it.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        position = 0
+        while position < len(data):
+            end = data.find(b"\n", position)
+            end = len(data) if end < 0 else end + 1
+            try:
+                records.append(json.loads(data[position:end]))
+            except ValueError:
+                # Torn last line of a crash, everything before it is valid
+                break
+            position = end
+        if position < len(data):
+            with open(path, "r+b") as f:
+                f.truncate(position)
+        elif data and not data.endswith(b"\n"):
+            # Only the newline of the last record was lost
+            with open(path, "ab") as f:
+                f.write(b"\n")
+
+    def open(self):
+        """Start appending after load() and the replay of its records."""
+        with self.lock:
+            self.log_file = open(self.log_path, "a")
+
+    def append(self, record):
+        """
+        Append one mutation. It is flushed to the OS right away (safe against a
+        tracker crash) and fsynced at most every fsync_interval seconds.
+        
+        Callers may hold their own locks, so compaction is never started from
+        here; snapshot_due is set instead and checked by a background task.
+        """
+        with self.lock:
+            if self.log_file is None:
+                return
+            self.log_file.write(json.dumps(record) + "\n")
+            self.log_file.flush()
+            now = time.monotonic()
+            if now - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.log_file.fileno())
+                self.last_fsync = now
+            self.records_since_snapshot += 1
+            if self.records_since_snapshot >= self.snapshot_every:
+                self.snapshot_due = True
+
+    def compact(self, dump_state):
+        """
+        Write a new snapshot and drop the log it covers.
+
+        Args:
+            dump_state (callable): Returns the current state as a JSON-serializable dict.
+                                   It is called after the log is rotated, so every
+                                   mutation is either in the new log or in the dump.
+        """
+        with self.lock:
+            if self.log_file is None or self.compacting:
+                return
+            self.compacting = True
+            self.snapshot_due = False
+            os.fsync(self.log_file.fileno())
+            self.log_file.close()
+            if os.path.exists(self.rotated_path):
+                # Left over by a crash mid-compaction and not covered by any snapshot yet
+                with open(self.rotated_path, "a") as rotated, open(self.log_path, "r") as log:
+                    rotated.write(log.read())
+                os.remove(self.log_path)
+            else:
+                os.replace(self.log_path, self.rotated_path)
+            self.log_file = open(self.log_path, "a")
+            self.records_since_snapshot = 0
+
+        try:
+            state = dump_state()
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            os.remove(self.rotated_path)
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def close(self):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.flush()
+                os.fsync(self.log_file.fileno())
+                self.log_file.close()
+                self.log_file = None
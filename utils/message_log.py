@@ -0,0 +1,272 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import time
+from threading import Lock
+
+# A segment is closed and a new one started past this many bytes of messages...
+SEGMENT_BYTES = 64 * 1024 * 1024
+# ...or this many messages, the capacity of its index
+SEGMENT_MESSAGES = 1 << 20
+
+INDEX_ENTRY = struct.Struct("!Q")  # File position of a message in its segment
+
+class Segment:
+    """
+    One segment of a MessageLog: <base>.log holds the messages with sequence
+    numbers from base on, one JSON line each, and <base>.idx, memory-mapped,
+    the position of each of them in the .log file.
+    """
+    def __init__(self, directory, base, capacity):
+        self.base = base
+        self.log_path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.capacity = capacity
+        self.count = 0  # Messages in the segment
+        self.size = 0  # Bytes of the .log file
+        self.file = None  # Open for appending, active segment only
+        self.fd = None  # Open for reading
+        self.index = None
+
+    def open(self, writable):
+        """Map the index and open the .log file; the index is created with room for capacity entries."""
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) < self.capacity * INDEX_ENTRY.size:
+            with open(self.index_path, "ab") as f:
+                f.truncate(self.capacity * INDEX_ENTRY.size)
+        with open(self.index_path, "r+b") as f:
+            self.index = mmap.mmap(f.fileno(), self.capacity * INDEX_ENTRY.size)
+        if writable:
+            self.file = open(self.log_path, "ab")
+        self.fd = os.open(self.log_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+    def recover(self):
+        """
+        Rebuild the index of the active segment from its .log file, dropping
+        a torn last line left by a crash. Only the last line is parsed, the
+        others were complete when the next one was written.
+        """
+        with open(self.log_path, "rb") as f:
+            data = f.read()
+        position = 0
+        while self.count < self.capacity:
+            end = data.find(b"\n", position)
+            if end < 0:
+                break
+            INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, position)
+            self.count += 1
+            position = end + 1
+        if self.count:
+            last = self.position(self.count - 1)
+            try:
+                json.loads(data[last:position])
+            except ValueError:
+                self.count -= 1
+                position = last
+        if position < len(data):
+            with open(self.log_path, "r+b") as f:
+                f.truncate(position)
+        self.size = position
+
+    def position(self, i):
+        """File position of message i of the segment, the end of the file past the last one."""
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)[0] if i < self.count else self.size
+
+    def append(self, line):
+        INDEX_ENTRY.pack_into(self.index, self.count * INDEX_ENTRY.size, self.size)
+        self.file.write(line)
+        self.count += 1
+        self.size += len(line)
+
+    def read(self, start, end):
+        """Messages start to end (exclusive) of the segment, counted from its base."""
+        first, last = self.position(start), self.position(end)
+        if last <= first:
+            return []
+        data = os.pread(self.fd, last - first, first) if hasattr(os, "pread") else self._read_at(first, last - first)
+        return [json.loads(line) for line in data.split(b"\n")[:-1]]
+
+    def _read_at(self, position, size):
+        # os.pread is not available on Windows
+        with open(self.log_path, "rb") as f:
+            f.seek(position)
+            return f.read(size)
+
+    def seal(self):
+        """Stop appending: the index is complete and only read from now on."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.index.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.seal()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+class MessageLog:
+    """
+    Durable history of one channel: an append-only log of its messages,
+    split in segment files named by the sequence number of their first
+    message.
+
+    Appends go to the last segment and are flushed to the OS right away
+    (safe against a host crash); they are fsynced at most every
+    fsync_interval seconds and when a segment is sealed. Each segment has
+    a memory-mapped index from sequence number to file position, so a page
+    of history anywhere in the log is read with one seek, and opening the
+    log only scans the last segment.
+
+    Messages must be appended with consecutive "seq" numbers.
+
+    Files in directory, <base> being a zero-padded sequence number:
+        <base>.log   Messages from base on, one JSON line each.
+        <base>.idx   Position of each of them in <base>.log, 8 bytes per message.
+    """
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, segment_messages=SEGMENT_MESSAGES, fsync_interval=1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_messages = segment_messages
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = Lock()
+        self.segments = []  # Oldest first
+        self.bases = []  # Base of each segment, for bisect
+        self.next_seq = 1
+        self.last_fsync = time.monotonic()
+        self.closed = False
+
+    def open(self):
+        """
+        Find the segments and recover the last one.
+
+        Returns:
+            int: The sequence number of the next message to append.
+        """
+        with self.lock:
+            bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+            for i, base in enumerate(bases):
+                segment = Segment(self.directory, base, self.segment_messages)
+                active = i == len(bases) - 1
+                segment.open(writable=active)
+                if active:
+                    segment.recover()
+                else:
+                    segment.count = bases[i + 1] - base
+                    segment.size = os.path.getsize(segment.log_path)
+                self.segments.append(segment)
+            self.bases = bases
+            if self.segments:
+                last = self.segments[-1]
+                self.next_seq = last.base + last.count
+            return self.next_seq
+
+    @property
+    def first_seq(self):
+        """Sequence number of the oldest message kept, next_seq if the log is empty."""
+        with self.lock:
+            return self.bases[0] if self.segments else self.next_seq
+
+    def append(self, message):
+        """Append a message whose "seq" is next_seq."""
+        line = json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self.lock:
+            if self.closed:
+                return
+            if message["seq"] != self.next_seq:
+                raise ValueError(f"Message {message['seq']} appended after {self.next_seq - 1}")
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.count >= segment.capacity or segment.size >= self.segment_bytes:
+                segment = self._roll()
+            segment.append(line)
+            self.next_seq += 1
+            segment.file.flush()
+            now = time.monotonic()
+            if now - self.last_fsync >= self.fsync_interval:
+                os.fsync(segment.file.fileno())
+                self.last_fsync = now
+
+    def _roll(self):
+        if self.segments:
+            self.segments[-1].seal()
+        segment = Segment(self.directory, self.next_seq, self.segment_messages)
+        open(segment.log_path, "ab").close()
+        segment.open(writable=True)
+        self.segments.append(segment)
+        self.bases.append(segment.base)
+        return segment
+
+    def read(self, start, end):
+        """The messages with sequence numbers from start to end (exclusive) still in the log."""
+        messages = []
+        with self.lock:
+            if not self.segments:
+                return messages
+            start = max(start, self.bases[0])
+            end = min(end, self.next_seq)
+            i = max(bisect.bisect_right(self.bases, start) - 1, 0)
+            while start < end and i < len(self.segments):
+                segment = self.segments[i]
+                stop = min(end, segment.base + segment.count)
+                messages.extend(segment.read(start - segment.base, stop - segment.base))
+                start = stop
+                i += 1
+        return messages
+
+    def retain(self, retention, sink=None, page_size=10000):
+        """
+        Delete the oldest segments that hold only messages outside retention
+        (utils/history.py), handing their messages to sink first if given.
+        Whole segments are deleted, so up to a segment more than retention
+        asks for is kept; the active segment is never deleted.
+
+        Returns:
+            int: The number of messages deleted.
+        """
+        deleted = 0
+        cutoff = retention.cutoff()
+        with self.lock:
+            total = sum(segment.size for segment in self.segments)
+            while len(self.segments) > 1:
+                segment = self.segments[0]
+                end = segment.base + segment.count
+                if not ((retention.max_messages is not None and self.next_seq - end >= retention.max_messages)
+                        or (retention.max_bytes is not None and total - segment.size >= retention.max_bytes)
+                        or (cutoff is not None and segment.read(segment.count - 1, segment.count)[0].get("ts", cutoff) < cutoff)):
+                    break
+                if sink is not None:
+                    for start in range(0, segment.count, page_size):
+                        sink(segment.read(start, min(segment.count, start + page_size)))
+                segment.close()
+                os.remove(segment.log_path)
+                os.remove(segment.index_path)
+                self.segments.pop(0)
+                self.bases.pop(0)
+                total -= segment.size
+                deleted += segment.count
+        return deleted
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "messages": self.next_seq - (self.bases[0] if self.segments else self.next_seq),
+                "bytes": sum(segment.size for segment in self.segments),
+            }
+
+    def close(self):
+        """Seal the log, later appends are ignored."""
+        with self.lock:
+            self.closed = True
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+            self.bases = []
@@ -0,0 +1,179 @@
+from collections import deque
+from threading import Lock
+
+# Frames a peer may have waiting to be written before its overflow policy applies
+OUTBOUND_QUEUE_SIZE = 256
+
+# Messages per frame when a peer is sent a span of the log: its history, or what it missed
+PAGE_SIZE = 500
+
+# What happens when a peer's queue is full and another broadcast arrives:
+#   drop_oldest  the oldest queued broadcast is dropped, the peer misses its messages
+#   disconnect   the peer is disconnected
+#   resync       the queued broadcasts are dropped and, once the peer caught up with the
+#                rest of its queue, the messages it missed are sent again from their sequence number
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect", "resync")
+
+class Outbox:
+    """
+    Bounded queue of the frames waiting to be written to one peer.
+
+    Broadcast frames are queued with the span [start, end) of message
+    sequence numbers they carry, responses without one. A writer (thread or
+    task) pops frames and writes them; ready() is called whenever a frame is
+    queued, so the writer can wait while the queue is empty. Responses count
+    against the limit too: a full queue makes room for one by applying the
+    policy to its broadcasts, and a peer whose queue is full of responses is
+    disconnected.
+
+    Messages the peer still has to receive but that are not queued as
+    frames, its history on CONNECT or what it missed under the resync
+    policy, are kept as a gap of sequence numbers; catch_up(start, end)
+    builds their frames a page at a time when the writer gets to them.
+    Memory stays bounded by the queue and the page size, and the peer
+    receives every message once, in order.
+    """
+    def __init__(self, limit=OUTBOUND_QUEUE_SIZE, policy="resync", catch_up=None, ready=None, page_size=PAGE_SIZE):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy}")
+        self.lock = Lock()
+        self.frames = deque()  # (frame, span), span is None for responses
+        self.limit = limit
+        self.policy = policy
+        self.catch_up = catch_up
+        self.ready = ready or (lambda: None)
+        self.page_size = page_size
+        self.gap = None  # [start, end) of the messages to send from the log once the frames are written
+        self.covered = None  # End of the messages queued or in the gap, None until the first span
+        self.closing = False
+        self.max_depth = 0
+        self.dropped_frames = 0
+        self.dropped_messages = 0
+        self.resyncs = 0
+
+    def resend(self, start, end):
+        """Send messages [start, end) from the log, e.g. the history a peer missed."""
+        with self.lock:
+            if start < end:
+                self.gap = [start, end] if self.gap is None else [min(self.gap[0], start), max(self.gap[1], end)]
+            self.covered = end if self.covered is None else max(self.covered, end)
+        self.ready()
+
+    def put(self, frame, span=None):
+        """
+        Queue a frame, span being the sequence numbers of a broadcast.
+
+        Returns:
+            bool: False if the peer overflowed under the disconnect policy and must be disconnected.
+        """
+        with self.lock:
+            if self.closing:
+                return True
+            if span is not None:
+                if self.covered is not None and span[1] <= self.covered:
+                    return True  # Sent with the history already
+                if self.gap is not None:
+                    # Sent from the log after the gap, to keep the order
+                    self.gap[1] = span[1]
+                    frame = None
+                elif self.covered is not None and span[0] != self.covered:
+                    # Overlaps the messages sent already: send exactly the new ones from the log
+                    self.gap = [self.covered, span[1]]
+                    frame = None
+                elif len(self.frames) >= self.limit and not self._overflow(span):
+                    return False
+                elif self.gap is not None:
+                    frame = None  # Resync of the queued broadcasts and this one
+                self.covered = span[1]
+            elif len(self.frames) >= self.limit and not self._make_room():
+                return False
+            if frame is not None:
+                self.frames.append((frame, span))
+                self.max_depth = max(self.max_depth, len(self.frames))
+        self.ready()
+        return True
+
+    def _overflow(self, span):
+        if self.policy == "disconnect":
+            self.dropped_frames += len(self.frames)
+            self.dropped_messages += sum(end - start for _, (start, end) in self._broadcasts())
+            self.frames.clear()
+            return False
+        if self.policy == "drop_oldest":
+            for i, (_, queued) in enumerate(self.frames):
+                if queued is not None:
+                    del self.frames[i]
+                    self.dropped_frames += 1
+                    self.dropped_messages += queued[1] - queued[0]
+                    break
+            return True
+        # resync: keep the responses, remember the span of the broadcasts instead of their frames
+        broadcasts = self._broadcasts()
+        start = broadcasts[0][1][0] if broadcasts else span[0]
+        self.frames = deque(entry for entry in self.frames if entry[1] is None)
+        self.dropped_frames += len(broadcasts)
+        self.resyncs += 1
+        self.gap = [start, span[1]]
+        return True
+
+    def _make_room(self):
+        """
+        Room for a response in the full queue, made by applying the policy to
+        the queued broadcasts (responses can not be dropped or resent).
+
+        Returns:
+            bool: False if the queue is still full, e.g. of responses to requests
+                  the peer keeps sending without reading: it must be disconnected.
+        """
+        broadcasts = self._broadcasts()
+        if broadcasts and self.policy == "drop_oldest":
+            self._overflow(None)
+        elif broadcasts and self.policy == "resync":
+            start = broadcasts[0][1][0]
+            self.frames = deque(entry for entry in self.frames if entry[1] is None)
+            self.dropped_frames += len(broadcasts)
+            self.resyncs += 1
+            self.gap = [start, self.covered] if self.gap is None else [min(self.gap[0], start), self.covered]
+        if len(self.frames) < self.limit:
+            return True
+        self.dropped_frames += len(self.frames)
+        self.dropped_messages += sum(end - start for _, (start, end) in self._broadcasts())
+        self.frames.clear()
+        return False
+
+    def _broadcasts(self):
+        return [entry for entry in self.frames if entry[1] is not None]
+
+    def pop(self):
+        """The next frame to write, None if there is none."""
+        with self.lock:
+            if self.frames:
+                return self.frames.popleft()[0]
+            if self.gap is None:
+                return None
+            start, end = self.gap
+            page_end = min(end, start + self.page_size)
+            self.gap = [page_end, end] if page_end < end else None
+        return self.catch_up(start, page_end)
+
+    def close(self):
+        """Queue no more frames; the writer stops once the queued ones are written."""
+        with self.lock:
+            self.closing = True
+        self.ready()
+
+    def done(self):
+        """True once the outbox is closed and nothing is left to write."""
+        with self.lock:
+            return self.closing and not self.frames and self.gap is None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "depth": len(self.frames),
+                "max_depth": self.max_depth,
+                "dropped_frames": self.dropped_frames,
+                "dropped_messages": self.dropped_messages,
+                "resyncs": self.resyncs,
+                "pending_messages": self.gap[1] - self.gap[0] if self.gap is not None else 0,
+            }
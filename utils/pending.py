@@ -0,0 +1,84 @@
+import heapq
+import time
+from concurrent.futures import Future
+from threading import Lock
+
+# Seconds a request waits for its reply unless the caller gives another timeout
+REQUEST_TIMEOUT = 10.0
+
+class PendingResponses:
+    """
+    Requests in flight on one connection, by request id.
+
+    register() hands out the id to send with a request and a Future that
+    resolve() completes with the (status, payload) reply carrying that id, so
+    many requests can share a connection and their replies arrive in any
+    order. A request without a reply by its deadline fails with TimeoutError
+    when expire() runs, so requests the server never answers do not pile up.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.next_id = 0
+        self.futures = {}  # {request_id: Future}
+        self.deadlines = []  # Heap of (deadline, request_id), entries of answered requests are skipped
+
+    def register(self, timeout=REQUEST_TIMEOUT):
+        """
+        Returns:
+            int: The request id to send with the request.
+            Future: Completed with the (status, payload) reply.
+        """
+        future = Future()
+        with self.lock:
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFFFFFF  # Ids are 32 bits on the wire
+            self.futures[request_id] = future
+            heapq.heappush(self.deadlines, (time.monotonic() + timeout, request_id))
+        return request_id, future
+
+    def resolve(self, request_id, response):
+        """
+        Complete the request with its reply.
+
+        Returns:
+            bool: False if no request with this id is pending, e.g. it timed out already.
+        """
+        with self.lock:
+            future = self.futures.pop(request_id, None)
+        if future is None:
+            return False
+        future.set_result(response)
+        return True
+
+    def discard(self, request_id, error):
+        """Fail a request that will get no reply, e.g. because sending it failed."""
+        with self.lock:
+            future = self.futures.pop(request_id, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def expire(self, now=None):
+        """Fail the requests whose deadline passed."""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, request_id = heapq.heappop(self.deadlines)
+                future = self.futures.pop(request_id, None)
+                if future is not None:
+                    expired.append((request_id, future))
+        for request_id, future in expired:
+            future.set_exception(TimeoutError(f"No reply to request {request_id}"))
+
+    def fail_all(self, error):
+        """Fail every pending request, once the connection is gone."""
+        with self.lock:
+            futures = list(self.futures.values())
+            self.futures.clear()
+            self.deadlines.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.futures)
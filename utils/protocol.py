@@ -1,5 +1,43 @@
+import copy
 import json
+import struct
+import time
+import zlib
 from enum import Enum
+from threading import Lock
+from utils.codec import JSON, CODECS, CODECS_BY_ID, choose_codec
+
+# Length-prefixed frames: a magic byte, a flags byte and the length of the body
+# (big endian), followed by the body "<COMMAND>\r\n<payload>" without separator.
+# Legacy frames start with an ASCII command name, never with the magic byte, so
+# a receiver tells both framings apart frame by frame. The magic byte followed by
+# a flags byte below 0x80 is not valid UTF-8, so receivers from before this
+# framing fail to decode such a frame and close the connection instead of
+# misreading it; clients use that to detect them during the handshake.
+FRAME_MAGIC = 0xC5
+FRAME_HEADER = struct.Struct("!BBI")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Flags byte: bit 0 marks a zlib-compressed body, bits 1-3 hold the id of the
+# payload codec (utils/codec.py), bit 4 tells that the sender accepts compressed
+# frames in reply, bit 5 that a request id follows the header. Flags stay below
+# 0x80 (see above).
+FLAG_COMPRESSED = 0x01
+FLAG_CODEC_SHIFT = 1
+FLAG_CODEC_MASK = 0x0E
+FLAG_ACCEPTS_COMPRESSED = 0x10
+FLAG_REQUEST_ID = 0x20
+
+# Request id of a length-prefixed frame, counted in the frame length. A response
+# carries the id of its request, so requests can be pipelined on one connection
+# and replies matched to them whatever their order (utils/pending.py).
+REQUEST_ID = struct.Struct("!I")
+
+# Bodies of at least this many bytes are compressed on wires that agreed on it;
+# smaller ones (most requests and responses) are not worth the CPU time
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+COMPRESSIONS = ["zlib"]
 
 class Command(Enum):
     LIST = "LIST"
@@ -13,57 +51,57 @@ class Command(Enum):
     CONNECT = "CONNECT"
     VIEW = "VIEW"
     DEBUG = "DEBUG"
+    LOOKUP = "LOOKUP"
+    STATS = "STATS"
+    HEARTBEAT = "HEARTBEAT"
+    UNHOST = "UNHOST"
+    SUBSCRIBE = "SUBSCRIBE"
+    EVENT = "EVENT"
+    HELLO = "HELLO"
+    BATCH = "BATCH"
+    SEARCH = "SEARCH"
     
 class Status(Enum):
     OK = "OK"
     REQUEST_ERROR = "REQUEST_ERROR"
     SERVER_ERROR = "SERVER_ERROR"
     UNAUTHORIZED = "UNAUTHORIZED"
-    
-def create_request(command, payload, separator="\\"):
+
+class Framing(Enum):
+    LEGACY = "legacy"  # Body followed by a separator
+    LENGTH = "length"  # FRAME_HEADER followed by the body
+
+# Framings this side can speak, in order of preference
+FRAMINGS = [Framing.LENGTH, Framing.LEGACY]
+
+def create_request(command, payload, separator="\\", framing=Framing.LEGACY, codec=JSON):
     """
     Create a request string to be sent to the tracker or peer.
     
     Args:
         command (Command): The command to be executed.
         payload (dict): The data associated with the command.
+        separator (string): Separate symbol ending a legacy frame
+        framing (Framing): LEGACY or LENGTH prefixed frame
+        codec: Payload codec from utils.codec, only JSON in the LEGACY framing
         
     Returns:
         str: The formatted request string.
     """
-    # Switch case for command
-    if command == Command.LIST:
-        return f"{command.value}\r\n{separator}".encode("utf-8")
-    elif command == Command.HOST:
-        # If the payload is a dictionary, convert it to a list of dictionaries
-        if isinstance(payload, dict):
-            payload = [payload]
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.MESSAGE:
-        # If the payload is a dictionary, convert it to a list of dictionaries
-        if isinstance(payload, dict):
-            payload = [payload]
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.CACHE:
-        # If the payload is a dictionary, convert it to a list of dictionaries
-        if isinstance(payload, dict):
-            payload = [payload]
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.BROADCAST:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.SIGNIN:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.SIGNUP:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.GUEST:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.CONNECT:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.VIEW:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    elif command == Command.DEBUG:
-        return f"{command.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
-    
+    return encode_frame(request_body(command, payload, codec), separator, framing, codec_flags(codec))
+
+def request_body(command, payload, codec=JSON):
+    """Encode a request without its framing: "<COMMAND>\\r\\n<payload>"."""
+    if command == Command.LIST and not payload:
+        # An empty payload asks for the whole directory, {"since_version": n} for a delta
+        return f"{command.value}\r\n".encode("utf-8")
+    return f"{command.value}\r\n".encode("utf-8") + codec.dumps(request_payload(command, payload))
+
+def request_payload(command, payload):
+    """The payload as sent for command: HOST, MESSAGE, CACHE and UNHOST take a list of dictionaries."""
+    if command in (Command.HOST, Command.MESSAGE, Command.CACHE, Command.UNHOST) and isinstance(payload, dict):
+        return [payload]
+    return payload
 
 def parse_request(response, isSeparated = False):
     """
@@ -91,7 +129,7 @@ def parse_request(response, isSeparated = False):
         print(f"Error parsing response: {response}")
         raise ValueError("Invalid response format")
     
-def create_response(status, payload, separator = "\\"):
+def create_response(status, payload, separator = "\\", framing=Framing.LEGACY, codec=JSON):
     """
     Create a response string to be sent back to the client.
     
@@ -99,10 +137,16 @@ def create_response(status, payload, separator = "\\"):
         status (Status): The status of the response.
         payload (dict): The data associated with the response.
         separator (string): Separate symbol to split 2 different response 
+        framing (Framing): LEGACY or LENGTH prefixed frame
+        codec: Payload codec from utils.codec, only JSON in the LEGACY framing
     Returns:
         str: The formatted response string.
     """
-    return f"{status.value}\r\n{json.dumps(payload) + separator}".encode("utf-8")
+    return encode_frame(response_body(status, payload, codec), separator, framing, codec_flags(codec))
+
+def response_body(status, payload, codec=JSON):
+    """Encode a response without its framing: "<STATUS>\\r\\n<payload>"."""
+    return f"{status.value}\r\n".encode("utf-8") + codec.dumps(payload)
 
 def parse_response(response, isSeparated = False):
     """
@@ -129,4 +173,458 @@ def parse_response(response, isSeparated = False):
         return status, payload
     except ValueError:
         print(f"Error parsing response: {response}")
-        raise ValueError("Invalid response format")
\ No newline at end of file
+        raise ValueError("Invalid response format")
+
+def encode_frame(body, separator="\\", framing=Framing.LEGACY, flags=0, request_id=None):
+    """
+    Frame an encoded request or response body for the wire.
+
+    Args:
+        body (bytes): "<COMMAND or STATUS>\\r\\n<payload>" as built by request_body or response_body.
+        separator (string): Separate symbol ending a legacy frame
+        framing (Framing): LEGACY appends the separator, LENGTH prepends FRAME_HEADER
+        flags (int): Flags byte of a LENGTH frame
+        request_id (int): Request id of a LENGTH frame, None for none
+    Returns:
+        bytes: The frame.
+    """
+    if framing == Framing.LENGTH:
+        if request_id is not None:
+            return (FRAME_HEADER.pack(FRAME_MAGIC, flags | FLAG_REQUEST_ID, REQUEST_ID.size + len(body))
+                    + REQUEST_ID.pack(request_id) + body)
+        return FRAME_HEADER.pack(FRAME_MAGIC, flags, len(body)) + body
+    return body + separator.encode("utf-8")
+
+def tag_frame(frame, request_id):
+    """Add a request id to a frame encoded without one, e.g. a cached response. Legacy frames have no ids."""
+    if request_id is None or not frame or frame[0] != FRAME_MAGIC:
+        return frame
+    _, flags, length = FRAME_HEADER.unpack_from(frame)
+    with memoryview(frame) as view:
+        return (FRAME_HEADER.pack(FRAME_MAGIC, flags | FLAG_REQUEST_ID, REQUEST_ID.size + length)
+                + REQUEST_ID.pack(request_id) + view[FRAME_HEADER.size:])
+
+def codec_flags(codec):
+    return codec.id << FLAG_CODEC_SHIFT
+
+class CompressionStats:
+    """Process-wide counters of the frames compressed and decompressed."""
+    def __init__(self):
+        self.lock = Lock()
+        self.compressed = 0  # Frames sent compressed
+        self.skipped = 0  # Frames above the threshold that did not get smaller
+        self.bytes_in = 0  # Body bytes before compression
+        self.bytes_out = 0  # ... and after
+        self.compress_seconds = 0.0  # CPU time spent compressing, including skipped frames
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "compressed_frames": self.compressed,
+                "skipped_frames": self.skipped,
+                "ratio": round(self.bytes_in / self.bytes_out, 2) if self.bytes_out else None,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+                "compress_cpu_ms": round(self.compress_seconds * 1000, 3),
+                "decompressed_frames": self.decompressed,
+                "decompress_cpu_ms": round(self.decompress_seconds * 1000, 3),
+            }
+
+compression_stats = CompressionStats()
+
+def compress_body(body):
+    """
+    zlib-compress a frame body.
+
+    Returns:
+        bytes: The compressed body, None if compressing did not make it smaller.
+    """
+    start = time.thread_time()
+    compressed = zlib.compress(body, COMPRESS_LEVEL)
+    elapsed = time.thread_time() - start
+    with compression_stats.lock:
+        compression_stats.compress_seconds += elapsed
+        if len(compressed) >= len(body):
+            compression_stats.skipped += 1
+            return None
+        compression_stats.compressed += 1
+        compression_stats.bytes_in += len(body)
+        compression_stats.bytes_out += len(compressed)
+    return compressed
+
+def decompress_body(data):
+    """Inflate a compressed frame body, refusing bodies inflating past MAX_FRAME_SIZE."""
+    start = time.thread_time()
+    inflater = zlib.decompressobj()
+    try:
+        body = inflater.decompress(data, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Invalid compressed frame: {e}")
+    if inflater.unconsumed_tail:
+        raise ValueError("Compressed frame is too large")
+    elapsed = time.thread_time() - start
+    with compression_stats.lock:
+        compression_stats.decompressed += 1
+        compression_stats.decompress_seconds += elapsed
+    return body
+
+def choose_compression(offered):
+    """Pick the compression of a connection from the names offered in its handshake, None if none is known."""
+    for name in offered or []:
+        if name in COMPRESSIONS:
+            return name
+    return None
+
+def choose_framing(offered):
+    """
+    Pick the framing of a connection from the framing names offered in its
+    handshake, falling back to the legacy framing if none is known.
+    """
+    for name in offered or []:
+        for framing in FRAMINGS:
+            if framing.value == name:
+                return framing
+    return Framing.LEGACY
+
+def handshake_offer():
+    """The framings, codecs and compressions this side speaks, offered in HELLO and CONNECT."""
+    return {
+        "framing": [framing.value for framing in FRAMINGS],
+        "codec": [codec.name for codec in CODECS],
+        "compression": list(COMPRESSIONS),
+        "request_ids": True,
+    }
+
+def accept_offer(offer, separator="\\"):
+    """Server side of a handshake: the Wire for what the peer offered, see Wire.agreement()."""
+    return Wire(choose_framing(offer.get("framing")), separator, choose_codec(offer.get("codec")),
+                choose_compression(offer.get("compression")), bool(offer.get("request_ids")))
+
+def agreed_wire(answer):
+    """Client side of a handshake: the Wire the server picked. Servers that picked nothing only speak legacy JSON."""
+    return Wire(choose_framing([answer.get("framing")]), codec=choose_codec([answer.get("codec")]),
+                compression=choose_compression([answer.get("compression")]),
+                request_ids=bool(answer.get("request_ids")))
+
+class Wire:
+    """
+    Encoding of the frames sent on one connection, as agreed in its handshake
+    (CONNECT with a peer host, HELLO with a tracker).
+
+    With compression agreed on, bodies of COMPRESS_THRESHOLD bytes and more
+    (a history or a message batch) are sent zlib-compressed.
+
+    request_ids tells whether the peer understands request ids, so requests
+    may carry one. A Wire answering a request (answering()) puts the id of the
+    request into its responses; untagged is the same Wire without it.
+    """
+    def __init__(self, framing=Framing.LEGACY, separator="\\", codec=JSON, compression=None, request_ids=False):
+        self.framing = framing
+        self.separator = separator
+        # Legacy frames have no flags to name another codec, a compressed body or a request id
+        self.codec = codec if framing == Framing.LENGTH else JSON
+        self.compression = compression if framing == Framing.LENGTH else None
+        self.request_ids = request_ids and framing == Framing.LENGTH
+        self.flags = codec_flags(self.codec) | (FLAG_ACCEPTS_COMPRESSED if self.compression else 0)
+        self.key = (framing, self.codec.name, self.compression)
+        self.request_id = None
+        self.untagged = self
+
+    def agreement(self):
+        """What the server echoes in a handshake answer."""
+        return {
+            "framing": self.framing.value,
+            "codec": self.codec.name,
+            "compression": self.compression,
+            "request_ids": self.request_ids,
+        }
+
+    def answering(self, request_id):
+        """Return this Wire for the responses to the request with request_id (None: untagged)."""
+        if request_id is None or self.framing != Framing.LENGTH:
+            return self.untagged
+        wire = copy.copy(self.untagged)
+        wire.request_id = request_id
+        return wire
+
+    def frame(self, body, request_id=None):
+        flags = self.flags
+        if self.compression and len(body) >= COMPRESS_THRESHOLD:
+            compressed = compress_body(body)
+            if compressed is not None:
+                body = compressed
+                flags |= FLAG_COMPRESSED
+        return encode_frame(body, self.separator, self.framing, flags, request_id)
+
+    def tag(self, frame):
+        """Add the id of the request answered to a frame encoded by untagged, e.g. a cached response."""
+        return tag_frame(frame, self.request_id)
+
+    def request(self, command, payload, request_id=None):
+        return self.frame(request_body(command, payload, self.codec), request_id)
+
+    def response(self, status, payload):
+        return self.frame(response_body(status, payload, self.codec), self.request_id)
+
+class BatchWire:
+    """
+    Stand-in for a Wire while a server handles the sub-requests of a BATCH:
+    response() returns the (status, payload) of the reply instead of encoding
+    it, so the replies are encoded together in the batch's response.
+    """
+    framing = None
+    request_id = None
+    key = ("batch",)
+
+    def __init__(self):
+        self.untagged = self
+
+    def response(self, status, payload):
+        return status.value, payload
+
+    def tag(self, reply):
+        return reply
+
+BATCH_WIRE = BatchWire()
+
+# Commands that can not be part of a BATCH: SUBSCRIBE turns the connection into
+# an event stream, CONNECT and HELLO decide how the batch itself is encoded
+UNBATCHED_COMMANDS = {Command.BATCH.value, Command.SUBSCRIBE.value, Command.CONNECT.value, Command.HELLO.value}
+
+def batch_items(requests, request_ids=None):
+    """
+    Build the payload of a BATCH: [{"command", "payload", "request_id"}, ...].
+
+    Args:
+        requests (list): [(Command, payload), ...] in the order they are handled.
+        request_ids (list): The request id of each item, none without.
+    """
+    items = []
+    for i, (command, payload) in enumerate(requests):
+        item = {"command": command.value, "payload": request_payload(command, payload)}
+        if request_ids is not None:
+            item["request_id"] = request_ids[i]
+        items.append(item)
+    return items
+
+def batch_result(item, reply):
+    """
+    Result of one BATCH item in the batch's response.
+
+    Args:
+        item (dict): The item: command, payload and optionally request_id.
+        reply: (status, payload) as returned through BATCH_WIRE, None if the command has no reply.
+    """
+    result = {"request_id": item.get("request_id")}
+    if reply is None:
+        result["status"] = None
+    else:
+        result["status"], result["payload"] = reply
+    return result
+
+def batch_rejection(item):
+    """Result of a BATCH item that is malformed or whose command can not be batched, None if it can run."""
+    if not isinstance(item, dict):
+        return {"request_id": None, "status": Status.REQUEST_ERROR.value, "payload": {"message": "Invalid batch item"}}
+    if item.get("command") in UNBATCHED_COMMANDS:
+        return batch_result(item, (Status.REQUEST_ERROR.value, {"message": f"{item.get('command')} can not be batched"}))
+    return None
+
+def batch_reply(item, handle):
+    """
+    Result of one BATCH item.
+
+    Args:
+        handle (callable): handle(command, payload) returns the item's reply through BATCH_WIRE.
+    """
+    rejection = batch_rejection(item)
+    if rejection is not None:
+        return rejection
+    try:
+        return batch_result(item, handle(item["command"], item.get("payload", {})))
+    except (ValueError, KeyError, TypeError, IndexError, AttributeError) as e:
+        # A malformed item fails alone, the rest of the batch is still handled
+        return batch_result(item, (Status.REQUEST_ERROR.value, {"message": f"Invalid request: {e}"}))
+
+class SharedFrame:
+    """
+    A request sent to many connections, e.g. a directory event or a message
+    batch: it is encoded at most once per framing and codec in use, however
+    many connections receive it.
+    """
+    def __init__(self, command, payload):
+        self.command = command
+        self.payload = payload
+        self.frames = {}  # {Wire.key: frame}
+
+    def for_wire(self, wire):
+        frame = self.frames.get(wire.key)
+        if frame is None:
+            frame = self.frames[wire.key] = wire.request(self.command, self.payload)
+        return frame
+
+class StreamDecoder:
+    """
+    Incremental decoder turning a received byte stream into frames.
+
+    Both framings are accepted on every connection: a frame starting with
+    FRAME_MAGIC is length-prefixed, anything else runs up to the separator.
+    framing, flags, codec and request_id describe the frame returned last, so
+    a server can answer in the framing and codec the request came in, with
+    its request id and compressed if the request said it accepts that
+    (reply_wire).
+
+    Data is received straight into one reusable bytearray (recv_into) and
+    frames are parsed from memoryview slices of it: a frame is decoded from
+    UTF-8 and JSON once, when it is complete, and a partial frame is never
+    copied or rescanned for each chunk that arrives. A length-prefixed frame
+    gets room for its whole body as soon as its header is read.
+    """
+    def __init__(self, separator="\\", size=4096, max_idle_size=1024 * 1024):
+        self.separator = separator.encode("utf-8")
+        self.size = size
+        # A buffer grown past this by a large frame is dropped once it is empty
+        self.max_idle_size = max_idle_size
+        self.buffer = bytearray(size)
+        self.start = 0  # First byte not consumed yet
+        self.end = 0  # End of the received bytes
+        self.scanned = 0  # buffer[start:scanned] holds no separator (legacy frames)
+        self.missing = 0  # Bytes still missing of the length-prefixed frame being received
+        self.framing = Framing.LEGACY
+        self.flags = 0
+        self.codec = JSON
+        self.request_id = None
+        self.wires = {}  # Wires of reply_wire(), by Wire.key
+
+    def reply_wire(self):
+        """Return a Wire encoding like the frame returned last, to answer it."""
+        compression = "zlib" if self.flags & FLAG_ACCEPTS_COMPRESSED else None
+        key = (self.framing, self.codec.name, compression)
+        wire = self.wires.get(key)
+        if wire is None:
+            wire = self.wires[key] = Wire(self.framing, self.separator.decode("utf-8"), self.codec, compression)
+        return wire.answering(self.request_id)
+
+    def _reserve(self, size):
+        """Make room for size bytes after end, moving the pending bytes to the front or growing the buffer."""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.scanned -= self.start
+            self.start, self.end = 0, pending
+        if len(self.buffer) - pending < size:
+            self.buffer.extend(bytes(max(len(self.buffer), pending + size - len(self.buffer))))
+
+    def feed(self, data):
+        """Append received bytes, for callers that do not own the socket (e.g. asyncio streams)."""
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def receive(self, sock, bufsize=4096):
+        """
+        Receive from sock straight into the buffer.
+
+        Returns:
+            int: The number of bytes received, 0 once the peer closed.
+        """
+        self._reserve(max(bufsize, self.missing))
+        with memoryview(self.buffer) as view:
+            received = sock.recv_into(view[self.end:])
+        self.end += received
+        return received
+
+    def _consume(self, next_start):
+        self.start = next_start
+        if self.start == self.end:
+            # Nothing pending, start over at the front instead of moving bytes later
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > self.max_idle_size:
+                self.buffer = bytearray(self.size)
+
+    def _parse(self, body_start, body_end):
+        codec = CODECS_BY_ID.get((self.flags & FLAG_CODEC_MASK) >> FLAG_CODEC_SHIFT)
+        if codec is None:
+            raise ValueError(f"Unknown codec in frame flags {self.flags:#x}")
+        self.codec = codec
+        data = self.buffer
+        if self.flags & FLAG_COMPRESSED:
+            with memoryview(self.buffer) as view:
+                data = decompress_body(view[body_start:body_end])
+            body_start, body_end = 0, len(data)
+        split = data.find(b"\r\n", body_start, body_end)
+        if split == -1:
+            raise ValueError("Invalid frame format")
+        with memoryview(data) as view:
+            command = str(view[body_start:split], "utf-8")
+            payload = codec.loads(view[split + 2:body_end]) if split + 2 < body_end else {}
+        return command, payload
+
+    def _next_frame(self):
+        """Parse and consume the next complete frame, None if there is none yet."""
+        while self.start < self.end:
+            if self.buffer[self.start] == FRAME_MAGIC:
+                if self.end - self.start < FRAME_HEADER.size:
+                    return None
+                _, flags, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+                if length > MAX_FRAME_SIZE:
+                    # The stream can not be resynchronized after this, treat it as a broken connection
+                    raise ConnectionError(f"Frame of {length} bytes is too large")
+                body_start = self.start + FRAME_HEADER.size
+                body_end = body_start + length
+                if self.end < body_end:
+                    self.missing = body_end - self.end
+                    return None
+                self.missing = 0
+                self.framing, self.flags = Framing.LENGTH, flags
+                self.request_id = None
+                # Consumed even if parsing fails, so a malformed frame is skipped
+                try:
+                    if flags & FLAG_REQUEST_ID:
+                        if length < REQUEST_ID.size:
+                            raise ValueError("Invalid frame format")
+                        self.request_id = REQUEST_ID.unpack_from(self.buffer, body_start)[0]
+                        body_start += REQUEST_ID.size
+                    return self._parse(body_start, body_end)
+                finally:
+                    self._consume(body_end)
+
+            # Only the bytes not searched yet, a separator may straddle the last chunk boundary
+            search_from = max(self.start, self.scanned - len(self.separator) + 1)
+            body_end = self.buffer.find(self.separator, search_from, self.end)
+            if body_end == -1:
+                self.scanned = self.end
+                return None
+            body_start = self.start
+            if body_end == body_start:
+                self._consume(body_end + len(self.separator))
+                continue
+            self.framing, self.flags, self.request_id = Framing.LEGACY, 0, None
+            try:
+                return self._parse(body_start, body_end)
+            finally:
+                self._consume(body_end + len(self.separator))
+        return None
+
+    def frames(self):
+        """Yield (command or status, payload) for every complete frame received so far."""
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def read_frame(self, sock, bufsize=4096):
+        """
+        Return the next (command or status, payload) received on sock,
+        receiving as much as needed. Returns None once the peer closed.
+        """
+        while True:
+            frame = self._next_frame()
+            if frame is not None:
+                return frame
+            if not self.receive(sock, bufsize):
+                return None
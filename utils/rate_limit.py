@@ -0,0 +1,51 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class RateLimiter:
+    """
+    Token buckets keyed by client (source address, username, ...).
+
+    Each key may spend burst requests at once and regains rate tokens per
+    second. Buckets are created on first use and only the max_keys most
+    recently seen keys are kept; a forgotten key simply starts with a full
+    bucket again. A rate of 0 disables the limiter.
+    """
+    def __init__(self, rate=0, burst=0, max_keys=100000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # {key: [tokens, updated]}, least recently seen first
+        self.lock = Lock()
+        self.rejected = 0
+
+    def acquire(self, key, now=None):
+        """
+        Take one token of key's bucket.
+
+        Returns:
+            float: 0 if the request may run, else the seconds until a token is available.
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.rejected += 1
+            return (1 - bucket[0]) / self.rate
+
+    def stats(self):
+        with self.lock:
+            return {"clients": len(self.buckets), "rejected": self.rejected}
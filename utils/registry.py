@@ -0,0 +1,314 @@
+import heapq
+import time
+from collections import deque
+from threading import Lock
+
+class ChannelRegistry:
+    """
+    Channel directory of the tracker, indexed by channel name.
+
+    Every change bumps a monotonically increasing version and is kept in a
+    bounded change log, so a client that already knows the directory at some
+    version only needs the channels added, updated or removed since then.
+    """
+    def __init__(self, max_changes=10000, encode_event=None):
+        self.channels = {}  # {channel_name: {channel_name, peer_server_ip, peer_server_port}}
+        self.version = 0
+        self.changes = deque(maxlen=max_changes)  # [(version, action, channel_name), ...]
+        self.lock = Lock()
+        
+        # Leases of channels registered with a TTL, expired from a heap ordered by deadline
+        self.leases = {}  # {channel_name: (expires_at, ttl)}
+        self.lease_heap = []  # [(expires_at, channel_name), ...], stale entries are skipped
+        
+        # Subscribers get every change pushed, encoded once by encode_event and shared by all
+        self.subscribers = []  # [push(event), ...], push must not block
+        self.encode_event = encode_event if encode_event is not None else (lambda event: event)
+        
+        # Optional utils.journal.Journal that records every change for recovery
+        self.journal = None
+        
+        # Encoded full LIST responses for the current version, rebuilt only after a change
+        self.listing_cache = {}  # {encoding key: response bytes}
+        self.listing_cache_version = -1
+        self.listing_cache_hits = 0
+        self.listing_cache_misses = 0
+
+    def _record(self, action, channel_name):
+        self.version += 1
+        self.changes.append((self.version, action, channel_name))
+        
+        if self.journal is not None:
+            if action == "removed":
+                self.journal.append({"op": "unregister", "version": self.version, "channel_name": channel_name})
+            else:
+                lease = self.leases.get(channel_name)
+                self.journal.append({
+                    "op": "register",
+                    "version": self.version,
+                    "channel": self.channels[channel_name],
+                    "ttl": lease[1] if lease else None,
+                })
+        
+        if self.subscribers:
+            event = {"event": action, "version": self.version, "channel_name": channel_name}
+            if action != "removed":
+                event["channel"] = self.channels[channel_name]
+            event = self.encode_event(event)
+            for push in self.subscribers:
+                push(event)
+
+    def _set_lease(self, channel_name, ttl):
+        if ttl is None:
+            # Registered without TTL, the channel stays until it is unregistered
+            self.leases.pop(channel_name, None)
+            return
+        expires_at = time.monotonic() + ttl
+        self.leases[channel_name] = (expires_at, ttl)
+        heapq.heappush(self.lease_heap, (expires_at, channel_name))
+
+    def register(self, channel, ttl=None):
+        """
+        Add a channel or refresh an existing one hosted at the same address.
+        
+        Args:
+            channel (dict): channel_name, peer_server_ip and peer_server_port.
+            ttl (float): Lease in seconds, renewed with renew(). None never expires.
+
+        Returns:
+            str: "added", "updated", "unchanged" or "conflict" when the name is
+                 already used by a channel hosted somewhere else.
+        """
+        channel_name = channel["channel_name"]
+        entry = {
+            "channel_name": channel_name,
+            "peer_server_ip": channel["peer_server_ip"],
+            "peer_server_port": channel["peer_server_port"],
+        }
+        with self.lock:
+            current = self.channels.get(channel_name)
+            if current is None:
+                self.channels[channel_name] = entry
+                self._set_lease(channel_name, ttl)
+                self._record("added", channel_name)
+                return "added"
+            if (current["peer_server_ip"], current["peer_server_port"]) != (entry["peer_server_ip"], entry["peer_server_port"]):
+                return "conflict"
+            self._set_lease(channel_name, ttl)
+            if current == entry:
+                return "unchanged"
+            self.channels[channel_name] = entry
+            self._record("updated", channel_name)
+            return "updated"
+
+    def renew(self, channel_names):
+        """
+        Extend the leases of the given channels by their TTL.
+
+        Returns:
+            list: The names that are not registered (anymore) and must be hosted again.
+        """
+        unknown = []
+        with self.lock:
+            for channel_name in channel_names:
+                if channel_name not in self.channels:
+                    unknown.append(channel_name)
+                elif channel_name in self.leases:
+                    self._set_lease(channel_name, self.leases[channel_name][1])
+        return unknown
+
+    def unregister(self, channel_name, address=None):
+        """
+        Remove a channel. If address (ip, port) is given, only the channel
+        hosted at that address is removed. Returns True if it was removed.
+        """
+        with self.lock:
+            current = self.channels.get(channel_name)
+            if current is None:
+                return False
+            if address is not None and (current["peer_server_ip"], current["peer_server_port"]) != tuple(address):
+                return False
+            del self.channels[channel_name]
+            self.leases.pop(channel_name, None)
+            self._record("removed", channel_name)
+            return True
+
+    def next_expiry(self):
+        """Monotonic time of the earliest lease deadline, None if no lease is pending."""
+        with self.lock:
+            while self.lease_heap:
+                expires_at, channel_name = self.lease_heap[0]
+                lease = self.leases.get(channel_name)
+                if lease is not None and lease[0] == expires_at:
+                    return expires_at
+                # Renewed or unregistered since it was pushed
+                heapq.heappop(self.lease_heap)
+            return None
+
+    def expire(self, now=None):
+        """
+        Unregister every channel whose lease has run out. Only the due heap
+        entries are visited, never the whole directory.
+
+        Returns:
+            list: The names of the expired channels.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while self.lease_heap and self.lease_heap[0][0] <= now:
+                expires_at, channel_name = heapq.heappop(self.lease_heap)
+                lease = self.leases.get(channel_name)
+                if lease is None or lease[0] != expires_at:
+                    continue
+                del self.leases[channel_name]
+                del self.channels[channel_name]
+                self._record("removed", channel_name)
+                expired.append(channel_name)
+        return expired
+
+    def get(self, channel_name):
+        """Direct lookup of a channel by name, None if it is not registered."""
+        with self.lock:
+            return self.channels.get(channel_name)
+
+    def snapshot(self):
+        """Return (version, [channel, ...]) of the whole directory."""
+        with self.lock:
+            # Entries are replaced, never mutated, so a shallow copy is enough
+            return self.version, list(self.channels.values())
+
+    def encoded_listing(self, encode, key=None):
+        """
+        Return the whole directory encoded as a ready-to-send response.
+        
+        The bytes are cached and only rebuilt when a registration, unregistration
+        or expiry bumped the version since the last call.
+        
+        Args:
+            encode (callable): Builds the response bytes from the list of channels.
+            key: Identifies the encoding when several response formats are cached.
+        """
+        with self.lock:
+            if self.listing_cache_version != self.version:
+                self.listing_cache = {}
+                self.listing_cache_version = self.version
+            response = self.listing_cache.get(key)
+            if response is not None:
+                self.listing_cache_hits += 1
+                return response
+            self.listing_cache_misses += 1
+            response = encode(list(self.channels.values()))
+            self.listing_cache[key] = response
+            return response
+
+    def dump(self):
+        """State of the registry for a journal snapshot."""
+        with self.lock:
+            return {
+                "version": self.version,
+                "channels": [
+                    {"channel": channel, "ttl": self.leases[name][1] if name in self.leases else None}
+                    for name, channel in self.channels.items()
+                ],
+            }
+
+    def restore(self, state):
+        """
+        Load a snapshot made by dump(). Leased channels get a fresh lease so
+        their hosts have a full TTL to send the next heartbeat.
+        """
+        with self.lock:
+            for entry in state.get("channels", []):
+                channel = entry["channel"]
+                self.channels[channel["channel_name"]] = channel
+                self._set_lease(channel["channel_name"], entry["ttl"])
+            self.version = state.get("version", 0)
+
+    def replay(self, record):
+        """Apply one journal record written by _record()."""
+        if record["op"] == "register":
+            self.register(record["channel"], record["ttl"])
+        elif record["op"] == "unregister":
+            self.unregister(record["channel_name"])
+        with self.lock:
+            # Keep versions known by clients valid after the restart
+            self.version = max(self.version, record["version"])
+
+    def stats(self):
+        """Counters describing the registry and its LIST response cache."""
+        with self.lock:
+            return {
+                "channels": len(self.channels),
+                "version": self.version,
+                "leases": len(self.leases),
+                "subscribers": len(self.subscribers),
+                "list_cache_hits": self.listing_cache_hits,
+                "list_cache_misses": self.listing_cache_misses,
+            }
+
+    def subscribe(self, push, since_version=0):
+        """
+        Register push to receive every later change and return the delta since
+        since_version. Both happen under the lock, so no change is missed or
+        delivered twice between the delta and the first event.
+        """
+        with self.lock:
+            self.subscribers.append(push)
+            return self._changes_since(since_version)
+
+    def unsubscribe(self, push):
+        with self.lock:
+            if push in self.subscribers:
+                self.subscribers.remove(push)
+
+    def changes_since(self, since_version):
+        """
+        Build the directory delta between since_version and the current version.
+
+        Falls back to a full listing when since_version is older than the
+        change log or newer than the registry (e.g. the tracker restarted).
+
+        Returns:
+            dict: {"version", "full": True, "channels"} or
+                  {"version", "full": False, "added", "updated", "removed"}
+        """
+        with self.lock:
+            return self._changes_since(since_version)
+
+    def _changes_since(self, since_version):
+        # Caller holds self.lock
+        oldest = self.changes[0][0] - 1 if self.changes else self.version
+        if since_version < oldest or since_version > self.version:
+            return {
+                "version": self.version,
+                "full": True,
+                "channels": list(self.channels.values()),
+            }
+
+        # First action after since_version tells whether the client knew the channel
+        first_action = {}
+        for version, action, channel_name in reversed(self.changes):
+            if version <= since_version:
+                break
+            first_action[channel_name] = action
+
+        added, updated, removed = [], [], []
+        # Walk back in version order so added channels keep their registration order
+        for channel_name, action in reversed(first_action.items()):
+            channel = self.channels.get(channel_name)
+            if channel is None:
+                if action != "added":
+                    removed.append(channel_name)
+            elif action == "added":
+                added.append(channel)
+            else:
+                updated.append(channel)
+
+        return {
+            "version": self.version,
+            "full": False,
+            "added": added,
+            "updated": updated,
+            "removed": removed,
+        }
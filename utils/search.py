@@ -0,0 +1,194 @@
+import bisect
+import heapq
+import math
+import re
+from array import array
+from collections import Counter
+from threading import Lock
+
+# Results a SEARCH returns per page unless it asks for fewer
+MAX_SEARCH_RESULTS = 100
+
+SORTS = ("newest", "relevance")
+
+# BM25 parameters, the usual defaults
+K1 = 1.2
+B = 0.75
+
+TOKEN = re.compile(r"\w+")
+
+def tokenize(text):
+    return TOKEN.findall(text.lower()) if isinstance(text, str) else []
+
+class SearchIndex:
+    """
+    Inverted index over the messages of a channel, kept up to date as they
+    are appended, so a search never scans the history.
+
+    Each term of a message's message_content and username maps to the
+    ascending sequence numbers of the messages holding it (4 bytes each)
+    and how often each holds it (1 byte). Each username maps to the sequence
+    numbers of its messages, and two arrays indexed by sequence number hold
+    the timestamp ("ts") and the number of terms of every message. Sequence
+    numbers being in order everywhere, filters and intersections are
+    bisections of sorted arrays, and a time range maps to a range of
+    sequence numbers.
+
+    Messages must be added with consecutive "seq" numbers and a "ts" that
+    never decreases, as PeerHost stamps them.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.terms = {}  # {term: array of seq}
+        self.frequencies = {}  # {term: array of the term's count in each message of terms[term]}
+        self.users = {}  # {username: array of seq}
+        self.base = None  # Sequence number of the first message indexed
+        self.stamps = array("q")  # "ts" of message base + i
+        self.lengths = array("H")  # Terms in message base + i
+        self.total_length = 0
+
+    @property
+    def next_seq(self):
+        return self.base + len(self.stamps) if self.base is not None else None
+
+    def add(self, message):
+        seq = message["seq"]
+        terms = tokenize(message.get("message_content")) + tokenize(message.get("username"))
+        with self.lock:
+            if self.base is None:
+                self.base = seq
+            elif seq != self.next_seq:
+                raise ValueError(f"Message {seq} indexed after {self.next_seq - 1}")
+            for term, frequency in Counter(terms).items():
+                postings = self.terms.get(term)
+                if postings is None:
+                    postings = self.terms[term] = array("I")
+                    self.frequencies[term] = array("B")
+                postings.append(seq)
+                self.frequencies[term].append(min(frequency, 0xFF))
+            username = message.get("username")
+            if isinstance(username, str):
+                postings = self.users.get(username)
+                if postings is None:
+                    postings = self.users[username] = array("I")
+                postings.append(seq)
+            self.stamps.append(message.get("ts", self.stamps[-1] if self.stamps else 0))
+            self.lengths.append(min(len(terms), 0xFFFF))
+            self.total_length += len(terms)
+
+    def forget_before(self, seq):
+        """Drop the messages before seq, e.g. once retention evicted them."""
+        with self.lock:
+            if self.base is None or seq <= self.base:
+                return
+            for index in (self.terms, self.users):
+                for key in list(index):
+                    postings = index[key]
+                    drop = bisect.bisect_left(postings, seq)
+                    del postings[:drop]
+                    if index is self.terms:
+                        del self.frequencies[key][:drop]
+                    if not postings:
+                        del index[key]
+                        self.frequencies.pop(key, None)
+            drop = min(seq - self.base, len(self.stamps))
+            self.total_length -= sum(self.lengths[:drop])
+            del self.stamps[:drop]
+            del self.lengths[:drop]
+            self.base += drop
+
+    def search(self, query="", username=None, since=None, until=None, sort="newest", offset=0, limit=20):
+        """
+        Messages holding every term of query, optionally only those of
+        username and with since <= ts < until (epoch milliseconds).
+
+        sort is "newest" (most recent first) or "relevance" (BM25 over the
+        query terms, most recent first among equal scores).
+
+        Returns:
+            tuple: (total, seqs), the number of matching messages and the
+                   sequence numbers of the page [offset, offset + limit).
+        """
+        if sort not in SORTS:
+            raise ValueError(f"Unknown sort {sort}")
+        if offset < 0 or limit < 1:
+            # A page of no results would never advance a client paging on next_offset
+            raise ValueError("offset must be 0 or more and limit 1 or more")
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self.lock:
+            if self.base is None:
+                return 0, []
+            low, high = self._seq_range(since, until)
+            lists = []
+            for term in terms:
+                postings = self.terms.get(term)
+                if postings is None:
+                    return 0, []
+                lists.append(postings)
+            if username is not None:
+                postings = self.users.get(username)
+                if postings is None:
+                    return 0, []
+                lists.append(postings)
+            matches = self._intersect(lists, low, high)
+            if sort == "relevance" and terms:
+                return len(matches), self._rank(terms, matches, offset, limit)
+        # Most recent first
+        total = len(matches)
+        start, end = max(total - offset - limit, 0), max(total - offset, 0)
+        return total, list(reversed(matches[start:end]))
+
+    def _seq_range(self, since, until):
+        """Sequence numbers [low, high) of the messages with since <= ts < until."""
+        low = self.base + (bisect.bisect_left(self.stamps, since) if since is not None else 0)
+        high = self.base + (bisect.bisect_left(self.stamps, until) if until is not None else len(self.stamps))
+        return low, high
+
+    def _intersect(self, lists, low, high):
+        """Sorted sequence numbers in [low, high) present in every list."""
+        if not lists:
+            return range(low, max(low, high))
+        # Start from the shortest list and keep what the others hold too, found by bisection
+        lists = sorted(lists, key=len)
+        first = lists[0]
+        matches = first[bisect.bisect_left(first, low):bisect.bisect_left(first, high)]
+        for other in lists[1:]:
+            kept = array("I")
+            position = 0
+            for seq in matches:
+                position = bisect.bisect_left(other, seq, position)
+                if position == len(other):
+                    break
+                if other[position] == seq:
+                    kept.append(seq)
+            matches = kept
+        return matches
+
+    def _rank(self, terms, matches, offset, limit):
+        count = len(self.stamps)
+        average = self.total_length / count if count else 1
+        weights = [(self.terms[term], self.frequencies[term],
+                    math.log(1 + (count - len(self.terms[term]) + 0.5) / (len(self.terms[term]) + 0.5)))
+                   for term in terms]
+        lengths, base = self.lengths, self.base
+
+        def score(seq):
+            norm = K1 * (1 - B + B * lengths[seq - base] / average)
+            total = 0
+            for postings, frequencies, idf in weights:
+                frequency = frequencies[bisect.bisect_left(postings, seq)]
+                total += idf * frequency * (K1 + 1) / (frequency + norm)
+            return total, seq
+        return [seq for _, seq in heapq.nlargest(offset + limit, (score(seq) for seq in matches))][offset:]
+
+    def stats(self):
+        with self.lock:
+            postings = sum(len(p) for p in self.terms.values()) + sum(len(p) for p in self.users.values())
+            return {
+                "messages": len(self.stamps),
+                "terms": len(self.terms),
+                "users": len(self.users),
+                "postings": postings,
+                # Sequence numbers, term counts, and the timestamp and length of every message
+                "index_bytes": postings * 4 + sum(len(f) for f in self.frequencies.values()) + len(self.stamps) * 10,
+            }